@@ -11,9 +11,30 @@ def setup_config(app):
 
 
 async def setup_storage(app):
-    from pgfire.engine.storage.postgres import PostgresJsonStorage
     dbconfig = app['config']['db']
-    app['storage'] = PostgresJsonStorage(dbconfig)
+    if dbconfig.get('engine') == 'memory':
+        from pgfire.engine.storage.memory import MemoryJsonStorage
+        app['storage'] = MemoryJsonStorage(dbconfig)
+    elif dbconfig.get('shards'):
+        from pgfire.engine.storage.postgres.shards import ShardedJsonStorage
+        app['storage'] = ShardedJsonStorage(dbconfig)
+    else:
+        from pgfire.engine.storage.postgres import PostgresJsonStorage
+        app['storage'] = PostgresJsonStorage(dbconfig)
+
+async def setup_fanout(app):
+    from pgfire.rest.fanout import EventFanout, DEFAULT_MAX_QUEUED_EVENTS
+    app['fanout'] = EventFanout(app['storage'], app['config'].get('max_queued_events', DEFAULT_MAX_QUEUED_EVENTS))
+
+
+async def close_fanout(app):
+    await app['fanout'].close()
+
+
+async def setup_admission(app):
+    from pgfire.rest.admission import get_admission_controller
+    app['admission'] = get_admission_controller(app['config'].get('admission'))
+
 
 async def close_storage(app):
     app['storage'].close()
@@ -30,9 +51,13 @@ def setup_routes(app):
 
 
 def prepare_app():
-    _app = web.Application()
+    from pgfire.rest.admission import admission_middleware
+    _app = web.Application(middlewares=[admission_middleware])
     setup_config(_app)
+    _app.on_startup.append(setup_admission)
     _app.on_startup.append(setup_storage)
+    _app.on_startup.append(setup_fanout)
+    _app.on_cleanup.append(close_fanout)
     _app.on_cleanup.append(close_storage)
     setup_routes(_app)
     return _app
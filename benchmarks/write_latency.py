@@ -0,0 +1,54 @@
+"""
+    Write latency of the storage, run against the db configured in config.json
+    python -m benchmarks.write_latency --writes 2000
+    --engine memory measures the in-process storage, the baseline without postgres
+"""
+import argparse
+import time
+
+from pgfire.engine.storage.memory import MemoryJsonStorage
+from pgfire.engine.storage.postgres import PostgresJsonStorage
+
+BENCH_DB_NAME = "bench_write_latency"
+
+
+def timed(writes, write_fn):
+    latencies = []
+    for i in range(writes):
+        start = time.perf_counter()
+        write_fn(i)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def run(db_settings: dict, writes: int, storage_cls=PostgresJsonStorage):
+    with storage_cls(db_settings) as storage:
+        if storage.get_db(BENCH_DB_NAME):
+            storage.delete_db(BENCH_DB_NAME)
+        json_db = storage.create_db(BENCH_DB_NAME)
+        cases = [
+            ("put new l1 key", lambda i: json_db.put("k%s/v" % i, i)),
+            ("put deep path", lambda i: json_db.put("deep/a/b/c/%s" % (i % 100), {"v": i})),
+            ("patch", lambda i: json_db.patch("deep/a/b", {"p": i})),
+            ("increment", lambda i: json_db.increment("counter/n")),
+            ("delete", lambda i: json_db.delete("k%s/v" % i)),
+        ]
+        for name, write_fn in cases:
+            stats = timed(writes, write_fn)
+            print("%-16s mean %.3f ms  p50 %.3f ms  p99 %.3f ms" % (
+                name, stats["mean_ms"], stats["p50_ms"], stats["p99_ms"]))
+        storage.delete_db(BENCH_DB_NAME)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pgfire write latency")
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--engine', choices=['postgresql', 'memory'], default='postgresql')
+    args = parser.parse_args()
+    from pgfire.conf import config
+    run(config['db'], args.writes, MemoryJsonStorage if args.engine == 'memory' else PostgresJsonStorage)
@@ -0,0 +1,402 @@
+"""
+    Python client of the pgfire REST api
+
+        with PgfireClient("http://localhost:8666") as client:
+            blog = client.db("blog_db")
+            blog.put("posts/first", {"title": "hello"})
+            blog.subscribe("posts")
+            blog.get("posts/first")  # served from the local cache
+"""
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pgfire.engine.storage.utils import is_related_path
+
+__all__ = ["PgfireClient", "ClientDb", "WriteBatch", "Subscription"]
+
+# same as pgfire.rest.api
+LSN_HEADER = 'X-Pgfire-Lsn'
+NEXT_PAGE_HEADER = 'X-Pgfire-Next'
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10
+RECONNECT_DELAY = 1.0
+
+
+def _split(path: str) -> List[str]:
+    return path.split('/') if path else []
+
+
+def _tree_get(tree, keys: List[str]):
+    for key in keys:
+        if not isinstance(tree, dict) or key not in tree:
+            return None
+        tree = tree[key]
+    return tree
+
+
+def _tree_set(tree: dict, keys: List[str], value, merge: bool = False):
+    for key in keys[:-1]:
+        if not isinstance(tree.get(key), dict):
+            tree[key] = {}
+        tree = tree[key]
+    if merge and isinstance(tree.get(keys[-1]), dict) and isinstance(value, dict):
+        tree[keys[-1]].update(value)
+    else:
+        tree[keys[-1]] = value
+
+
+def _tree_delete(tree: dict, keys: List[str]):
+    nodes = [tree]
+    for key in keys[:-1]:
+        if not isinstance(nodes[-1].get(key), dict):
+            return
+        nodes.append(nodes[-1][key])
+    nodes[-1].pop(keys[-1], None)
+    # the server removes objects left empty by a delete
+    for i in range(len(nodes) - 1, 0, -1):
+        if nodes[i]:
+            break
+        del nodes[i - 1][keys[i - 1]]
+
+
+def _is_event(message) -> bool:
+    return isinstance(message, dict) and message.get('event') in ('put', 'patch', 'delete') \
+        and isinstance(message.get('path'), str) and 'data' in message
+
+
+class PgfireClient(object):
+    """
+        Keeps a pool of keep-alive connections to one pgfire server,
+        shared by all dbs of the client and safe to use from many threads.
+    """
+
+    def __init__(self, base_url: str = "http://localhost:8666", pool_size: int = DEFAULT_POOL_SIZE,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # write position of the last write, sent with reads to observe it on replicas
+        self.last_lsn = None
+        self.dbs = {}
+
+    def request(self, method: str, url_path: str, **kwargs) -> requests.Response:
+        headers = kwargs.pop('headers', {})
+        if method == 'GET' and self.last_lsn:
+            headers[LSN_HEADER] = self.last_lsn
+        response = self.session.request(method, self.base_url + url_path, headers=headers,
+                                        timeout=kwargs.pop('timeout', self.timeout), **kwargs)
+        response.raise_for_status()
+        if response.headers.get(LSN_HEADER):
+            self.last_lsn = response.headers[LSN_HEADER]
+        return response
+
+    def create_db(self, db_name: str, durability: str = None) -> 'ClientDb':
+        """
+        :param durability: one of pgfire.engine.storage.base.DURABILITY_LEVELS, durable by default
+        """
+        body = {"db_name": db_name}
+        if durability is not None:
+            body["durability"] = durability
+        self.request('POST', '/createdb', json=body)
+        return self.db(db_name)
+
+    def db(self, db_name: str) -> 'ClientDb':
+        if db_name not in self.dbs:
+            self.dbs[db_name] = ClientDb(self, db_name)
+        return self.dbs[db_name]
+
+    def close(self):
+        for db in self.dbs.values():
+            db.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ClientDb(object):
+    """
+        Reads and writes of one json db. Reads at or below a subscribed
+        path are served from the local copy while its change stream is
+        connected.
+    """
+
+    def __init__(self, client: PgfireClient, db_name: str):
+        self.client = client
+        self.db_name = db_name
+        self.subscriptions = {}
+        self.cache_lock = threading.Lock()
+        self.cache = {}
+
+    def __url(self, path: str) -> str:
+        if not path:
+            return '/database/%s' % self.db_name
+        return '/database/%s/%s' % (self.db_name, path)
+
+    def __cached(self, path: str) -> Tuple[bool, object]:
+        for sub_path, subscription in self.subscriptions.items():
+            if subscription.synced and (not sub_path or path == sub_path or
+                                        (path or '').startswith(sub_path + '/')):
+                with self.cache_lock:
+                    return True, json.loads(json.dumps(_tree_get(self.cache, _split(path))))
+        return False, None
+
+    def get(self, path: str = None, fields: List[str] = None):
+        if fields is None:
+            cached, value = self.__cached(path)
+            if cached:
+                return value
+        params = {'fields': ','.join(fields)} if fields is not None else None
+        return self.client.request('GET', self.__url(path), params=params).json()
+
+    def get_page(self, path: str, limit: int, after: str = None,
+                 fields: List[str] = None) -> Tuple[dict, Optional[str]]:
+        params = {'limit': limit}
+        if after is not None:
+            params['after'] = after
+        if fields is not None:
+            params['fields'] = ','.join(fields)
+        response = self.client.request('GET', self.__url(path), params=params)
+        return response.json(), response.headers.get(NEXT_PAGE_HEADER)
+
+    @staticmethod
+    def __ttl_params(ttl: float):
+        return {'ttl': ttl} if ttl is not None else None
+
+    @staticmethod
+    def __written(response: requests.Response):
+        # the server writes bodies above its stream_body_threshold as they arrive and answers 204
+        if response.status_code == 204 or not response.content:
+            return None
+        return response.json()
+
+    def put(self, path: str, value, ttl: float = None):
+        """
+        :param ttl: seconds after which the server deletes path
+        :return: the value written, None when the server streamed a large value
+        """
+        return self.__written(self.client.request('PUT', self.__url(path), params=self.__ttl_params(ttl),
+                                                  json=value))
+
+    def post(self, path: str, value, ttl: float = None) -> dict:
+        return self.client.request('POST', self.__url(path), params=self.__ttl_params(ttl), json=value).json()
+
+    def patch(self, path: str, value, ttl: float = None):
+        """
+        :return: the value at path, None when the server streamed a large value
+        """
+        return self.__written(self.client.request('PATCH', self.__url(path), params=self.__ttl_params(ttl),
+                                                  json=value))
+
+    def replace(self, path: str, value):
+        """
+        a put that rewrites and notifies only the children that differ, a put at the root always does
+        """
+        return self.client.request('PUT', self.__url(path), params={'op': 'replace'}, json=value).json()
+
+    def delete(self, path: str) -> bool:
+        return self.client.request('DELETE', self.__url(path)).json()
+
+    def atomic(self, path: str, op: str, value):
+        """
+        :param op: one of pgfire.engine.storage.base.ATOMIC_OPS
+        """
+        return self.client.request('PATCH', self.__url(path), params={'op': op}, json=value).json()
+
+    def increment(self, path: str, by=1):
+        return self.atomic(path, 'increment', by)
+
+    def batch(self) -> 'WriteBatch':
+        return WriteBatch(self)
+
+    def subscribe(self, path: str = None) -> 'Subscription':
+        """
+        keeps a local copy of the data at path current with its change stream
+        """
+        path = path or ''
+        if path not in self.subscriptions:
+            subscription = Subscription(self, path)
+            self.subscriptions[path] = subscription
+            subscription.start()
+        return self.subscriptions[path]
+
+    def unsubscribe(self, path: str = None):
+        subscription = self.subscriptions.pop(path or '', None)
+        if subscription is not None:
+            subscription.close()
+
+    def apply(self, subscription: 'Subscription', message):
+        """
+        applies a message of the change stream of subscription to the local copy
+        """
+        if not _is_event(message) or not is_related_path(message['path'], subscription.path):
+            # the data at the path sent first is older than the data read on connect
+            return
+        if message.get('truncated'):
+            # too large to be sent with the event, read it
+            message = dict(message, event='put', data=self.client.request('GET', self.__url(message['path'])).json())
+        with self.cache_lock:
+            keys = _split(message['path'])
+            if message['event'] == 'delete':
+                _tree_delete(self.cache, keys)
+            else:
+                _tree_set(self.cache, keys, message['data'], merge=message['event'] == 'patch')
+
+    def reset(self, subscription: 'Subscription', value):
+        with self.cache_lock:
+            self.__replace(subscription.path, value)
+
+    def __replace(self, path: str, value):
+        keys = _split(path)
+        if not keys:
+            self.cache = value if isinstance(value, dict) else {}
+        elif value is None:
+            _tree_delete(self.cache, keys)
+        else:
+            _tree_set(self.cache, keys, value)
+
+    def close(self):
+        for path in list(self.subscriptions):
+            self.unsubscribe(path)
+
+
+class WriteBatch(object):
+    """
+        Collects writes and sends them together over the pooled connections.
+        Writes of a batch may be applied in any order, servers running group
+        commit apply writes arriving together in one transaction.
+
+            with db.batch() as batch:
+                batch.put("a", 1)
+                batch.increment("n")
+            batch.results  # [1, 1]
+    """
+
+    def __init__(self, db: ClientDb):
+        self.db = db
+        self.writes = []
+        self.results = None
+
+    def put(self, path: str, value):
+        self.writes.append((self.db.put, path, value))
+
+    def post(self, path: str, value):
+        self.writes.append((self.db.post, path, value))
+
+    def patch(self, path: str, value):
+        self.writes.append((self.db.patch, path, value))
+
+    def delete(self, path: str):
+        self.writes.append((self.db.delete, path))
+
+    def atomic(self, path: str, op: str, value):
+        self.writes.append((self.db.atomic, path, op, value))
+
+    def increment(self, path: str, by=1):
+        self.atomic(path, 'increment', by)
+
+    def execute(self) -> list:
+        """
+        :return: result of each write, in the order the writes were added
+        """
+        writes, self.writes = self.writes, []
+        with ThreadPoolExecutor(max_workers=min(self.db.client.pool_size, len(writes) or 1)) as executor:
+            futures = [executor.submit(write[0], *write[1:]) for write in writes]
+            self.results = [future.result() for future in futures]
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+
+class Subscription(object):
+    """
+        Change stream of one path of a db, reconnects when the stream is lost.
+        The local copy is used for reads only while the stream is connected.
+    """
+
+    def __init__(self, db: ClientDb, path: str):
+        self.db = db
+        self.path = path
+        self.synced = False
+        self.closed = False
+        self.response = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def wait_synced(self, timeout: float = None) -> bool:
+        return self.ready.wait(timeout)
+
+    def __run(self):
+        client = self.db.client
+        url_path = '/%s' % self.db.db_name
+        if self.path:
+            url_path += '/' + self.path
+        while not self.closed:
+            try:
+                self.response = client.session.get(client.base_url + '/database_events' + url_path, stream=True,
+                                                   timeout=(client.timeout, None),
+                                                   headers={'Accept': 'text/event-stream'})
+                self.response.raise_for_status()
+                # changes from here on arrive on the stream, start from the data as of now
+                self.db.reset(self, client.request('GET', '/database' + url_path).json())
+                self.synced = True
+                self.ready.set()
+                for message in self.__messages(self.response):
+                    self.db.apply(self, message)
+            except Exception:
+                pass
+            finally:
+                self.synced = False
+                if self.response is not None:
+                    self.response.close()
+            if not self.closed:
+                time.sleep(RECONNECT_DELAY)
+
+    @staticmethod
+    def __messages(response):
+        data = []
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if line.startswith('data:'):
+                data.append(line[5:].lstrip(' '))
+            elif not line and data:
+                yield json.loads('\n'.join(data))
+                data = []
+
+    def close(self):
+        self.closed = True
+        self.synced = False
+        response = self.response
+        if response is not None:
+            # wakes up the stream thread blocked reading the socket
+            sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            response.close()
@@ -1,4 +1,4 @@
-from typing import Union, List
+from typing import Dict, Union, List, Optional, Tuple
 
 from ..utils import PushID
 
@@ -6,6 +6,18 @@ post_push_id = PushID()
 
 JSON_PRIMITIVES = Union[int, float, bool, dict, str, None]
 
+# write operations applied atomically by the storage on the current value
+ATOMIC_OPS = ('increment', 'append', 'remove_from_array', 'max', 'min')
+NUMERIC_ATOMIC_OPS = ('increment', 'max', 'min')
+
+# durability of the writes of a db: committed with a WAL flush, committed without waiting
+# for the flush (the last writes may be lost on a crash), or not written to the WAL at all
+# (the db is emptied after a crash)
+DURABLE = 'durable'
+ASYNC_COMMIT = 'async_commit'
+UNLOGGED = 'unlogged'
+DURABILITY_LEVELS = (DURABLE, ASYNC_COMMIT, UNLOGGED)
+
 
 class BaseJsonDb(object):
     """
@@ -16,21 +28,118 @@ class BaseJsonDb(object):
         self.db_name = db_name
         self.storage = storage
 
-    def get(self, path: str = None) -> JSON_PRIMITIVES:
-        return self.storage.get_from_path(self.db_name, path)
+    def get(self, path: str = None, min_lsn: str = None, fields: List[str] = None) -> JSON_PRIMITIVES:
+        return self.storage.get_from_path(self.db_name, path, min_lsn, fields)
+
+    def get_page(self, path: str, limit: int, after: str = None,
+                 min_lsn: str = None, fields: List[str] = None) -> Tuple[dict, Optional[str]]:
+        return self.storage.get_page_from_path(self.db_name, path, limit, after, min_lsn, fields)
+
+    def query(self, path: str, order_by: str, start_at: JSON_PRIMITIVES = None, end_at: JSON_PRIMITIVES = None,
+              limit_to_first: int = None, limit_to_last: int = None, min_lsn: str = None,
+              fields: List[str] = None) -> dict:
+        return self.storage.query_from_path(self.db_name, path, order_by, start_at, end_at,
+                                            limit_to_first, limit_to_last, min_lsn, fields)
+
+    def put(self, path: str, value: JSON_PRIMITIVES, report_changed: bool = False,
+            ttl: float = None) -> JSON_PRIMITIVES:
+        return self.storage.put_at_path(self.db_name, path, value, report_changed, ttl)
 
-    def put(self, path: str, value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
-        return self.storage.put_at_path(self.db_name, path, value)
+    def post(self, path: str, value: JSON_PRIMITIVES, ttl: float = None) -> JSON_PRIMITIVES:
+        return self.storage.post_at_path(self.db_name, path, value, ttl)
 
-    def post(self, path: str, value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
-        return self.storage.post_at_path(self.db_name, path, value)
+    def patch(self, path: str, value: JSON_PRIMITIVES, report_changed: bool = False,
+              ttl: float = None) -> JSON_PRIMITIVES:
+        return self.storage.patch_at_path(self.db_name, path, value, report_changed, ttl)
 
-    def patch(self, path: str, value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
-        return self.storage.patch_at_path(self.db_name, path, value)
+    def replace(self, path: str, value: JSON_PRIMITIVES) -> int:
+        return self.storage.replace_at_path(self.db_name, path, value)
 
     def delete(self, path: str) -> bool:
         return self.storage.delete_at_path(self.db_name, path)
 
+    def increment(self, path: str, by: Union[int, float] = 1) -> JSON_PRIMITIVES:
+        return self.storage.atomic_at_path(self.db_name, path, 'increment', by)
+
+    def append(self, path: str, value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
+        return self.storage.atomic_at_path(self.db_name, path, 'append', value)
+
+    def remove_from_array(self, path: str, value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
+        return self.storage.atomic_at_path(self.db_name, path, 'remove_from_array', value)
+
+    def max(self, path: str, value: Union[int, float]) -> JSON_PRIMITIVES:
+        return self.storage.atomic_at_path(self.db_name, path, 'max', value)
+
+    def min(self, path: str, value: Union[int, float]) -> JSON_PRIMITIVES:
+        return self.storage.atomic_at_path(self.db_name, path, 'min', value)
+
+
+class JsonChildrenWriter(object):
+    """
+        Writes the value at path one batch of children at a time, for values
+        too large to hold at once. 'put' replaces the value at path,
+        'patch' merges the children into it. Children of the root are
+        written as rows of their own, below the root each batch is merged
+        with one write, so the data of an l1_key is not rewritten for every
+        child. Storages subclass it to write in a transaction of their own.
+
+            with storage.children_writer(db_name, path) as writer:
+                writer.write({"a": 1, "b": 2})
+    """
+
+    def __init__(self, db_name: str, path: str, op_type: str, storage):
+        if op_type not in ('put', 'patch'):
+            raise ValueError("Unsupported operation: %s" % op_type)
+        self.db_name = db_name
+        self.path = path or ''
+        self.op_type = op_type
+        self.storage = storage
+        self.children = 0
+
+    def apply(self, path: str, value: JSON_PRIMITIVES, op_type: str):
+        self.storage.set_at_path(self.db_name, path, value, op_type)
+
+    def clear_root(self):
+        for key in list((self.storage.get_from_path(self.db_name, None) or {}).keys()):
+            self.apply(key, None, 'delete')
+
+    def put_root_children(self, children: dict):
+        for key, value in children.items():
+            self.apply(key, value, 'put')
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def begin(self):
+        if self.op_type != 'put':
+            return
+        if self.path:
+            self.apply(self.path, {}, 'put')
+        else:
+            self.clear_root()
+
+    def write(self, children: dict):
+        if not children:
+            return
+        if not self.path:
+            self.put_root_children(children)
+        else:
+            self.apply(self.path, children, 'patch')
+        self.children += len(children)
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
 
 class BaseJsonChangeNotifier(object):
     """
@@ -56,6 +165,13 @@ class BaseJsonChangeNotifier(object):
     def listen(self):
         raise NotImplementedError()
 
+    def set_wakeup(self, wakeup):
+        """
+        :param wakeup: wakeup() is called from the thread receiving the changes whenever the
+            generator of listen() has more to yield, None stops the calls
+        """
+        raise NotImplementedError()
+
     def cleanup(self):
         raise NotImplementedError()
 
@@ -65,45 +181,131 @@ class BaseJsonStorage(object):
         Base class for all Json Storages
     """
     vendor = 'unknown'
+    # position token of the last write, see get_from_path(min_lsn=...)
+    last_write_lsn = None
+    # writes block until a commit shared with other callers, call them from worker threads
+    group_commit = False
 
     def __init__(self, storage_settings: dict):
         self.storage_settings = storage_settings
 
-    def get_from_path(self, db_name: str, path: str) -> JSON_PRIMITIVES:
+    def get_from_path(self, db_name: str, path: str, min_lsn: str = None,
+                      fields: List[str] = None) -> JSON_PRIMITIVES:
+        """
+        :param min_lsn: write position returned by a previous write,
+            storages with read replicas must serve a state at least this recent
+        :param fields: keep only these keys of each child of the value at path
+        """
+        raise NotImplementedError()
+
+    def get_page_from_path(self, db_name: str, path: str, limit: int, after: str = None,
+                           min_lsn: str = None, fields: List[str] = None) -> Tuple[dict, Optional[str]]:
+        """
+        a page of the children at path in key order
+        :param after: returned with the previous page, None for the first page
+        :param fields: as in get_from_path
+        :return: (page, after for the next page or None)
+        """
+        raise NotImplementedError()
+
+    def query_from_path(self, db_name: str, path: str, order_by: str, start_at: JSON_PRIMITIVES = None,
+                        end_at: JSON_PRIMITIVES = None, limit_to_first: int = None, limit_to_last: int = None,
+                        min_lsn: str = None, fields: List[str] = None) -> dict:
+        """
+        children at path ordered by the value at their child path order_by, in the
+        order of jsonb values, children without it first and ties in key order
+        :param start_at: only children whose value is at least start_at
+        :param end_at: only children whose value is at most end_at
+        :param limit_to_first: only the first n children
+        :param limit_to_last: only the last n children
+        :param fields: as in get_from_path
+        :return: the children, in order
+        """
         raise NotImplementedError()
 
     def set_at_path(self, db_name: str,
                     path: str,
                     value: JSON_PRIMITIVES,
-                    op_type: str = 'put'  # 'put', 'post', or 'patch'
+                    op_type: str = 'put',  # 'put', 'post', 'patch', 'replace', 'delete' or one of ATOMIC_OPS
+                    report_changed: bool = False,
+                    ttl: float = None
                     ) -> JSON_PRIMITIVES:
+        """
+        for ATOMIC_OPS value is the operand and the new value at path is returned,
+        'delete' ignores value and returns whether something was deleted,
+        'replace' returns the number of change events, see replace_at_path.
+        A 'put' or 'patch' leaving the stored value as it is writes and notifies nothing,
+        with report_changed it returns (value, whether the stored value changed).
+        With ttl, path is deleted ttl seconds later unless written with a ttl again,
+        a delete at or above path cancels it
+        """
         raise NotImplementedError()
 
     def put_at_path(self, db_name: str, path: str,
-                    value: JSON_PRIMITIVES,
+                    value: JSON_PRIMITIVES, report_changed: bool = False, ttl: float = None
                     ) -> JSON_PRIMITIVES:
-        return self.set_at_path(db_name, path, value, 'put')
+        return self.set_at_path(db_name, path, value, 'put', report_changed, ttl)
 
     def post_at_path(self, db_name: str, path: str,
-                     value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
+                     value: JSON_PRIMITIVES, ttl: float = None) -> JSON_PRIMITIVES:
         # attach push_id to path
         posted_data = {}
         push_id = post_push_id.next_id()
         new_path = "%s/%s" % (path, push_id)
-        posted_data[push_id] = self.set_at_path(db_name, new_path, value, 'post')
+        posted_data[push_id] = self.set_at_path(db_name, new_path, value, 'post', ttl=ttl)
         return posted_data
 
     def patch_at_path(self, db_name: str, path: str,
-                      value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
-        return self.set_at_path(db_name, path, value, 'patch')
+                      value: JSON_PRIMITIVES, report_changed: bool = False, ttl: float = None) -> JSON_PRIMITIVES:
+        return self.set_at_path(db_name, path, value, 'patch', report_changed, ttl)
+
+    def replace_at_path(self, db_name: str, path: str, value: JSON_PRIMITIVES) -> int:
+        """
+        same result as a put, but only the parts of the stored value that differ
+        are written and notified: a change event for each child of path that
+        changed or disappeared when the stored value is an object and the new one
+        a non empty object, else one for path. Replacing with an equal value writes nothing.
+        Path None or '' replaces the root, value must then be an object.
+        :return: number of change events
+        """
+        return self.set_at_path(db_name, path or '', value, 'replace')
+
+    def atomic_at_path(self, db_name: str, path: str, op_type: str,
+                       value: JSON_PRIMITIVES) -> JSON_PRIMITIVES:
+        if op_type not in ATOMIC_OPS:
+            raise ValueError("Unknown atomic operation: %s" % op_type)
+        if op_type in NUMERIC_ATOMIC_OPS and \
+                (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError("Operand of %s must be a number" % op_type)
+        return self.set_at_path(db_name, path, value, op_type)
 
     def delete_at_path(self, db_name: str, path: str) -> bool:
         raise NotImplementedError()
 
+    def sweep_expired(self) -> int:
+        """
+        deletes one batch of the paths whose ttl passed, storages also do it in the background
+        :return: number of paths deleted
+        """
+        raise NotImplementedError()
+
+    def children_writer(self, db_name: str, path: str, op_type: str = 'put') -> JsonChildrenWriter:
+        """
+        writes a large object at path in batches of its children, see JsonChildrenWriter.
+        storages that can should apply all batches in one transaction.
+        """
+        return JsonChildrenWriter(db_name, path, op_type, self)
+
     def optimize(self, db_name: str):
         raise NotImplementedError()
 
-    def create_db(self, db_name: str) -> BaseJsonDb:
+    def create_db(self, db_name: str, durability: str = DURABLE) -> BaseJsonDb:
+        """
+        :param durability: one of DURABILITY_LEVELS
+        """
+        raise NotImplementedError()
+
+    def set_durability(self, db_name: str, durability: str):
         raise NotImplementedError()
 
     def delete_db(self, db_name: str) -> bool:
@@ -115,12 +317,28 @@ class BaseJsonStorage(object):
     def get_notifier(self, db_name: str, path: str) -> BaseJsonChangeNotifier:
         raise NotImplementedError()
 
-    def get_all_dbs(self) -> List[str]:
+    def get_all_dbs(self, min_lsn: str = None) -> List[str]:
+        raise NotImplementedError()
+
+    def get_db_stats(self) -> Dict[str, dict]:
+        """
+        counters kept up to date by the writes, reading them scans no data
+        :return: {db_name: {"rows": rows of the db, "bytes": size of its data or None,
+            "writes": writes that changed something, "writes_per_minute": writes of the last complete minute}}
+        """
         raise NotImplementedError()
 
     def create_index(self, db_name, path):
         raise NotImplementedError()
 
+    def advise_indexes(self, db_name: str, apply: bool = False) -> dict:
+        """
+        indexes recommended by the queries of db_name served so far, and those unused
+        since the previous advice
+        :param apply: create the recommended indexes and drop the unused ones
+        """
+        raise NotImplementedError()
+
     def close(self):
         raise NotImplementedError()
 
@@ -0,0 +1,488 @@
+import copy
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from ..base import *
+from ..utils import WakeupQueue, queue_to_generator, path_filter, jsonb_key, jsonb_sort_key
+
+DEFAULT_SNAPSHOT_INTERVAL = 5.0
+DEFAULT_TTL_SWEEP_INTERVAL = 1.0
+DEFAULT_TTL_SWEEP_BATCH = 500
+
+
+def _split_path(path: str) -> List[str]:
+    if not path:
+        raise ValueError("Invalid path")
+    return path.split('/')
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _atomic_apply(cur, op: str, operand):
+    """
+    same results as jsonb_atomic_apply of the postgres storage
+    """
+    if op == 'increment':
+        return cur + operand if _is_number(cur) else operand
+    elif op == 'max':
+        return cur if _is_number(cur) and cur >= operand else operand
+    elif op == 'min':
+        return cur if _is_number(cur) and cur <= operand else operand
+    elif op == 'append':
+        return cur + [operand] if isinstance(cur, list) else [operand]
+    elif op == 'remove_from_array':
+        return [e for e in cur if not _same(e, operand)] if isinstance(cur, list) else cur
+    raise ValueError("Unknown atomic operation: %s" % op)
+
+
+def _same(a, b) -> bool:
+    # True == 1 in python, not in jsonb where 1 == 1.0
+    return jsonb_key(a) == jsonb_key(b)
+
+
+def _pick(value, fields):
+    if fields is None or not isinstance(value, dict):
+        return value
+    return dict((k, v) for k, v in value.items() if k in fields)
+
+
+def _project(value, fields):
+    if fields is None or not isinstance(value, dict):
+        return value
+    return dict((k, _pick(v, fields)) for k, v in value.items())
+
+
+class MemoryJsonStorage(BaseJsonStorage):
+    """
+        Keeps every json db as a tree of dicts in the process, each path
+        segment is one level of the tree. Runs without a database for tests
+        and local benchmarks, and gives the baseline to compare the
+        overhead of the postgres storage with.
+        With "snapshot_file" in the settings the dbs are loaded from the
+        file on start, and written back every "snapshot_interval" seconds
+        after a change and on close.
+        Deadlines of paths written with a ttl are not part of the snapshot.
+    """
+    vendor = "memory"
+
+    def __init__(self, storage_settings: dict):
+        super().__init__(storage_settings)
+        self.closed = False
+        self.lock = threading.RLock()
+        self.dbs = {}
+        self.listeners = {}
+        self.json_db_instance_cache = {}
+        self.snapshot_file = storage_settings.get("snapshot_file")
+        self.dirty = False
+        self.snapshot_thread = None
+        self.__stop_snapshots = threading.Event()
+        # (db_name, path) -> deadline on the monotonic clock
+        self.expiries = {}
+        # db_name -> [writes, minute, writes in minute, writes in the minute before]
+        self.write_counts = {}
+        self.notified = 0
+        self.ttl_sweep_batch = storage_settings.get("ttl_sweep_batch", DEFAULT_TTL_SWEEP_BATCH)
+        self.__stop_sweeps = threading.Event()
+        self.sweep_thread = threading.Thread(
+            target=self.__sweep_loop,
+            args=(storage_settings.get("ttl_sweep_interval", DEFAULT_TTL_SWEEP_INTERVAL),),
+            daemon=True
+        )
+        self.sweep_thread.start()
+        if self.snapshot_file:
+            self.__load_snapshot()
+            self.snapshot_thread = threading.Thread(
+                target=self.__snapshot_loop,
+                args=(storage_settings.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL),),
+                daemon=True
+            )
+            self.snapshot_thread.start()
+
+    def __check_closed(self):
+        if self.closed:
+            raise ValueError('Storage already closed')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __data(self, db_name: str) -> dict:
+        if db_name not in self.dbs:
+            raise ValueError("No such db: %s" % db_name)
+        return self.dbs[db_name]
+
+    def __node(self, db_name: str, path: str):
+        node = self.__data(db_name)
+        if not path:
+            return node
+        for key in path.split('/'):
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return node
+
+    def get_from_path(self, db_name: str, path: str, min_lsn: str = None,
+                      fields: List[str] = None) -> JSON_PRIMITIVES:
+        self.__check_closed()
+        with self.lock:
+            return copy.deepcopy(_project(self.__node(db_name, path), fields))
+
+    def get_page_from_path(self, db_name: str, path: str, limit: int, after: str = None,
+                           min_lsn: str = None, fields: List[str] = None) -> Tuple[dict, Optional[str]]:
+        self.__check_closed()
+        if limit < 1:
+            raise ValueError("Invalid limit")
+        with self.lock:
+            node = self.__node(db_name, path)
+            if not isinstance(node, dict):
+                return {}, None
+            # code point order of str is the byte order of utf-8, as COLLATE "C"
+            keys = sorted(k for k in node if after is None or k > after)
+            page = dict((k, copy.deepcopy(_pick(node[k], fields))) for k in keys[:limit])
+        return page, keys[limit - 1] if len(keys) > limit else None
+
+    def query_from_path(self, db_name: str, path: str, order_by: str, start_at: JSON_PRIMITIVES = None,
+                        end_at: JSON_PRIMITIVES = None, limit_to_first: int = None, limit_to_last: int = None,
+                        min_lsn: str = None, fields: List[str] = None) -> dict:
+        self.__check_closed()
+        if (limit_to_first is not None and limit_to_first < 1) or (limit_to_last is not None and limit_to_last < 1):
+            raise ValueError("Invalid limit")
+        order_path = order_by.split('/')
+        with self.lock:
+            node = self.__node(db_name, path)
+            if not isinstance(node, dict):
+                return {}
+            children = sorted(((jsonb_sort_key(v, order_path), k) for k, v in node.items()))
+            if start_at is not None:
+                children = [c for c in children if c[0] != (0,) and c[0] >= jsonb_key(start_at)]
+            if end_at is not None:
+                children = [c for c in children if c[0] != (0,) and c[0] <= jsonb_key(end_at)]
+            if limit_to_last is not None:
+                children = children[-limit_to_last:]
+            elif limit_to_first is not None:
+                children = children[:limit_to_first]
+            return dict((k, copy.deepcopy(_pick(node[k], fields))) for _, k in children)
+
+    def set_at_path(self, db_name: str, path: str, value: JSON_PRIMITIVES,
+                    op_type: str = 'put', report_changed: bool = False, ttl: float = None) -> JSON_PRIMITIVES:
+        self.__check_closed()
+        if ttl is not None and (not path or op_type == 'delete' or ttl <= 0):
+            raise ValueError("A ttl needs a path to write and a positive number of seconds")
+        with self.lock:
+            notified = self.notified
+            result = self.__write(db_name, path, value, op_type, report_changed)
+            if self.notified != notified:
+                self.__count_write(db_name)
+            # a write replaces the deadlines of what it overwrites, a patch keeps those of the children it leaves alone
+            self.__clear_expiry(db_name, path or '',
+                                list(value) if op_type == 'patch' and isinstance(value, dict) else None)
+            if ttl is not None:
+                self.expiries[(db_name, path)] = time.monotonic() + ttl
+            return result
+
+    def __count_write(self, db_name: str):
+        minute = int(time.time() // 60)
+        counts = self.write_counts.setdefault(db_name, [0, minute, 0, 0])
+        if counts[1] != minute:
+            counts[3] = counts[2] if counts[1] == minute - 1 else 0
+            counts[1], counts[2] = minute, 0
+        counts[0] += 1
+        counts[2] += 1
+
+    def __clear_expiry(self, db_name: str, path: str, children: list = None):
+        if children is None:
+            subtrees, exact = [path], None
+        else:
+            subtrees, exact = ['%s/%s' % (path, key) if path else key for key in children], path
+        for key in [key for key in self.expiries
+                    if key[0] == db_name and (key[1] == exact or any(
+                        not subtree or key[1] == subtree or key[1].startswith(subtree + '/') for subtree in subtrees))]:
+            del self.expiries[key]
+
+    def sweep_expired(self) -> int:
+        self.__check_closed()
+        now = time.monotonic()
+        with self.lock:
+            due = sorted((deadline, key) for key, deadline in self.expiries.items() if deadline <= now)
+            for _, (db_name, path) in due[:self.ttl_sweep_batch]:
+                if db_name in self.dbs:
+                    self.set_at_path(db_name, path, None, 'delete')
+                else:
+                    self.expiries.pop((db_name, path), None)
+            return len(due[:self.ttl_sweep_batch])
+
+    def __sweep_loop(self, interval: float):
+        while not self.__stop_sweeps.wait(interval):
+            while self.expiries and self.sweep_expired() == self.ttl_sweep_batch:
+                pass
+
+    def __write(self, db_name: str, path: str, value: JSON_PRIMITIVES,
+                op_type: str, report_changed: bool) -> JSON_PRIMITIVES:
+        if op_type == 'replace':
+            with self.lock:
+                result = self.__replace(db_name, path, value)
+                self.dirty = True
+                return result
+        keys = _split_path(path)
+        with self.lock:
+            data = self.__data(db_name)
+            if op_type == 'delete':
+                result = self.__delete(data, keys)
+                if result:
+                    self.__notify(db_name, {"event": "delete", "path": path, "data": None})
+            elif op_type in ATOMIC_OPS:
+                parent = self.__parent(data, keys)
+                result = _atomic_apply(parent.get(keys[-1]), op_type, value)
+                parent[keys[-1]] = result
+                self.__notify(db_name, {"event": "put", "op": op_type, "path": path, "data": result})
+            else:
+                old = self.__node(db_name, path)
+                merge = op_type == 'patch' and isinstance(old, dict) and isinstance(value, dict)
+                # like the postgres storage, a value equal to the stored one is neither written nor notified
+                changed = old is None or not _same(old, dict(old, **value) if merge else value)
+                if changed:
+                    parent = self.__parent(data, keys)
+                    value = copy.deepcopy(value)
+                    if merge:
+                        parent[keys[-1]].update(value)
+                    else:
+                        parent[keys[-1]] = value
+                    self.__notify(db_name, {"event": 'patch' if op_type == 'patch' else 'put',
+                                            "path": path, "data": value})
+                    self.dirty = True
+                result = copy.deepcopy(value)
+                return (result, changed) if report_changed else result
+            self.dirty = True
+            return copy.deepcopy(result)
+
+    def __replace(self, db_name: str, path: str, value: JSON_PRIMITIVES) -> int:
+        """
+        same change events as the replace statements of the postgres storage
+        """
+        data = self.__data(db_name)
+        if not path:
+            if not isinstance(value, dict):
+                raise ValueError("The root can only be replaced by an object")
+            old, prefix = data, ''
+        else:
+            old, prefix = self.__node(db_name, path), path + '/'
+        if _same(old, value):
+            return 0
+        if not path or isinstance(old, dict) and isinstance(value, dict) and value:
+            events = [{"event": "delete", "path": prefix + key, "data": None} for key in old if key not in value]
+            events = [{"event": "put", "path": prefix + key, "data": v}
+                      for key, v in value.items() if key not in old or not _same(old[key], v)] + events
+        else:
+            events = [{"event": "put", "path": path, "data": value}]
+        if not path:
+            self.dbs[db_name] = copy.deepcopy(value)
+        else:
+            keys = _split_path(path)
+            self.__parent(data, keys)[keys[-1]] = copy.deepcopy(value)
+        for event in events:
+            self.__notify(db_name, event)
+        return len(events)
+
+    @staticmethod
+    def __parent(data: dict, keys: List[str]) -> dict:
+        """
+        objects missing on the path are created and non objects on the path are replaced
+        """
+        node = data
+        for key in keys[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        return node
+
+    @staticmethod
+    def __delete(data: dict, keys: List[str]) -> bool:
+        nodes = [data]
+        for key in keys[:-1]:
+            node = nodes[-1].get(key)
+            if not isinstance(node, dict):
+                return False
+            nodes.append(node)
+        if keys[-1] not in nodes[-1]:
+            return False
+        del nodes[-1][keys[-1]]
+        # objects left empty by the delete are removed as well
+        for i in range(len(nodes) - 1, 0, -1):
+            if nodes[i]:
+                break
+            del nodes[i - 1][keys[i - 1]]
+        return True
+
+    def delete_at_path(self, db_name: str, path: str) -> bool:
+        return self.set_at_path(db_name, path, None, 'delete')
+
+    def create_db(self, db_name: str, durability: str = DURABLE) -> BaseJsonDb:
+        """
+        durability is accepted for compatibility, the dbs live as long as the process or its snapshot
+        """
+        self.__check_closed()
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError("Unknown durability: %s" % durability)
+        with self.lock:
+            self.dbs.setdefault(db_name, {})
+            self.dirty = True
+            db = BaseJsonDb(db_name, self)
+            self.json_db_instance_cache[db_name] = db
+            return db
+
+    def set_durability(self, db_name: str, durability: str):
+        self.__check_closed()
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError("Unknown durability: %s" % durability)
+        if db_name not in self.dbs:
+            raise ValueError("Json db does not exist: %s" % db_name)
+
+    def delete_db(self, db_name: str) -> bool:
+        self.__check_closed()
+        with self.lock:
+            self.dbs.pop(db_name, None)
+            self.json_db_instance_cache.pop(db_name, None)
+            self.expiries = dict((key, deadline) for key, deadline in self.expiries.items() if key[0] != db_name)
+            self.write_counts.pop(db_name, None)
+            self.dirty = True
+            return True
+
+    def get_db(self, db_name: str) -> BaseJsonDb:
+        self.__check_closed()
+        with self.lock:
+            if db_name in self.json_db_instance_cache:
+                return self.json_db_instance_cache[db_name]
+            elif db_name in self.dbs:
+                db = BaseJsonDb(db_name, self)
+                self.json_db_instance_cache[db_name] = db
+                return db
+
+    def get_all_dbs(self, min_lsn: str = None) -> List[str]:
+        self.__check_closed()
+        with self.lock:
+            return list(self.dbs)
+
+    def get_db_stats(self) -> Dict[str, dict]:
+        """
+        rows are the children of the root, the size of the data is not tracked
+        """
+        self.__check_closed()
+        minute = int(time.time() // 60)
+        stats = {}
+        with self.lock:
+            for db_name, data in self.dbs.items():
+                writes, last, minute_writes, last_minute_writes = self.write_counts.get(db_name, (0, None, 0, 0))
+                # writes of the last complete minute
+                rate = last_minute_writes if last == minute else minute_writes if last == minute - 1 else 0
+                stats[db_name] = {"rows": len(data), "bytes": None, "writes": writes, "writes_per_minute": rate}
+        return stats
+
+    def get_notifier(self, db_name: str, path: str) -> BaseJsonChangeNotifier:
+        return MemoryJsonChangeNotifier(db_name, path, self)
+
+    def __notify(self, db_name: str, payload: dict):
+        self.notified += 1
+        for message_queue in self.listeners.get(db_name, ()):
+            message_queue.put(copy.deepcopy(payload))
+
+    def add_listener(self, db_name: str, message_queue: queue.Queue):
+        with self.lock:
+            self.listeners.setdefault(db_name, []).append(message_queue)
+
+    def remove_listener(self, db_name: str, message_queue: queue.Queue):
+        with self.lock:
+            if message_queue in self.listeners.get(db_name, ()):
+                self.listeners[db_name].remove(message_queue)
+
+    def create_index(self, db_name, path):
+        pass
+
+    def optimize(self, db_name: str):
+        pass
+
+    def snapshot(self):
+        """
+        writes all dbs to the snapshot file, the previous snapshot is replaced only once the new one is complete
+        """
+        with self.lock:
+            contents = json.dumps(self.dbs).encode('utf-8')
+            self.dirty = False
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, "w+b") as f:
+            f.truncate(len(contents))
+            with mmap.mmap(f.fileno(), len(contents)) as mm:
+                mm[:] = contents
+                mm.flush()
+        os.replace(tmp_file, self.snapshot_file)
+
+    def __load_snapshot(self):
+        if not os.path.exists(self.snapshot_file) or os.path.getsize(self.snapshot_file) == 0:
+            return
+        with open(self.snapshot_file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.dbs = json.loads(mm[:].decode('utf-8'))
+
+    def __snapshot_loop(self, interval: float):
+        while not self.__stop_snapshots.wait(interval):
+            if self.dirty:
+                self.snapshot()
+
+    def close(self):
+        if self.closed:
+            return
+        with self.lock:
+            for message_queues in self.listeners.values():
+                for message_queue in message_queues:
+                    message_queue.put(None)
+            self.listeners = {}
+        self.__stop_sweeps.set()
+        self.sweep_thread.join()
+        if self.snapshot_thread is not None:
+            self.__stop_snapshots.set()
+            self.snapshot_thread.join()
+            self.snapshot()
+        self.closed = True
+
+
+class MemoryJsonChangeNotifier(BaseJsonChangeNotifier):
+    def __init__(self, db_name: str, path: str, storage: MemoryJsonStorage):
+        super().__init__(db_name, path)
+        self.storage = storage
+        self.message_queue = WakeupQueue()
+        self.listening = False
+
+    def listen(self):
+        if not self.listening:
+            self.storage.add_listener(self.db, self.message_queue)
+            self.listening = True
+        return path_filter(self.path, queue_to_generator(self.message_queue))
+
+    def set_wakeup(self, wakeup):
+        self.message_queue.wakeup = wakeup
+
+    def cleanup(self):
+        if self.listening:
+            self.storage.remove_listener(self.db, self.message_queue)
+            self.listening = False
+            self.message_queue.put(None)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
+
+    def __enter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
@@ -1,20 +1,26 @@
 import json
 import os
-import queue
+import threading
+from contextlib import contextmanager
 
 import psycopg2
 import sqlalchemy
 from sqlalchemy import exists
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm.session import Session
-from sqlalchemy.schema import DDL
 
+from .db_stats import *
+from .expiry import *
+from .group_commit import *
+from .index_advisor import *
+from .layouts import *
+from .meta_cache import *
 from .models import *
+from .replicas import *
+from .schema import *
+from .statements import subtree_channel
 from ..base import *
-from ..utils import read_file
-
-UPSERT_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), 'upsert_json_data_notify.sql')
-PATCH_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "patch_json_data_notify.sql")
-JSONB_DEEP_SET_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "jsonb_set_deep.sql")
+from ..utils import WakeupQueue, queue_to_generator, path_filter
 
 
 def _build_path_query(path):
@@ -33,6 +39,34 @@ def _build_path_query(path):
         return sp[0], tuple(sp), '{' + ','.join(sp) + '}'
 
 
+def _connection_string(settings):
+    return 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(settings.get("username"),
+                                                        settings.get("password"),
+                                                        settings.get("host"),
+                                                        settings.get("port"),
+                                                        settings.get("db"))
+
+
+def _pick(value, fields):
+    """
+    keeps only fields of the json object value, in the query
+    """
+    if fields is None:
+        return value
+    return sqlalchemy.func.jsonb_pick(value, sqlalchemy.literal(list(fields), ARRAY(sqlalchemy.Text)),
+                                      type_=JSONB)
+
+
+def _project(value, fields):
+    """
+    keeps only fields of each child of the json object value, in the query
+    """
+    if fields is None:
+        return value
+    return sqlalchemy.func.jsonb_project(value, sqlalchemy.literal(list(fields), ARRAY(sqlalchemy.Text)),
+                                         type_=JSONB)
+
+
 def _construct_data(path, value):
     d = {}
     if len(path) == 1:
@@ -52,8 +86,24 @@ class PostgresJsonStorage(BaseJsonStorage):
         super().__init__(storage_settings)
         self.closed = False
         self.json_db_instance_cache = {}
+        # held while the meta cache forgets a db deleted by another process, from its listener thread
+        self.db_lock = threading.Lock()
+        # LSN of the last write committed by this storage, clients can
+        # pass it back with reads to get read-your-writes from replicas
+        self.last_write_lsn = None
         self.__db_init()
+        self.__replicas_init()
+        self.db_meta = DbMetaCache(self.__new_pg_connection(), on_delete=self.__forget_db)
+        self.db_meta.start()
+        self.__stats_init()
+        self.__group_commit_init()
+        self.__expiry_init()
         self.notifiers = []
+        self.access_stats = AccessStats(storage_settings.get("access_stats_max_entries", DEFAULT_MAX_STATS_ENTRIES))
+        self.index_advisor = IndexAdvisor(
+            self, self.access_stats,
+            storage_settings.get("index_advisor_min_queries", DEFAULT_ADVISOR_MIN_QUERIES)
+        )
 
     def __check_closed(self):
         if self.closed:
@@ -62,45 +112,127 @@ class PostgresJsonStorage(BaseJsonStorage):
     def __db_init(self):
         from sqlalchemy import create_engine
         from sqlalchemy.orm import sessionmaker
-        settings = self.storage_settings
-        db_name = settings.get("db")
-        db_host = settings.get("host")
-        port = settings.get("port")
-        user = settings.get("username")
-        password = settings.get("password")
-
-        connection_string = 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(user,
-                                                                          password,
-                                                                          db_host,
-                                                                          port,
-                                                                          db_name)
-
-        engine = create_engine(connection_string)
+        engine = create_engine(_connection_string(self.storage_settings))
         self.engine = engine
         session_maker = sessionmaker()
         session_maker.configure(bind=engine)
 
-        sqlalchemy.event.listen(
-            Base.metadata,
-            'after_create',
-            DDL(read_file(JSONB_DEEP_SET_FUNCTION_FILE))
+        # an up to date schema is detected with one query, DDL is skipped
+        installed = installed_schema(engine)
+        # dbs written before their stats were kept are counted once, see __stats_init
+        self.__stats_outdated = installed.get(CORE_SCHEMA, DB_STATS_SCHEMA_VERSION) < DB_STATS_SCHEMA_VERSION
+        # a newer schema installed by a later release is left to it, see install_schema
+        if installed.get(CORE_SCHEMA, 0) < SCHEMA_VERSION:
+            install_schema(engine, CORE_SCHEMA, SCHEMA_VERSION, install_core_schema)
+
+        self.session_maker = session_maker
+        self.session = session_maker()  # type: Session
+        self.layout = get_layout(self.storage_settings, self.__db_id)
+        component = self.layout.schema_component
+        if component and installed.get(component, 0) < self.layout.schema_version:
+            install_schema(engine, component, self.layout.schema_version, self.layout.install)
+
+    def __replicas_init(self):
+        """
+        replicas are configured in the db settings as a list of endpoints,
+        missing connection settings are taken from the primary.
+            "replicas": [{"host": "replica1", "port": 5432}],
+            "max_replica_lag_bytes": 16777216,
+            "replica_check_interval": 1.0
+        """
+        from sqlalchemy import create_engine
+        settings = self.storage_settings
+        replicas = []
+        for replica_settings in settings.get("replicas") or []:
+            replica_settings = dict(settings, **replica_settings)
+            replicas.append(Replica(
+                "%s:%s" % (replica_settings.get("host"), replica_settings.get("port")),
+                create_engine(_connection_string(replica_settings))
+            ))
+        self.replicas = ReplicaSet(
+            self.engine,
+            replicas,
+            max_lag_bytes=settings.get("max_replica_lag_bytes", DEFAULT_MAX_REPLICA_LAG_BYTES),
+            check_interval=settings.get("replica_check_interval", DEFAULT_REPLICA_CHECK_INTERVAL)
         )
 
-        sqlalchemy.event.listen(
-            Base.metadata,
-            'after_create',
-            DDL(read_file(UPSERT_FUNCTION_FILE))
+    def __stats_init(self):
+        """
+        row count, size and writes of each db, maintained by the writes
+            "stats_flush_interval": 1.0
+        """
+        self.db_stats = DbStats(
+            self.engine,
+            self.session_maker,
+            interval=self.storage_settings.get("stats_flush_interval", DEFAULT_STATS_FLUSH_INTERVAL)
         )
+        if self.__stats_outdated:
+            self.recount_stats()
 
-        sqlalchemy.event.listen(
-            Base.metadata,
-            'after_create',
-            DDL(read_file(PATCH_FUNCTION_FILE))
+    def __group_commit_init(self):
+        """
+        opt-in, writes of concurrent callers are committed together
+            "group_commit": true,
+            "group_commit_window_ms": 2,
+            "group_commit_max_batch": 256
+        """
+        settings = self.storage_settings
+        self.write_pipeline = None
+        if settings.get("group_commit"):
+            self.write_pipeline = GroupCommitWriter(
+                self.session_maker(),
+                self.__execute_write,
+                on_commit=self.__record_write_lsn,
+                before_commit=lambda session, batch: self.__relax_commit(session, [args[0] for args in batch]),
+                window_ms=settings.get("group_commit_window_ms", DEFAULT_GROUP_COMMIT_WINDOW_MS),
+                max_batch=settings.get("group_commit_max_batch", DEFAULT_GROUP_COMMIT_MAX_BATCH)
+            )
+
+    def __expiry_init(self):
+        """
+        paths written with a ttl are deleted in the background
+            "ttl_sweep_interval": 1.0,
+            "ttl_sweep_batch": 500
+        """
+        settings = self.storage_settings
+        self.expiry_sweeper = ExpirySweeper(
+            self.session_maker(),
+            lambda session, db_name, path: self.__execute_write(session, db_name, path, None, 'delete'),
+            on_commit=self.__record_write_lsn,
+            interval=settings.get("ttl_sweep_interval", DEFAULT_TTL_SWEEP_INTERVAL),
+            batch=settings.get("ttl_sweep_batch", DEFAULT_TTL_SWEEP_BATCH)
         )
 
-        Base.metadata.create_all(engine)
+    @property
+    def group_commit(self) -> bool:
+        return self.write_pipeline is not None
 
-        self.session = session_maker()  # type: Session
+    def __record_write_lsn(self):
+        if self.replicas:
+            self.last_write_lsn = self.engine.scalar(PRIMARY_LSN_QUERY)
+
+    @contextmanager
+    def __read_session(self, min_lsn: str = None):
+        """
+        session to read from, a replica if one is healthy and has replayed
+        min_lsn, otherwise the primary
+        """
+        replica = self.replicas.choose(min_lsn)
+        if replica is None:
+            try:
+                yield self.session
+            finally:
+                # an open snapshot holds back vacuum and waits out concurrent index builds
+                self.session.rollback()
+            return
+        try:
+            yield replica.session
+        except sqlalchemy.exc.DBAPIError:
+            self.replicas.mark_failed(replica)
+            raise
+        finally:
+            # do not hold a snapshot open on the standby between reads
+            replica.session.rollback()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
@@ -110,93 +242,375 @@ class PostgresJsonStorage(BaseJsonStorage):
 
     def set_at_path(self, db_name: str,
                     path: str,
-                    value: JSON_PRIMITIVES, op_type: str = 'put') -> JSON_PRIMITIVES:
+                    value: JSON_PRIMITIVES, op_type: str = 'put', report_changed: bool = False,
+                    ttl: float = None) -> JSON_PRIMITIVES:
         self.__check_closed()
+        if ttl is not None and (not path or op_type == 'delete' or ttl <= 0):
+            raise ValueError("A ttl needs a path to write and a positive number of seconds")
+        if self.write_pipeline is not None:
+            return self.write_pipeline.submit(db_name, path, value, op_type, report_changed, ttl).result()
+
         session = self.session
-        l1_key, path_query, write_path = _build_path_query(path)
+        try:
+            value = self.__execute_write(session, db_name, path, value, op_type, report_changed, ttl)
+            self.__relax_commit(session, [db_name])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.__record_write_lsn()
+        return value
 
-        if op_type == 'patch':
-            func_call = sqlalchemy.func.patch_json_data_notify(
-                db_name,
-                l1_key,
-                json.dumps(_construct_data(path.split('/'), value)),
-                write_path,
-                json.dumps(value)
-            )
-        else:
-            func_call = sqlalchemy.func.upsert_json_data_notify(
-                db_name,
-                l1_key,
-                json.dumps(_construct_data(path.split('/'), value)),
-                write_path,
-                json.dumps(value)
-            )
+    def __execute_write(self, session: Session, db_name: str, path: str,
+                        value: JSON_PRIMITIVES, op_type: str, report_changed: bool = False,
+                        ttl: float = None) -> JSON_PRIMITIVES:
+        result, rows = self.__execute_statement(session, db_name, path, value, op_type, report_changed)
+        self.__clear_expiry(session, db_name, path, value, op_type)
+        if ttl is not None:
+            set_expiry(session, self.__db_id(db_name), path, ttl)
+        # counted once the transaction commits
+        DbStats.record(session, db_name, rows)
+        return result
+
+    def __clear_expiry(self, session: Session, db_name: str, path: str, value: JSON_PRIMITIVES, op_type: str):
+        """
+        the deadlines of what a write replaces, a patch keeps those of the children it leaves alone
+        """
+        children = list(value) if op_type == 'patch' and isinstance(value, dict) else None
+        clear_expiry(session, self.__db_id(db_name), path, children)
 
-        session.execute(func_call)
-        session.commit()
-        return value
+    def __execute_statement(self, session: Session, db_name: str, path: str,
+                            value: JSON_PRIMITIVES, op_type: str, report_changed: bool) -> tuple:
+        """
+        :return: (result of the write, rows of its statement)
+        """
+        statements = self.layout.statements(db_name)
+        db_args = self.layout.statement_args(db_name)
+        self.layout.fence(db_name, session)
+        conn = session.connection()
+        if op_type == 'replace' and not path:
+            if not isinstance(value, dict):
+                raise ValueError("The root can only be replaced by an object")
+            rows = statements.execute(conn, 'replace_root', json.dumps(value), *db_args)
+            return len(rows), rows
+        if not path:
+            raise ValueError("Invalid path")
+        l1_key, path_query, write_path = _build_path_query(path)
+
+        if op_type == 'replace':
+            rows = statements.execute(conn, 'replace', l1_key,
+                                      json.dumps(_construct_data(path.split('/'), value)),
+                                      write_path, json.dumps(value), *db_args)
+            return len(rows), rows
+        elif op_type == 'delete':
+            rows = statements.execute(conn, 'delete', l1_key, write_path, *db_args)
+            return len(rows) > 0, rows
+        elif op_type in ATOMIC_OPS:
+            rows = statements.execute(conn, 'atomic', l1_key, write_path, op_type, json.dumps(value), *db_args)
+            return rows[0][0], rows
+
+        # no row when the stored value was left as it is
+        rows = statements.execute(
+            conn,
+            'patch' if op_type == 'patch' else 'put',
+            l1_key,
+            json.dumps(_construct_data(path.split('/'), value)),
+            write_path,
+            json.dumps(value),
+            *db_args
+        )
+        changed = len(rows) > 0
+        return ((value, changed) if report_changed else value), rows
 
     def __check_db_exists(self, db_name: str) -> bool:
         return self.session.query(exists().where(StorageMeta.db_name == db_name)).scalar()
 
+    def __db_exists(self, db_name: str) -> bool:
+        if self.db_meta.synced:
+            return db_name in self.db_meta
+        return self.__check_db_exists(db_name)
+
+    def hosts_db(self, db_name: str, fresh: bool = False) -> bool:
+        """
+        :param fresh: read storage_meta instead of the cache
+        :return: whether db_name exists here and is not being moved in from another shard
+        """
+        if self.db_meta.synced and not fresh:
+            return db_name in self.db_meta and not self.db_meta.is_incoming(db_name)
+        try:
+            incoming = self.session.query(StorageMeta.incoming).filter(StorageMeta.db_name == db_name).scalar()
+        finally:
+            self.session.rollback()
+        return incoming is False
+
+    def __durability(self, db_name: str) -> str:
+        if self.db_meta.synced:
+            return self.db_meta.durability_of(db_name)
+        durability = self.session.query(StorageMeta.durability).filter(StorageMeta.db_name == db_name).scalar()
+        return durability or DURABLE
+
+    def __relax_commit(self, session: Session, db_names: List[str]):
+        """
+        a transaction writing only to dbs that are not DURABLE commits without waiting for its WAL flush
+        """
+        if all(self.__durability(db_name) != DURABLE for db_name in db_names):
+            session.execute("SET LOCAL synchronous_commit TO OFF")
+
+    def set_durability(self, db_name: str, durability: str):
+        """
+        changing to or from UNLOGGED rewrites the table of the db
+        """
+        self.__check_closed()
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError("Unknown durability: %s" % durability)
+        self.layout.set_durability(db_name, durability, self.__durability(db_name), self.session)
+        self.db_meta.durability_changed(db_name, durability)
+
+    def __db_id(self, db_name: str) -> int:
+        db_id = self.db_meta.id_of(db_name) if self.db_meta.synced else None
+        if db_id is None:
+            db_id = self.session.query(StorageMeta.id).filter(StorageMeta.db_name == db_name).scalar()
+        if db_id is None:
+            raise ValueError("Json db does not exist: %s" % db_name)
+        return db_id
+
+    def __forget_db(self, db_name: str):
+        with self.db_lock:
+            self.json_db_instance_cache.pop(db_name, None)
+            self.db_stats.forget(db_name)
+            self.layout.forget(db_name)
+            forget_json_db_cls(db_name)
+
     def get_db(self, db_name: str) -> BaseJsonDb:
         self.__check_closed()
-        if db_name in self.json_db_instance_cache:
-            return self.json_db_instance_cache[db_name]
-        elif self.__check_db_exists(db_name):
-            db = BaseJsonDb(db_name, self)
-            self.json_db_instance_cache[db_name] = db
+        db = self.json_db_instance_cache.get(db_name)
+        if db is not None:
             return db
+        elif self.__db_exists(db_name):
+            with self.db_lock:
+                return self.json_db_instance_cache.setdefault(db_name, BaseJsonDb(db_name, self))
 
-    def get_from_path(self, db_name: str, path: str) -> JSON_PRIMITIVES:
+    def get_from_path(self, db_name: str, path: str, min_lsn: str = None,
+                      fields: List[str] = None) -> JSON_PRIMITIVES:
         """
         1. get the app class from models
         2. extract base_key or l1_key from path and create path query
         :param db_name:
         :param path:
+        :param min_lsn: LSN of a write this read must observe
+        :param fields: sub-keys of each child to return, projected in postgres
         :return:
         """
         self.__check_closed()
-        session = self.session
-        cls = get_json_db_cls(db_name)
+        cls = self.layout.table(db_name)
 
-        if not path:
-            # return all data
-            return self.__get_all_data(cls)
+        with self.__read_session(min_lsn) as session:
+            if not path:
+                # return all data
+                return self.__get_all_data(session, db_name, cls, fields)
 
-        l1_key, path_query, _ = _build_path_query(path)
-        if not path_query:
-            raise ValueError("Invalid path")
+            l1_key, path_query, _ = _build_path_query(path)
+            if not path_query:
+                raise ValueError("Invalid path")
 
-        return session.query(cls.data[path_query]).filter(cls.l1_key == l1_key).scalar()
+            query = self.layout.scope(session.query(_project(cls.data[path_query], fields)), db_name)
+            return query.filter(cls.l1_key == l1_key).scalar()
 
-    def __get_all_data(self, cls):
+    def __get_all_data(self, session, db_name, cls, fields=None):
         all_data = {}
-        for row in self.session.query(cls.data).all():
+        # a row holds {l1_key: value}, the children of the root
+        for row in self.layout.scope(session.query(_project(cls.data, fields)), db_name).all():
             all_data.update(row[0])
         return all_data
 
+    def get_page_from_path(self, db_name: str, path: str, limit: int, after: str = None,
+                           min_lsn: str = None, fields: List[str] = None) -> Tuple[dict, Optional[str]]:
+        """
+        children of the object at path in key order, evaluated in postgres.
+        keys are compared bytewise, so push ids page in the order they were posted.
+        :param limit: children in the page
+        :param after: key to continue after, the continuation of the previous page
+        :param fields: sub-keys of each child to return
+        :return: (page, key to continue after or None on the last page)
+        """
+        self.__check_closed()
+        if limit < 1:
+            raise ValueError("Invalid limit")
+        cls = self.layout.table(db_name)
+
+        with self.__read_session(min_lsn) as session:
+            if not path:
+                # children of the root are the l1_key rows
+                key = cls.l1_key.collate("C")
+                query = session.query(cls.l1_key, _pick(cls.data[cls.l1_key], fields))
+            else:
+                l1_key, path_query, _ = _build_path_query(path)
+                node = cls.data[path_query]
+                children = sqlalchemy.func.jsonb_each(
+                    sqlalchemy.case([(sqlalchemy.func.jsonb_typeof(node) == 'object', node)])
+                ).alias('child')
+                key = sqlalchemy.literal_column('child.key').collate("C")
+                query = session.query(sqlalchemy.literal_column('child.key'),
+                                      _pick(sqlalchemy.literal_column('child.value'), fields)) \
+                    .select_from(cls, children) \
+                    .filter(cls.l1_key == l1_key)
+
+            query = self.layout.scope(query, db_name)
+            if after is not None:
+                query = query.filter(key > after)
+            rows = query.order_by(key).limit(limit + 1).all()
+
+        page = dict(rows[:limit])
+        next_after = rows[limit - 1][0] if len(rows) > limit else None
+        return page, next_after
+
+    def query_from_path(self, db_name: str, path: str, order_by: str, start_at: JSON_PRIMITIVES = None,
+                        end_at: JSON_PRIMITIVES = None, limit_to_first: int = None, limit_to_last: int = None,
+                        min_lsn: str = None, fields: List[str] = None) -> dict:
+        """
+        children of the object at path ordered by the value at their child path order_by,
+        evaluated in postgres. Queries of the root can use the index of create_index(db_name, order_by).
+        """
+        self.__check_closed()
+        if (limit_to_first is not None and limit_to_first < 1) or (limit_to_last is not None and limit_to_last < 1):
+            raise ValueError("Invalid limit")
+        self.access_stats.record(db_name, path, order_by, start_at is not None or end_at is not None)
+        cls = self.layout.table(db_name)
+        order_path = tuple(order_by.split('/'))
+
+        with self.__read_session(min_lsn) as session:
+            if not path:
+                key, value = cls.l1_key, cls.data[cls.l1_key]
+                query = session.query(key, _pick(value, fields))
+            else:
+                l1_key, path_query, _ = _build_path_query(path)
+                node = cls.data[path_query]
+                children = sqlalchemy.func.jsonb_each(
+                    sqlalchemy.case([(sqlalchemy.func.jsonb_typeof(node) == 'object', node)])
+                ).alias('child')
+                key = sqlalchemy.literal_column('child.key')
+                value = sqlalchemy.literal_column('child.value', type_=JSONB)
+                query = session.query(key, _pick(value, fields)) \
+                    .select_from(cls, children) \
+                    .filter(cls.l1_key == l1_key)
+
+            # same expressions and order as the columns of index_columns_sql
+            sort = value[order_path]
+            query = self.layout.scope(query, db_name)
+            if start_at is not None:
+                query = query.filter(sort >= sqlalchemy.cast(start_at, JSONB))
+            if end_at is not None:
+                query = query.filter(sort <= sqlalchemy.cast(end_at, JSONB))
+            if limit_to_last is not None:
+                rows = query.order_by(sort.desc().nullslast(), key.collate("C").desc()).limit(limit_to_last).all()
+                rows.reverse()
+            else:
+                query = query.order_by(sort.nullsfirst(), key.collate("C"))
+                rows = (query.limit(limit_to_first) if limit_to_first is not None else query).all()
+        return dict(rows)
+
     def delete_db(self, db_name: str) -> bool:
         self.__check_closed()
-        remove_json_db_table(db_name, self.session)
+        # dropping an index concurrently waits for every open transaction, ours included
+        self.session.commit()
+        for index in self.list_indexes(db_name):
+            self.drop_index(db_name, index["order_by"])
+        self.access_stats.forget(db_name)
+        self.index_advisor.forget(db_name)
+        self.db_stats.forget(db_name)
+        self.layout.remove_db(db_name, self.session)
+        self.db_meta.removed(db_name)
+        self.__record_write_lsn()
         return True
 
-    def create_db(self, db_name: str) -> BaseJsonDb:
+    def create_db(self, db_name: str, durability: str = DURABLE, incoming: bool = False) -> BaseJsonDb:
+        """
+        :param durability: one of DURABILITY_LEVELS, UNLOGGED dbs need the table per db layout
+        :param incoming: the db is filled from another shard, see activate_db
+        """
         self.__check_closed()
-        create_json_db_table(db_name, self.session)
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError("Unknown durability: %s" % durability)
+        db_id = self.layout.create_db(db_name, self.session, durability, incoming)
+        self.db_meta.added(db_name, db_id, durability, incoming)
+        self.__record_write_lsn()
         db = BaseJsonDb(db_name, self)
-        self.json_db_instance_cache[db_name] = db
+        with self.db_lock:
+            self.json_db_instance_cache[db_name] = db
         return db
 
+    def activate_db(self, db_name: str):
+        """
+        an incoming db is hosted here from now on
+        """
+        self.__check_closed()
+        activate_json_db(db_name, self.session)
+        self.db_meta.activated(db_name)
+
     def delete_at_path(self, db_name: str, path: str) -> bool:
+        """
+        removes the key at path, objects left empty and the l1_key row
+        when it becomes empty are removed with it
+        :return: False if there was nothing at path
+        """
+        return self.set_at_path(db_name, path, None, 'delete')
+
+    def sweep_expired(self) -> int:
         self.__check_closed()
-        self.set_at_path(db_name, path, None)
-        return True
+        return self.expiry_sweeper.sweep()
 
-    def get_all_dbs(self) -> List[str]:
+    def children_writer(self, db_name: str, path: str, op_type: str = 'put') -> JsonChildrenWriter:
+        """
+        all batches are written in one transaction on a session of their own,
+        readers and other writers never see a partly written value
+        """
+        self.__check_closed()
+        return PostgresJsonChildrenWriter(db_name, path, op_type, self, self.session_maker(),
+                                          self.__execute_write, self.__record_write_lsn,
+                                          lambda session: self.__relax_commit(session, [db_name]),
+                                          self.__clear_expiry)
+
+    def get_all_dbs(self, min_lsn: str = None) -> List[str]:
+        self.__check_closed()
+        with self.__read_session(min_lsn) as session:
+            all_dbs = session.query(StorageMeta).all()
+            return [it.db_name for it in all_dbs]
+
+    def get_db_stats(self) -> Dict[str, dict]:
+        """
+        rows are the l1_key rows of a db, bytes the pg_column_size of their data as written.
+        Writes committed by other processes count once they flushed them.
+        """
         self.__check_closed()
-        all_dbs = self.session.query(StorageMeta).all()
-        return [it.db_name for it in all_dbs]
+        return self.db_stats.read()
+
+    def recount_stats(self, db_names: List[str] = None):
+        """
+        replaces the row count and size of the dbs, all by default, by counting
+        their data. Scans every row of the dbs.
+        """
+        self.__check_closed()
+        session = self.session_maker()
+        try:
+            query = session.query(StorageMeta.id, StorageMeta.db_name)
+            if db_names is not None:
+                query = query.filter(StorageMeta.db_name.in_(db_names))
+            for db_id, db_name in query.all():
+                table = self.layout.table(db_name)
+                # same measure as the write statements
+                size = sqlalchemy.func.coalesce(table.size, sqlalchemy.func.pg_column_size(table.data))
+                try:
+                    with session.begin_nested():
+                        rows, total = self.layout.scope(session.query(
+                            sqlalchemy.func.count(table.data), sqlalchemy.func.coalesce(sqlalchemy.func.sum(size), 0)
+                        ), db_name).one()
+                        DbStats.recount(session, db_id, rows, total)
+                except sqlalchemy.exc.ProgrammingError:
+                    # no table of its own, a db of another layout sharing storage_meta
+                    continue
+            session.commit()
+        finally:
+            session.close()
 
     def __new_pg_connection(self):
         import psycopg2
@@ -212,63 +626,146 @@ class PostgresJsonStorage(BaseJsonStorage):
         self.notifiers.append(notifier)
         return notifier
 
-    def create_index(self, db_name, path):
-        pass
+    def create_index(self, db_name: str, path: str) -> str:
+        """
+        builds the index of queries of the root ordered by the child path, without
+        blocking writes. An index left invalid by an interrupted build is built again.
+        :return: name of the index
+        """
+        self.__check_closed()
+        name = index_name(db_name, path)
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            valid = conn.execute(sqlalchemy.text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+            ), {"name": name}).scalar()
+            if valid:
+                return name
+            if valid is not None:
+                conn.execute('DROP INDEX CONCURRENTLY IF EXISTS "%s"' % name)
+            table, predicate = self.layout.index_target(db_name, conn)
+            conn.execute('CREATE INDEX CONCURRENTLY "%s" ON %s (%s)%s' % (
+                name, table, index_columns_sql(path), " WHERE " + predicate if predicate else ""
+            ))
+            conn.execute(sqlalchemy.text('COMMENT ON INDEX "%s" IS :comment' % name), {
+                "comment": INDEX_COMMENT_PREFIX + json.dumps({"db_name": db_name, "order_by": path})
+            })
+        return name
+
+    def drop_index(self, db_name: str, path: str):
+        self.__check_closed()
+        with self.engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+                'DROP INDEX CONCURRENTLY IF EXISTS "%s"' % index_name(db_name, path)
+            )
+
+    def list_indexes(self, db_name: str) -> List[dict]:
+        """
+        :return: [{"order_by", "name", "scans"}] of the indexes made by create_index
+        """
+        self.__check_closed()
+        with self.engine.connect() as conn:
+            return list_path_indexes(conn, db_name)
+
+    def advise_indexes(self, db_name: str, apply: bool = False) -> dict:
+        self.__check_closed()
+        if apply:
+            return self.index_advisor.apply(db_name)
+        return self.index_advisor.advise(db_name)
 
     def optimize(self, db_name: str):
         pass
 
     def close(self):
         map(lambda x: x.cleanup(), self.notifiers)
+        if self.write_pipeline is not None:
+            self.write_pipeline.close()
+        self.expiry_sweeper.close()
+        self.db_stats.close()
         self.session.close()
+        self.replicas.close()
+        self.db_meta.close()
         self.closed = True
 
 
-def queue_to_generator(q):
-    while True:
+class PostgresJsonChildrenWriter(JsonChildrenWriter):
+    """
+        Children of the root are upserted with one statement per batch and a
+        put at the root deletes the rows of the db with one statement
+    """
+
+    def __init__(self, db_name: str, path: str, op_type: str, storage: PostgresJsonStorage,
+                 session: Session, write_fn, on_commit, before_commit, clear_expiry_fn):
+        """
+        :param write_fn: write_fn(session, db_name, path, value, op_type) applies a write without committing
+        :param before_commit: before_commit(session) sets the commit mode of the db
+        :param clear_expiry_fn: clear_expiry_fn(session, db_name, path, value, op_type) removes the
+            deadlines of what a write of the root replaces
+        """
+        super().__init__(db_name, path, op_type, storage)
+        self.session = session
+        self.write_fn = write_fn
+        self.on_commit = on_commit
+        self.before_commit = before_commit
+        self.clear_expiry_fn = clear_expiry_fn
+
+    def apply(self, path: str, value: JSON_PRIMITIVES, op_type: str):
+        self.write_fn(self.session, self.db_name, path, value, op_type)
+
+    def __execute(self, op: str, *args):
+        layout = self.storage.layout
+        layout.fence(self.db_name, self.session)
+        rows = layout.statements(self.db_name).execute(
+            self.session.connection(), op, *args, *layout.statement_args(self.db_name)
+        )
+        DbStats.record(self.session, self.db_name, rows)
+
+    def clear_root(self):
+        self.__execute('clear')
+        self.clear_expiry_fn(self.session, self.db_name, '', None, 'delete')
+
+    def put_root_children(self, children: dict):
+        self.__execute('put_children', json.dumps(children))
+        self.clear_expiry_fn(self.session, self.db_name, '', children, 'patch')
+
+    def commit(self):
         try:
-            data = q.get_nowait()
-            if data is None:
-                raise StopIteration()
-            q.task_done()
-            yield data
-        except queue.Empty:
-            yield None
-
-
-def path_filter(path, gen):
-    for payload in gen:
-        if payload and path is not None:
-            if payload['path'].startswith(path):
-                yield payload
-            else:
-                continue
-        else:
-            yield payload
+            self.before_commit(self.session)
+            self.session.commit()
+            self.on_commit()
+        finally:
+            self.session.close()
+
+    def rollback(self):
+        self.session.rollback()
+        self.session.close()
 
 
 class ThreadSafeJsonChangeNotifier(BaseJsonChangeNotifier):
     def __init__(self, db_name: str, path: str, conn):
         super().__init__(db_name, path)
         self.conn = conn
+        # changes below the root arrive only on the channel of their l1_key as well
+        self.channel = subtree_channel(db_name, path.split('/')[0]) if path else db_name
         self.listen_thread = None  # type : threading.Thread
         self.__thread_kill = False
-        self.message_queue = queue.Queue()
+        self.message_queue = WakeupQueue()
 
     def __prepare_listen_thread(self):
         import threading
         if self.listen_thread is None:
             self.__thread_kill = False
-            self.listen_thread = threading.Thread(target=self.__listen)
+            # listening before listen() returns, writes made after it are not missed
+            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = self.conn.cursor()
+            cursor.execute("LISTEN %s;" % psycopg2.extensions.quote_ident(self.channel, cursor))
+            self.listen_thread = threading.Thread(target=self.__listen, args=(cursor,))
             self.listen_thread.start()
 
-    def __listen(self):
+    def __listen(self, cursor):
         import select
 
         conn = self.conn
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        cursor = conn.cursor()
-        cursor.execute("LISTEN %s;" % self.db)
         try:
             while not self.__thread_kill:
                 if select.select([conn], [], [], 1) == ([], [], []):
@@ -276,9 +773,12 @@ class ThreadSafeJsonChangeNotifier(BaseJsonChangeNotifier):
                 else:
                     conn.poll()
                     while conn.notifies:
-                        notify = conn.notifies.pop()
+                        notify = conn.notifies.pop(0)
                         print("Got NOTIFY:", notify.pid, notify.channel, notify.payload)
                         payload = json.loads(notify.payload)
+                        # channels of long keys are hashed, the changes of other dbs may share them
+                        if payload.pop('db', self.db) != self.db:
+                            continue
                         payload['path'] = '/'.join(payload['path'])
                         self.message_queue.put(payload)
         finally:
@@ -297,6 +797,9 @@ class ThreadSafeJsonChangeNotifier(BaseJsonChangeNotifier):
         print("Thread id:%s" % self.listen_thread.ident)
         return path_filter(self.path, queue_to_generator(self.message_queue))
 
+    def set_wakeup(self, wakeup):
+        self.message_queue.wakeup = wakeup
+
     def cleanup(self):
         print("stop notification thread for path:%s" % self.path)
         print("Thread id:%s" % self.listen_thread.ident)
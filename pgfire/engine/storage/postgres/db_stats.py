@@ -0,0 +1,156 @@
+import json
+import threading
+
+import sqlalchemy
+from sqlalchemy import event, text
+from sqlalchemy.orm.session import Session
+
+__all__ = ["DbStats", "DEFAULT_STATS_FLUSH_INTERVAL"]
+
+DEFAULT_STATS_FLUSH_INTERVAL = 1.0
+PENDING_INFO_KEY = "pgfire_db_stats"
+
+# the deltas of all dbs in one statement, rows are locked in db_id order so
+# workers flushing at the same time do not deadlock. Writes are counted in
+# the minute of the flush, the count of the minute before is kept for rates.
+FLUSH_SQL = """INSERT INTO db_stats AS s (db_id, rows, bytes, writes, minute, minute_writes, last_minute_writes)
+SELECT m.id, d.rows, d.bytes, d.writes, date_trunc('minute', now()), d.writes, 0
+FROM jsonb_to_recordset(CAST(:deltas AS jsonb)) AS d(db_name text, rows bigint, bytes bigint, writes bigint)
+JOIN storage_meta m ON m.db_name = d.db_name
+ORDER BY m.id
+ON CONFLICT (db_id) DO UPDATE SET
+    rows = s.rows + excluded.rows,
+    bytes = s.bytes + excluded.bytes,
+    writes = s.writes + excluded.writes,
+    last_minute_writes = CASE WHEN s.minute = excluded.minute THEN s.last_minute_writes
+                              WHEN s.minute = excluded.minute - interval '1 minute' THEN s.minute_writes
+                              ELSE 0 END,
+    minute_writes = CASE WHEN s.minute = excluded.minute THEN s.minute_writes + excluded.minute_writes
+                         ELSE excluded.minute_writes END,
+    minute = excluded.minute"""
+
+# dbs being moved in from another shard are left out
+STATS_SQL = """SELECT m.db_name, COALESCE(s.rows, 0), COALESCE(s.bytes, 0), COALESCE(s.writes, 0),
+       CASE WHEN s.minute = date_trunc('minute', now()) THEN s.last_minute_writes
+            WHEN s.minute = date_trunc('minute', now()) - interval '1 minute' THEN s.minute_writes
+            ELSE 0 END
+FROM storage_meta m LEFT JOIN db_stats s ON s.db_id = m.id
+WHERE NOT m.incoming"""
+
+RECOUNT_SQL = """INSERT INTO db_stats (db_id, rows, bytes) VALUES (:db_id, :rows, :bytes)
+ON CONFLICT (db_id) DO UPDATE SET rows = excluded.rows, bytes = excluded.bytes"""
+
+
+class DbStats(object):
+    """
+        Row count, size and writes of each json db, kept up to date by the
+        writes instead of scanning the data. Every write statement returns
+        how it changed the rows and bytes of its db, the deltas of a
+        transaction are added up once it commits and flushed to db_stats
+        every interval, so concurrent writers do not wait on the row of a
+        db. Bytes are the pg_column_size of the data of each row when it
+        was written, before postgres compressed or toasted it.
+    """
+
+    def __init__(self, engine, session_maker, interval: float = DEFAULT_STATS_FLUSH_INTERVAL):
+        """
+        :param session_maker: deltas are recorded on the sessions it makes
+        """
+        self.engine = engine
+        self.interval = interval
+        self.lock = threading.Lock()
+        # {db_name: [rows, bytes, writes]} committed since the last flush
+        self.deltas = {}
+        event.listen(session_maker, "after_commit", self.__committed)
+        event.listen(session_maker, "after_soft_rollback", self.__rolled_back)
+        self.stopped = threading.Event()
+        self.flush_thread = threading.Thread(target=self.__run, daemon=True)
+        self.flush_thread.start()
+
+    @staticmethod
+    def record(session: Session, db_name: str, rows: list):
+        """
+        :param rows: rows of a write statement, ending with their rows_delta and bytes_delta
+        """
+        if not rows:
+            return
+        pending = session.info.setdefault(PENDING_INFO_KEY, {}).setdefault(db_name, [0, 0, 0])
+        for row in rows:
+            pending[0] += row[-2]
+            pending[1] += row[-1]
+        pending[2] += 1
+
+    def __committed(self, session: Session):
+        if session.transaction is not None and session.transaction.nested:
+            # a released savepoint, the transaction may still roll back
+            return
+        pending = session.info.pop(PENDING_INFO_KEY, None)
+        if pending:
+            self.__add(pending)
+
+    @staticmethod
+    def __rolled_back(session: Session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop(PENDING_INFO_KEY, None)
+
+    def __add(self, deltas: dict):
+        with self.lock:
+            for db_name, (rows, size, writes) in deltas.items():
+                totals = self.deltas.setdefault(db_name, [0, 0, 0])
+                totals[0] += rows
+                totals[1] += size
+                totals[2] += writes
+
+    def forget(self, db_name: str):
+        with self.lock:
+            self.deltas.pop(db_name, None)
+
+    def flush(self):
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+        if not deltas:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text(FLUSH_SQL), {"deltas": json.dumps([
+                    {"db_name": db_name, "rows": rows, "bytes": size, "writes": writes}
+                    for db_name, (rows, size, writes) in deltas.items()
+                ])})
+        except Exception:
+            # kept for the next flush
+            self.__add(deltas)
+            raise
+
+    def read(self) -> dict:
+        """
+        :return: {db_name: {"rows", "bytes", "writes", "writes_per_minute"}}, writes_per_minute
+            counts the writes of the last complete minute
+        """
+        self.flush()
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(STATS_SQL)).fetchall()
+        return dict((db_name, {"rows": rows_count, "bytes": size, "writes": writes, "writes_per_minute": rate})
+                    for db_name, rows_count, size, writes, rate in rows)
+
+    @staticmethod
+    def recount(session: Session, db_id: int, rows: int, size: int):
+        """
+        replaces the row count and size of a db by values counted from its data
+        """
+        session.execute(text(RECOUNT_SQL), {"db_id": db_id, "rows": rows, "bytes": size})
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except sqlalchemy.exc.SQLAlchemyError:
+                # tried again after the next interval
+                pass
+
+    def close(self):
+        self.stopped.set()
+        self.flush_thread.join()
+        try:
+            self.flush()
+        except sqlalchemy.exc.SQLAlchemyError:
+            pass
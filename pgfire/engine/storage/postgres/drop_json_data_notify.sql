@@ -0,0 +1,9 @@
+-- write functions replaced by the statements prepared per table, see statements.py
+DROP FUNCTION IF EXISTS public.upsert_json_data_notify(regclass, text, jsonb, text[], jsonb);
+DROP FUNCTION IF EXISTS public.patch_json_data_notify(regclass, text, jsonb, text[], jsonb);
+DROP FUNCTION IF EXISTS public.atomic_json_data_notify(regclass, text, text[], text, jsonb);
+DROP FUNCTION IF EXISTS public.delete_json_data_notify(regclass, text, text[]);
+DROP FUNCTION IF EXISTS public.upsert_json_data_notify(integer, text, text, jsonb, text[], jsonb);
+DROP FUNCTION IF EXISTS public.patch_json_data_notify(integer, text, text, jsonb, text[], jsonb);
+DROP FUNCTION IF EXISTS public.atomic_json_data_notify(integer, text, text, text[], text, jsonb);
+DROP FUNCTION IF EXISTS public.delete_json_data_notify(integer, text, text, text[]);
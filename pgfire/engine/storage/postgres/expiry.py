@@ -0,0 +1,118 @@
+import threading
+
+import sqlalchemy
+from sqlalchemy import text
+from sqlalchemy.orm.session import Session
+
+__all__ = ["ExpirySweeper", "set_expiry", "clear_expiry",
+           "DEFAULT_TTL_SWEEP_INTERVAL", "DEFAULT_TTL_SWEEP_BATCH"]
+
+DEFAULT_TTL_SWEEP_INTERVAL = 1.0
+DEFAULT_TTL_SWEEP_BATCH = 500
+
+SET_EXPIRY_SQL = """INSERT INTO path_expiry (db_id, path, expires)
+VALUES (:db_id, :path, now() + make_interval(secs => :ttl))
+ON CONFLICT (db_id, path) DO UPDATE SET expires = excluded.expires"""
+
+# deadlines of paths and of the paths below those with below set. Paths below p sort
+# between p || '/' and p || '0' in the C collation of the path_expiry_subtree index
+CLEAR_EXPIRY_SQL = """DELETE FROM path_expiry e
+USING unnest(CAST(:paths AS text[]), CAST(:below AS boolean[])) AS p(path, below)
+WHERE e.db_id = :db_id AND (e.path = p.path OR p.below AND e.path COLLATE "C" > p.path || '/'
+                                                      AND e.path COLLATE "C" < p.path || '0')"""
+
+CLEAR_DB_EXPIRY_SQL = "DELETE FROM path_expiry WHERE db_id = :db_id"
+
+# the deadlines are taken in the order they passed, rows locked by another
+# worker sweeping at the same time are skipped
+DUE_EXPIRIES_SQL = """DELETE FROM path_expiry e
+USING (
+    SELECT db_id, path FROM path_expiry WHERE expires <= now()
+    ORDER BY expires LIMIT :limit FOR UPDATE SKIP LOCKED
+) AS due, storage_meta m
+WHERE e.db_id = due.db_id AND e.path = due.path AND m.id = e.db_id
+RETURNING m.db_name, e.path, e.expires"""
+
+
+def set_expiry(session: Session, db_id: int, path: str, ttl: float):
+    """
+    path is deleted ttl seconds after the start of the transaction, a previous deadline is replaced
+    """
+    session.execute(text(SET_EXPIRY_SQL), {"db_id": db_id, "path": path, "ttl": ttl})
+
+
+def clear_expiry(session: Session, db_id: int, path: str, children: list = None):
+    """
+    removes the deadlines of path and of the paths below it, with children only
+    those of path and below its children. The root clears all deadlines of the db.
+    """
+    if not path:
+        if children is None:
+            session.execute(text(CLEAR_DB_EXPIRY_SQL), {"db_id": db_id})
+            return
+        paths, below = list(children), [True] * len(children)
+    elif children is None:
+        paths, below = [path], [True]
+    else:
+        paths, below = [path] + ["%s/%s" % (path, key) for key in children], [False] + [True] * len(children)
+    session.execute(text(CLEAR_EXPIRY_SQL), {"db_id": db_id, "paths": paths, "below": below})
+
+
+class ExpirySweeper(object):
+    """
+        Deletes the paths whose deadline passed, at most batch paths per
+        transaction. The deletes are normal writes of the storage and send
+        the same change events.
+    """
+
+    def __init__(self, session: Session, delete_fn, on_commit=None,
+                 interval: float = DEFAULT_TTL_SWEEP_INTERVAL,
+                 batch: int = DEFAULT_TTL_SWEEP_BATCH):
+        """
+        :param session: used only by the sweeper
+        :param delete_fn: delete_fn(session, db_name, path) deletes path without committing
+        :param on_commit: called after every batch that deleted something
+        """
+        self.session = session
+        self.delete_fn = delete_fn
+        self.on_commit = on_commit
+        self.interval = interval
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sweep_thread = threading.Thread(target=self.__run, daemon=True)
+        self.sweep_thread.start()
+
+    def sweep(self) -> int:
+        """
+        :return: number of expired paths deleted
+        """
+        with self.lock:
+            session = self.session
+            try:
+                due = session.execute(text(DUE_EXPIRIES_SQL), {"limit": self.batch}).fetchall()
+                # deleted in the order of their deadlines
+                for db_name, path, _ in sorted(due, key=lambda row: row[2]):
+                    self.delete_fn(session, db_name, path)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+        if due and self.on_commit:
+            self.on_commit()
+        return len(due)
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                # a full batch leaves more passed deadlines behind
+                while self.sweep() == self.batch and not self.stopped.is_set():
+                    pass
+            except sqlalchemy.exc.SQLAlchemyError:
+                # tried again after the next interval
+                pass
+
+    def close(self):
+        self.stopped.set()
+        self.sweep_thread.join()
+        self.session.close()
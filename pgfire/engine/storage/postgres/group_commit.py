@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy.orm.session import Session
+
+__all__ = ["GroupCommitWriter", "DEFAULT_GROUP_COMMIT_WINDOW_MS", "DEFAULT_GROUP_COMMIT_MAX_BATCH"]
+
+DEFAULT_GROUP_COMMIT_WINDOW_MS = 2
+DEFAULT_GROUP_COMMIT_MAX_BATCH = 256
+
+
+class GroupCommitWriter(object):
+    """
+        Coalesces writes of concurrent callers into shared transactions.
+        Writes arriving within window_ms of the first one, up to max_batch,
+        are applied in arrival order and committed together, so a burst of
+        small writes costs one WAL flush instead of one per write.
+        When a write of the batch fails, the batch is applied again with a
+        savepoint per write, so the failing write fails only its caller.
+    """
+
+    def __init__(self, session: Session, execute_fn, on_commit=None, before_commit=None,
+                 window_ms: float = DEFAULT_GROUP_COMMIT_WINDOW_MS,
+                 max_batch: int = DEFAULT_GROUP_COMMIT_MAX_BATCH):
+        """
+        :param session: used only by the writer thread
+        :param execute_fn: execute_fn(session, *args) applies one write, returns its result
+        :param on_commit: called after every committed batch
+        :param before_commit: before_commit(session, [args of each write]) is called before committing a batch
+        """
+        self.session = session
+        self.execute_fn = execute_fn
+        self.on_commit = on_commit
+        self.before_commit = before_commit
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.write_queue = queue.Queue()
+        self.write_thread = threading.Thread(target=self.__run, daemon=True)
+        self.write_thread.start()
+
+    def submit(self, *args) -> Future:
+        future = Future()
+        self.write_queue.put((args, future))
+        return future
+
+    def __next_batch(self):
+        first = self.write_queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                write = self.write_queue.get(timeout=remaining) if remaining > 0 \
+                    else self.write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is None:
+                # stop after this batch
+                self.write_queue.put(None)
+                break
+            batch.append(write)
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                return
+            self.__apply(batch)
+
+    def __apply(self, batch):
+        session = self.session
+        try:
+            results = [(future, self.execute_fn(session, *args), None) for args, future in batch]
+        except Exception:
+            session.rollback()
+            results = self.__apply_isolated(batch)
+        try:
+            if self.before_commit:
+                self.before_commit(session, [args for args, _ in batch])
+            session.commit()
+            if self.on_commit:
+                self.on_commit()
+        except Exception as e:
+            session.rollback()
+            for future, _, _ in results:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def __apply_isolated(self, batch):
+        session = self.session
+        results = []
+        for args, future in batch:
+            try:
+                with session.begin_nested():
+                    results.append((future, self.execute_fn(session, *args), None))
+            except Exception as e:
+                results.append((future, None, e))
+        return results
+
+    def close(self):
+        """
+        completes the writes already submitted
+        """
+        self.write_queue.put(None)
+        self.write_thread.join()
+        self.session.close()
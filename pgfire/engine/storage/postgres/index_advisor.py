@@ -0,0 +1,145 @@
+import hashlib
+import json
+import threading
+
+from sqlalchemy import text
+
+__all__ = ["AccessStats", "IndexAdvisor", "index_name", "index_columns_sql", "list_path_indexes",
+           "INDEX_COMMENT_PREFIX", "DEFAULT_MAX_STATS_ENTRIES", "DEFAULT_ADVISOR_MIN_QUERIES"]
+
+DEFAULT_MAX_STATS_ENTRIES = 10000
+DEFAULT_ADVISOR_MIN_QUERIES = 100
+# comment of the indexes created for ordered queries, followed by {"db_name", "order_by"}
+INDEX_COMMENT_PREFIX = "pgfire:"
+
+
+def index_name(db_name: str, order_by: str) -> str:
+    # postgres truncates names at 63 bytes, a digest keeps them unique
+    return "pgfire_ix_%s" % hashlib.md5(("%s\0%s" % (db_name, order_by)).encode('utf-8')).hexdigest()
+
+
+def index_columns_sql(order_by: str) -> str:
+    """
+    columns of the index serving queries of the root ordered by the child path order_by,
+    same expressions and order as the queries of PostgresJsonStorage.query_from_path
+    """
+    segments = ', '.join("'%s'" % segment.replace("'", "''") for segment in order_by.split('/'))
+    return '((data -> l1_key) #> ARRAY[%s]::text[]) NULLS FIRST, l1_key COLLATE "C"' % segments
+
+
+class AccessStats(object):
+    """
+        How often the children of each path are ordered and filtered on
+        each child path, counted in memory by the process serving the reads.
+        Past max_entries the least queried entries are forgotten.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_STATS_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (db_name, path, order_by) -> [queries, filtered]
+        self.entries = {}
+
+    def record(self, db_name: str, path: str, order_by: str, filtered: bool):
+        key = (db_name, path or '', order_by)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.max_entries:
+                    self.__evict()
+                entry = self.entries[key] = [0, 0]
+            entry[0] += 1
+            if filtered:
+                entry[1] += 1
+
+    def __evict(self):
+        # half of the entries go at once, so eviction is rare
+        by_queries = sorted(self.entries, key=lambda k: self.entries[k][0])
+        for key in by_queries[:max(1, len(by_queries) // 2)]:
+            del self.entries[key]
+
+    def for_db(self, db_name: str) -> list:
+        with self.lock:
+            return [{"path": path, "order_by": order_by, "queries": queries, "filtered": filtered}
+                    for (db, path, order_by), (queries, filtered) in self.entries.items() if db == db_name]
+
+    def forget(self, db_name: str):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == db_name]:
+                del self.entries[key]
+
+
+class IndexAdvisor(object):
+    """
+        Recommends an index for each child path the root of a db is often
+        ordered or filtered on, and the indexes not used since the advice was
+        last applied for dropping. Advising alone changes nothing, however
+        often it is asked. Children below the root are stored in the row
+        of their l1_key, their queries are reported but no index can serve
+        them.
+    """
+
+    def __init__(self, storage, stats: AccessStats, min_queries: int = DEFAULT_ADVISOR_MIN_QUERIES):
+        """
+        :param storage: provides list_indexes, create_index and drop_index
+        """
+        self.storage = storage
+        self.stats = stats
+        self.min_queries = min_queries
+        # db_name -> {order_by: (queries, index scans)} when the advice was last applied
+        self.applied = {}
+
+    def advise(self, db_name: str) -> dict:
+        queries = sorted(self.stats.for_db(db_name), key=lambda q: -q["queries"])
+        indexes = self.storage.list_indexes(db_name)
+        indexed = dict((index["order_by"], index) for index in indexes)
+        root_queries = dict((q["order_by"], q["queries"]) for q in queries if not q["path"])
+
+        applied = self.applied.get(db_name, {})
+        unused = [order_by for order_by, index in indexed.items()
+                  if applied.get(order_by) == (root_queries.get(order_by, 0), index["scans"])]
+        return {
+            "queries": queries,
+            "indexes": indexes,
+            "create": [order_by for order_by, count in root_queries.items()
+                       if count >= self.min_queries and order_by not in indexed],
+            "drop": unused,
+            "not_indexable": [q for q in queries if q["path"] and q["queries"] >= self.min_queries],
+        }
+
+    def apply(self, db_name: str) -> dict:
+        """
+        creates the recommended indexes and drops the unused ones, the
+        indexes left are unused at the next apply if nothing used them meanwhile
+        :return: the advice applied
+        """
+        advice = self.advise(db_name)
+        for order_by in advice["create"]:
+            self.storage.create_index(db_name, order_by)
+        for order_by in advice["drop"]:
+            self.storage.drop_index(db_name, order_by)
+        root_queries = dict((q["order_by"], q["queries"]) for q in advice["queries"] if not q["path"])
+        self.applied[db_name] = dict((index["order_by"], (root_queries.get(index["order_by"], 0), index["scans"]))
+                                     for index in self.storage.list_indexes(db_name))
+        return advice
+
+    def forget(self, db_name: str):
+        self.applied.pop(db_name, None)
+
+
+def list_path_indexes(conn, db_name: str) -> list:
+    """
+    indexes created for ordered queries of db_name, with their scans since the statistics were reset
+    """
+    rows = conn.execute(text(
+        "SELECT c.relname, obj_description(c.oid, 'pg_class'), COALESCE(s.idx_scan, 0) "
+        "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = c.oid "
+        "WHERE c.relkind = 'i' AND i.indisvalid AND obj_description(c.oid, 'pg_class') LIKE :prefix"
+    ), {"prefix": INDEX_COMMENT_PREFIX + '%'}).fetchall()
+    indexes = []
+    for name, comment, scans in rows:
+        meta = json.loads(comment[len(INDEX_COMMENT_PREFIX):])
+        if meta.get("db_name") == db_name:
+            indexes.append({"order_by": meta["order_by"], "name": name, "scans": scans})
+    return indexes
@@ -0,0 +1,13 @@
+-- taken by every write of a db of the shared layout before it changes rows. A move of the db to
+-- another shard holds the exclusive lock while it switches over, writes waiting for it fail
+-- once the db is gone from storage_meta and are retried on the new shard.
+-- Volatile, the check sees what was committed while the lock was waited for.
+CREATE OR REPLACE FUNCTION json_db_fence(lock_class int, db_id int)
+  RETURNS void AS $$
+    BEGIN
+      PERFORM pg_advisory_xact_lock_shared(lock_class, db_id);
+      IF NOT EXISTS (SELECT 1 FROM storage_meta WHERE id = db_id) THEN
+        RAISE EXCEPTION USING MESSAGE = 'Json db ' || db_id || ' moved or was deleted', ERRCODE = 'undefined_table';
+      END IF;
+    END;
+  $$ LANGUAGE plpgsql VOLATILE;
@@ -0,0 +1,27 @@
+-- channel of the changes under one l1_key, <db channel>__<l1_key>. Channel names are limited to
+-- 63 bytes, longer ones use the md5 of the db channel and the key, dbs sharing the first
+-- characters of their name get channels of their own. Same as statements.subtree_channel.
+CREATE OR REPLACE FUNCTION json_notify_channel(channel text, l1_key text)
+  RETURNS text AS $$
+    SELECT CASE WHEN octet_length(channel) + octet_length(l1_key) + 2 < 64
+                THEN channel || '__' || l1_key
+                ELSE left(channel, 29) || '__' || md5(channel || '/' || l1_key) END;
+  $$ LANGUAGE sql IMMUTABLE;
+
+-- a change is sent on the channel of the db, for listeners of the root, and on the channel of its l1_key.
+-- The payload names the db, listeners of a hashed channel drop the changes of other dbs.
+CREATE OR REPLACE FUNCTION json_notify(channel text, l1_key text, payload text)
+  RETURNS void AS $$
+    DECLARE
+      change json;
+    BEGIN
+      payload := '{"db" : ' || to_json(channel)::text || ', ' || substr(payload, 2);
+      IF octet_length(payload) >= 8000 THEN
+        change := payload::json;
+        payload := json_build_object('db', channel, 'event', change -> 'event', 'path', change -> 'path',
+                                     'data', NULL, 'truncated', true)::text;
+      END IF;
+      PERFORM pg_notify(channel, payload);
+      PERFORM pg_notify(json_notify_channel(channel, l1_key), payload);
+    END;
+  $$ LANGUAGE plpgsql;
@@ -0,0 +1,17 @@
+-- payload of a change notification. NOTIFY payloads are limited to 8000 bytes,
+-- larger changes are announced without their data and listeners read it instead.
+CREATE OR REPLACE FUNCTION json_notify_payload(event text, path text[], data jsonb, op text DEFAULT NULL)
+  RETURNS text AS $$
+    DECLARE
+      payload text;
+    BEGIN
+      payload := json_build_object('event', event, 'path', path, 'data', data)::text;
+      IF op IS NOT NULL THEN
+        payload := json_build_object('event', event, 'op', op, 'path', path, 'data', data)::text;
+      END IF;
+      IF octet_length(payload) < 8000 THEN
+        RETURN payload;
+      END IF;
+      RETURN json_build_object('event', event, 'path', path, 'data', NULL, 'truncated', true)::text;
+    END;
+  $$ LANGUAGE plpgsql IMMUTABLE;
@@ -0,0 +1,34 @@
+CREATE OR REPLACE FUNCTION jsonb_atomic_apply(cur jsonb, op text, operand jsonb)
+  RETURNS jsonb AS $$
+    BEGIN
+      IF op = 'increment' THEN
+        IF jsonb_typeof(cur) = 'number' THEN
+          RETURN to_jsonb((cur #>> '{}')::numeric + (operand #>> '{}')::numeric);
+        END IF;
+        RETURN operand;
+      ELSIF op = 'max' THEN
+        IF jsonb_typeof(cur) = 'number' AND (cur #>> '{}')::numeric >= (operand #>> '{}')::numeric THEN
+          RETURN cur;
+        END IF;
+        RETURN operand;
+      ELSIF op = 'min' THEN
+        IF jsonb_typeof(cur) = 'number' AND (cur #>> '{}')::numeric <= (operand #>> '{}')::numeric THEN
+          RETURN cur;
+        END IF;
+        RETURN operand;
+      ELSIF op = 'append' THEN
+        IF jsonb_typeof(cur) = 'array' THEN
+          RETURN cur || jsonb_build_array(operand);
+        END IF;
+        RETURN jsonb_build_array(operand);
+      ELSIF op = 'remove_from_array' THEN
+        IF jsonb_typeof(cur) IS DISTINCT FROM 'array' THEN
+          RETURN coalesce(cur, 'null'::jsonb);
+        END IF;
+        RETURN (SELECT coalesce(jsonb_agg(e ORDER BY i), '[]'::jsonb)
+                FROM jsonb_array_elements(cur) WITH ORDINALITY AS elements(e, i)
+                WHERE e != operand);
+      END IF;
+      RAISE EXCEPTION 'unknown atomic operation %%', op;
+    END;
+  $$ LANGUAGE plpgsql IMMUTABLE;
@@ -0,0 +1,14 @@
+CREATE OR REPLACE FUNCTION jsonb_delete_prune(target jsonb, path text[])
+  RETURNS jsonb AS $$
+    DECLARE
+      i integer;
+    BEGIN
+      target := target #- path;
+      -- objects left empty by the delete are removed as well
+      FOR i IN REVERSE array_length(path, 1) - 1 .. 1 LOOP
+        EXIT WHEN target #> path[1:i] != '{}'::jsonb;
+        target := target #- path[1:i];
+      END LOOP;
+      RETURN target;
+    END;
+  $$ LANGUAGE plpgsql IMMUTABLE;
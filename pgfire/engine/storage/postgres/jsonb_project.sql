@@ -0,0 +1,16 @@
+CREATE OR REPLACE FUNCTION jsonb_pick(target jsonb, fields text[])
+  RETURNS jsonb AS $$
+    SELECT CASE WHEN jsonb_typeof(target) = 'object' THEN
+                  (SELECT coalesce(jsonb_object_agg(key, value), '{}'::jsonb)
+                   FROM jsonb_each(target) WHERE key = ANY(fields))
+                ELSE target END;
+  $$ LANGUAGE sql IMMUTABLE;
+
+-- keeps only the given fields of each child of target
+CREATE OR REPLACE FUNCTION jsonb_project(target jsonb, fields text[])
+  RETURNS jsonb AS $$
+    SELECT CASE WHEN jsonb_typeof(target) = 'object' THEN
+                  (SELECT coalesce(jsonb_object_agg(key, jsonb_pick(value, fields)), '{}'::jsonb)
+                   FROM jsonb_each(target))
+                ELSE target END;
+  $$ LANGUAGE sql IMMUTABLE;
@@ -1,22 +1,20 @@
--- https://gist.github.com/tuhoojabotti/5b1fbbf3f22853475bba14f8833faada
+-- sets val at path, objects missing on the path are created and non objects on the path are replaced.
+-- only the prefixes of path are looked up, the missing part of the path is built around val in one go.
 CREATE OR REPLACE FUNCTION jsonb_set_deep(target jsonb, path text[], val jsonb)
   RETURNS jsonb AS $$
     DECLARE
-      k text;
-      p text[];
+      depth integer := array_length(path, 1);
+      i integer;
     BEGIN
-      target = coalesce(target, '{}'::jsonb);
-      -- Create missing objects in the path.
-      FOREACH k IN ARRAY path LOOP
-        p := p || k;
-        IF (target #> p IS NULL) THEN
-          target := jsonb_set(target, p, '{}'::jsonb);
-        ELSIF (jsonb_typeof(target #> p) != 'object') THEN
-          -- remove the value at the target and convert it to an empty object
-          target := jsonb_set(target, p, '{}'::jsonb);
-        END IF;
+      target := coalesce(target, '{}'::jsonb);
+      -- deepest proper prefix of path that is an object
+      i := depth - 1;
+      WHILE i > 0 AND jsonb_typeof(target #> path[1:i]) IS DISTINCT FROM 'object' LOOP
+        i := i - 1;
       END LOOP;
-      -- Set the value like normal.
-      RETURN jsonb_set(target, path, val);
+      FOR j IN REVERSE depth .. i + 2 LOOP
+        val := jsonb_build_object(path[j], val);
+      END LOOP;
+      RETURN jsonb_set(target, path[1:i + 1], val);
     END;
-  $$ LANGUAGE plpgsql;
\ No newline at end of file
+  $$ LANGUAGE plpgsql IMMUTABLE;
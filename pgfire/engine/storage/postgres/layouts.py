@@ -0,0 +1,170 @@
+import re
+
+from sqlalchemy import text
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.session import Session
+
+from .models import *
+from .statements import *
+from ..base import DURABLE, UNLOGGED
+
+__all__ = ["TablePerDbLayout", "SharedLayout", "get_layout", "LAYOUT_TABLE_PER_DB", "LAYOUT_SHARED"]
+
+LAYOUT_TABLE_PER_DB = "table_per_db"
+LAYOUT_SHARED = "shared"
+DEFAULT_SHARED_PARTITIONS = 16
+SHARED_LAYOUT_VERSION = 2
+# class of the advisory locks of json_db_fence, the second key is the db id
+WRITE_FENCE_LOCK_CLASS = 0x70676677
+
+
+class TablePerDbLayout(object):
+    """
+        Every json db is a table of its own, named after the db
+    """
+    name = LAYOUT_TABLE_PER_DB
+    # tables shared by all dbs of the layout, recorded in pgfire_schema
+    schema_component = None
+    schema_version = None
+
+    def __init__(self, db_id_fn):
+        self.db_id_fn = db_id_fn
+        self.write_statements = {}
+
+    def install(self, conn):
+        pass
+
+    def table(self, db_name: str):
+        return get_json_db_cls(db_name)
+
+    def scope(self, query: Query, db_name: str) -> Query:
+        return query
+
+    def statements(self, db_name: str) -> WriteStatements:
+        # read once, forget may drop the entry from the thread of the meta cache
+        statements = self.write_statements.get(db_name)
+        if statements is None:
+            statements = self.write_statements[db_name] = table_write_statements(db_name)
+        return statements
+
+    def statement_args(self, db_name: str) -> tuple:
+        """
+        trailing arguments of the write statements that select the db
+        """
+        return ()
+
+    def forget(self, db_name: str):
+        self.write_statements.pop(db_name, None)
+
+    def fence(self, db_name: str, session: Session):
+        """
+        called in the transaction of a write of db_name before it changes rows
+        """
+        pass
+
+    def block_writes(self, db_name: str, session: Session):
+        """
+        writes of db_name wait until the transaction of session ends, reads go on.
+        Writes that waited for a db removed meanwhile fail.
+        """
+        table, _ = self.index_target(db_name, session.connection())
+        session.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % table)
+
+    def index_target(self, db_name: str, conn) -> tuple:
+        """
+        :return: (table to create indexes of the db on, predicate of its rows or None)
+        """
+        return conn.dialect.identifier_preparer.quote(db_name), None
+
+    def create_db(self, db_name: str, session: Session, durability: str = DURABLE, incoming: bool = False) -> int:
+        return create_json_db_table(db_name, session, durability, incoming)
+
+    def set_durability(self, db_name: str, durability: str, previous: str, session: Session):
+        if (durability == UNLOGGED) != (previous == UNLOGGED):
+            # rewrites the table, its writes wait meanwhile
+            session.execute('ALTER TABLE %s SET %s' % (
+                session.bind.dialect.identifier_preparer.quote(db_name),
+                'UNLOGGED' if durability == UNLOGGED else 'LOGGED'
+            ))
+        set_json_db_durability(db_name, durability, session)
+
+    def remove_db(self, db_name: str, session: Session):
+        remove_json_db_table(db_name, session)
+
+
+class SharedLayout(TablePerDbLayout):
+    """
+        All json dbs share the hash partitioned json_data table.
+        Creating a db adds no catalog entries, which keeps tens of thousands
+        of small dbs cheap for the planner and autovacuum.
+    """
+    name = LAYOUT_SHARED
+    schema_component = "shared_layout"
+    schema_version = SHARED_LAYOUT_VERSION
+
+    def __init__(self, db_id_fn, partitions: int = DEFAULT_SHARED_PARTITIONS):
+        super().__init__(db_id_fn)
+        self.partitions = partitions
+        self.shared_statements = shared_write_statements(SharedJsonData.__tablename__)
+
+    def install(self, conn):
+        create_shared_json_data_table(self.partitions, conn)
+
+    def table(self, db_name: str):
+        return SharedJsonData
+
+    def scope(self, query: Query, db_name: str) -> Query:
+        return query.filter(SharedJsonData.db_id == self.db_id_fn(db_name))
+
+    def statements(self, db_name: str) -> WriteStatements:
+        return self.shared_statements
+
+    def statement_args(self, db_name: str) -> tuple:
+        return self.db_id_fn(db_name), db_name
+
+    def fence(self, db_name: str, session: Session):
+        # the partitions hold other dbs, a lock of the db stands in for the lock of its table
+        session.execute(text("SELECT json_db_fence(:lock_class, :db_id)"),
+                        {"lock_class": WRITE_FENCE_LOCK_CLASS, "db_id": self.db_id_fn(db_name)})
+
+    def block_writes(self, db_name: str, session: Session):
+        session.execute(text("SELECT pg_advisory_xact_lock(:lock_class, :db_id)"),
+                        {"lock_class": WRITE_FENCE_LOCK_CLASS, "db_id": self.db_id_fn(db_name)})
+
+    def index_target(self, db_name: str, conn) -> tuple:
+        # indexes of a partitioned table cannot be built concurrently, they go on the partition of the db
+        db_id = self.db_id_fn(db_name)
+        partitions = conn.execute(text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = CAST(:table AS regclass)"
+        ), {"table": SharedJsonData.__tablename__}).fetchall()
+        for name, bound in partitions:
+            modulus, remainder = re.search(r"modulus (\d+), remainder (\d+)", bound).groups()
+            if conn.execute(text("SELECT satisfies_hash_partition(CAST(:table AS regclass), :m, :r, :db_id)"), {
+                "table": SharedJsonData.__tablename__, "m": int(modulus), "r": int(remainder), "db_id": db_id
+            }).scalar():
+                return name, "db_id = %d" % db_id
+        raise ValueError("No partition for db: %s" % db_name)
+
+    def create_db(self, db_name: str, session: Session, durability: str = DURABLE, incoming: bool = False) -> int:
+        if durability == UNLOGGED:
+            raise ValueError("Dbs of the shared layout cannot be unlogged")
+        return create_shared_json_db(db_name, session, durability, incoming)
+
+    def set_durability(self, db_name: str, durability: str, previous: str, session: Session):
+        # the partitions hold the rows of many dbs
+        if durability == UNLOGGED:
+            raise ValueError("Dbs of the shared layout cannot be unlogged")
+        set_json_db_durability(db_name, durability, session)
+
+    def remove_db(self, db_name: str, session: Session):
+        remove_shared_json_db(db_name, session)
+
+
+def get_layout(storage_settings: dict, db_id_fn) -> TablePerDbLayout:
+    layout = storage_settings.get("layout", LAYOUT_TABLE_PER_DB)
+    if layout == LAYOUT_TABLE_PER_DB:
+        return TablePerDbLayout(db_id_fn)
+    elif layout == LAYOUT_SHARED:
+        return SharedLayout(db_id_fn, storage_settings.get("shared_partitions", DEFAULT_SHARED_PARTITIONS))
+    raise ValueError("Unknown storage layout: %s" % layout)
@@ -0,0 +1,114 @@
+import json
+import threading
+
+import psycopg2
+
+from .models import META_CHANNEL
+from ..base import DURABLE
+
+__all__ = ["DbMetaCache"]
+
+
+class DbMetaCache(object):
+    """
+        Names, ids, durability and incoming dbs, loaded once at startup and kept in sync
+        with other processes through NOTIFY on META_CHANNEL.
+        While in sync, a name missing from the cache does not exist, so
+        looking up a db never needs a query.
+    """
+
+    def __init__(self, conn, on_delete=None):
+        self.conn = conn
+        self.on_delete = on_delete
+        self.db_ids = {}
+        # dbs that are not DURABLE
+        self.durability = {}
+        # dbs being moved in from another shard
+        self.incoming = set()
+        self.synced = False
+        self.listen_thread = None  # type: threading.Thread
+        self.__thread_kill = False
+
+    def start(self):
+        conn = self.conn
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            # listen before loading, a change committed in between is not lost
+            cursor.execute("LISTEN %s;" % META_CHANNEL)
+            cursor.execute("SELECT db_name, id, durability, incoming FROM storage_meta")
+            rows = cursor.fetchall()
+            self.db_ids = dict((db_name, db_id) for db_name, db_id, _, _ in rows)
+            self.durability = dict((db_name, durability) for db_name, _, durability, _ in rows
+                                   if durability != DURABLE)
+            self.incoming = set(db_name for db_name, _, _, incoming in rows if incoming)
+        self.synced = True
+        self.listen_thread = threading.Thread(target=self.__listen, daemon=True)
+        self.listen_thread.start()
+
+    def __listen(self):
+        import select
+
+        conn = self.conn
+        try:
+            while not self.__thread_kill:
+                if select.select([conn], [], [], 1) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    payload = json.loads(notify.payload)
+                    if payload['event'] == 'create':
+                        self.added(payload['db_name'], payload['db_id'], payload.get('durability'),
+                                   payload.get('incoming', False))
+                    elif payload['event'] == 'delete':
+                        self.removed(payload['db_name'])
+                    elif payload['event'] == 'durability':
+                        self.durability_changed(payload['db_name'], payload['durability'])
+                    elif payload['event'] == 'activate':
+                        self.activated(payload['db_name'])
+        except (psycopg2.Error, OSError):
+            # notifications may be lost from here on, callers fall back to querying
+            self.synced = False
+
+    def added(self, db_name: str, db_id: int, durability: str = None, incoming: bool = False):
+        self.db_ids[db_name] = db_id
+        self.durability_changed(db_name, durability)
+        if incoming:
+            self.incoming.add(db_name)
+        else:
+            self.incoming.discard(db_name)
+
+    def activated(self, db_name: str):
+        self.incoming.discard(db_name)
+
+    def removed(self, db_name: str):
+        self.db_ids.pop(db_name, None)
+        self.durability.pop(db_name, None)
+        self.incoming.discard(db_name)
+        if self.on_delete:
+            self.on_delete(db_name)
+
+    def durability_changed(self, db_name: str, durability: str):
+        if durability and durability != DURABLE:
+            self.durability[db_name] = durability
+        else:
+            self.durability.pop(db_name, None)
+
+    def id_of(self, db_name: str):
+        return self.db_ids.get(db_name)
+
+    def durability_of(self, db_name: str) -> str:
+        return self.durability.get(db_name, DURABLE)
+
+    def is_incoming(self, db_name: str) -> bool:
+        return db_name in self.incoming
+
+    def __contains__(self, db_name: str):
+        return db_name in self.db_ids
+
+    def close(self):
+        if self.listen_thread is not None and not self.__thread_kill:
+            self.__thread_kill = True
+            self.listen_thread.join()
+        self.synced = False
+        self.conn.close()
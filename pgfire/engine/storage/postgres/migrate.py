@@ -0,0 +1,55 @@
+"""
+    Moves json dbs from the table-per-db layout to the shared layout.
+
+    Stop the servers, switch "layout" to "shared" in the db section of
+    config.json, then run
+        python -m pgfire.engine.storage.postgres.migrate
+    Every db is moved in its own transaction, running it again resumes
+    with the dbs that still have a table.
+"""
+from sqlalchemy import text
+
+from . import PostgresJsonStorage
+from .layouts import LAYOUT_SHARED
+from .models import *
+from ..base import ASYNC_COMMIT, UNLOGGED
+from ..utils import session_scope
+
+__all__ = ["migrate_to_shared_layout"]
+
+
+def migrate_to_shared_layout(storage_settings: dict, log=print) -> list:
+    """
+    :param storage_settings: db settings of the deployment
+    :param log: called with a progress message for every db
+    :return: names of the dbs moved
+    """
+    storage_settings = dict(storage_settings, layout=LAYOUT_SHARED)
+    moved = []
+    with PostgresJsonStorage(storage_settings) as storage:
+        session = storage.session
+        for meta_entry in session.query(StorageMeta).order_by(StorageMeta.id).all():
+            db_id, db_name = meta_entry.id, meta_entry.db_name
+            if session.execute(text("SELECT to_regclass(:t)"), {"t": '"%s"' % db_name}).scalar() is None:
+                continue
+            with session_scope(session):
+                # writers of a table-per-db server still running would be lost
+                session.execute(text('LOCK TABLE "%s" IN ACCESS EXCLUSIVE MODE' % db_name))
+                rows = session.execute(text(
+                    'INSERT INTO {0} (db_id, l1_key, data, size, size_change, created, last_modified) '
+                    'SELECT :db_id, l1_key, data, size, size_change, created, last_modified FROM "{1}"'
+                    .format(SharedJsonData.__tablename__, db_name)
+                ), {"db_id": db_id}).rowcount
+                session.execute(text('DROP TABLE "%s"' % db_name))
+                if meta_entry.durability == UNLOGGED:
+                    # the shared partitions are logged, the writes of the db still skip the WAL flush
+                    meta_entry.durability = ASYNC_COMMIT
+            forget_json_db_cls(db_name)
+            log("moved %s: %s rows" % (db_name, rows))
+            moved.append(db_name)
+    return moved
+
+
+if __name__ == "__main__":
+    from pgfire.conf import config
+    migrate_to_shared_layout(config['db'])
@@ -1,15 +1,29 @@
-from sqlalchemy import Column, DateTime, String, Integer, func
+import json
+import threading
+import warnings
+
+from sqlalchemy import Column, BigInteger, Boolean, DateTime, String, Integer, Text, ForeignKey, Index, func, text
+from sqlalchemy.exc import SAWarning
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
+from ..base import DURABLE, UNLOGGED
 from ..utils import session_scope
 
 JSON_DB_CLS = {}
+# held while JSON_DB_CLS and Base.metadata change, the meta cache forgets dbs from its listener thread
+JSON_DB_CLS_LOCK = threading.Lock()
+# create and delete of json dbs are announced on this channel
+META_CHANNEL = "pgfire_storage_meta"
 
-__all__ = ["Base",
-           "StorageMeta", "create_json_db_table", "get_json_db_cls", "remove_json_db_table"]
+__all__ = ["Base", "SharedBase", "META_CHANNEL",
+           "StorageMeta", "PathExpiry", "JsonDbStats", "create_json_db_table", "get_json_db_cls", "remove_json_db_table",
+           "forget_json_db_cls", "SharedJsonData", "create_shared_json_data_table",
+           "create_shared_json_db", "add_size_columns_sql", "remove_shared_json_db", "set_json_db_durability", "activate_json_db"]
 
 Base = declarative_base()
+# tables of the shared layout, only created when a deployment selects it
+SharedBase = declarative_base()
 
 
 class StorageMeta(Base):
@@ -20,11 +34,43 @@ class StorageMeta(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     db_name = Column(String(255), unique=True, nullable=False)
     created = Column(DateTime, default=func.now())
+    # one of DURABILITY_LEVELS
+    durability = Column(String(16), nullable=False, default=DURABLE, server_default=DURABLE)
+    # being moved in from another shard, requests still go to the other one
+    incoming = Column(Boolean, nullable=False, default=False, server_default=text("false"))
 
     def __repr__(self):
         return '({}, {})'.format(self.id, self.db_name)
 
 
+class PathExpiry(Base):
+    """
+        Deadline of a path written with a ttl, the sweeper deletes the
+        path once it passed. Deadlines go with their db.
+    """
+    __tablename__ = "path_expiry"
+    __table_args__ = (Index("path_expiry_expires", "expires"),)
+    db_id = Column(Integer, ForeignKey(StorageMeta.id, ondelete="CASCADE"), primary_key=True)
+    path = Column(Text, primary_key=True)
+    expires = Column(DateTime(timezone=True), nullable=False)
+
+
+class JsonDbStats(Base):
+    """
+        Counters of a json db maintained by its writes, see DbStats.
+        minute_writes counts the writes of minute, last_minute_writes
+        those of the minute before it.
+    """
+    __tablename__ = "db_stats"
+    db_id = Column(Integer, ForeignKey(StorageMeta.id, ondelete="CASCADE"), primary_key=True)
+    rows = Column(BigInteger, nullable=False, server_default=text("0"))
+    bytes = Column(BigInteger, nullable=False, server_default=text("0"))
+    writes = Column(BigInteger, nullable=False, server_default=text("0"))
+    minute = Column(DateTime(timezone=True))
+    minute_writes = Column(BigInteger, nullable=False, server_default=text("0"))
+    last_minute_writes = Column(BigInteger, nullable=False, server_default=text("0"))
+
+
 class BaseJsonDbTable(Base):
     """
         {
@@ -46,41 +92,149 @@ class BaseJsonDbTable(Base):
     l1_key = Column(String(255), primary_key=True)
     # all data will go here
     data = Column(JSONB)
+    # pg_column_size of data when it was written, and how much the last write changed it,
+    # NULL when it inserted the row. Kept by the write statements for the db stats
+    size = Column(Integer)
+    size_change = Column(Integer)
+
+    created = Column(DateTime, default=func.now())
+    last_modified = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class SharedJsonData(SharedBase):
+    """
+        All json dbs in one table, keyed by (db_id, l1_key).
+        db_id is the id of the db in storage_meta, rows are spread over
+        hash partitions of db_id so that each db lives in one partition.
+    """
+    __tablename__ = "json_data"
+    __table_args__ = {"postgresql_partition_by": "HASH (db_id)"}
+    db_id = Column(Integer, primary_key=True, autoincrement=False)
+    l1_key = Column(String(255), primary_key=True)
+    data = Column(JSONB)
+    # pg_column_size of data when it was written, and how much the last write changed it,
+    # NULL when it inserted the row. Kept by the write statements for the db stats
+    size = Column(Integer)
+    size_change = Column(Integer)
 
     created = Column(DateTime, default=func.now())
     last_modified = Column(DateTime, default=func.now(), onupdate=func.now())
 
 
 def get_json_db_cls(db_name: str) -> BaseJsonDbTable:
-    if db_name in JSON_DB_CLS:
-        return JSON_DB_CLS[db_name]
+    cls = JSON_DB_CLS.get(db_name)
+    if cls is not None:
+        return cls
 
     class_name = db_name
     table_name = db_name
-    cls = type(class_name, (BaseJsonDbTable,), {"__tablename__": table_name})
-    JSON_DB_CLS[db_name] = cls
+    with JSON_DB_CLS_LOCK:
+        if db_name in JSON_DB_CLS:
+            return JSON_DB_CLS[db_name]
+        with warnings.catch_warnings():
+            # a db deleted and created again replaces its forgotten class by name
+            warnings.simplefilter("ignore", SAWarning)
+            cls = type(class_name, (BaseJsonDbTable,), {"__tablename__": table_name})
+        JSON_DB_CLS[db_name] = cls
     return cls
 
 
-def create_json_db_table(db_name: str, sa: Session) -> BaseJsonDbTable:
+def forget_json_db_cls(db_name: str):
+    """
+    drop the mapped class of a deleted json db
+    """
+    with JSON_DB_CLS_LOCK:
+        cls = JSON_DB_CLS.pop(db_name, None)
+        if cls is not None:
+            Base.metadata.remove(cls.__table__)
+
+
+def create_json_db_table(db_name: str, sa: Session, durability: str = DURABLE, incoming: bool = False) -> int:
     cls = get_json_db_cls(db_name)
     with session_scope(sa) as session:
-        cls.metadata.create_all(session.bind)
-        add_json_db_entry_to_meta(db_name, session)
-    return cls
+        cls.__table__.create(bind=session.connection(), checkfirst=True)
+        if durability == UNLOGGED:
+            session.execute('ALTER TABLE "%s" SET UNLOGGED' % db_name)
+        db_id = add_json_db_entry_to_meta(db_name, session, durability, incoming)
+        notify_meta_change('create', db_name, db_id, session, durability, incoming)
+    return db_id
 
 
 def remove_json_db_table(db_name: str, sa: Session):
     cls = get_json_db_cls(db_name)
     with session_scope(sa) as session:
-        remove_json_db_entry_from_meta(db_name, session)
-        cls.__table__.drop(bind=session.bind)
+        db_id = remove_json_db_entry_from_meta(db_name, session)
+        cls.__table__.drop(bind=session.connection())
+        notify_meta_change('delete', db_name, db_id, session)
+    forget_json_db_cls(db_name)
+
+
+def create_shared_json_data_table(partitions: int, conn):
+    table = SharedJsonData.__table__
+    table.create(bind=conn, checkfirst=True)
+    for remainder in range(partitions):
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS {0}_p{1} PARTITION OF {0} '
+            'FOR VALUES WITH (MODULUS {2}, REMAINDER {1})'.format(table.name, remainder, partitions)
+        ))
+    # columns added after the first release
+    conn.execute(text(add_size_columns_sql(table.name)))
+
+
+def add_size_columns_sql(table_name: str) -> str:
+    return ('ALTER TABLE IF EXISTS "%s" ADD COLUMN IF NOT EXISTS size integer, '
+            'ADD COLUMN IF NOT EXISTS size_change integer' % table_name.replace('"', '""'))
+
+
+def create_shared_json_db(db_name: str, sa: Session, durability: str = DURABLE, incoming: bool = False) -> int:
+    with session_scope(sa) as session:
+        db_id = add_json_db_entry_to_meta(db_name, session, durability, incoming)
+        notify_meta_change('create', db_name, db_id, session, durability, incoming)
+    return db_id
+
+
+def remove_shared_json_db(db_name: str, sa: Session):
+    with session_scope(sa) as session:
+        db_id = remove_json_db_entry_from_meta(db_name, session)
+        session.query(SharedJsonData).filter(SharedJsonData.db_id == db_id).delete()
+        notify_meta_change('delete', db_name, db_id, session)
+
+
+def set_json_db_durability(db_name: str, durability: str, sa: Session):
+    with session_scope(sa) as session:
+        meta_entry = session.query(StorageMeta).filter(StorageMeta.db_name == db_name).one()
+        meta_entry.durability = durability
+        notify_meta_change('durability', db_name, meta_entry.id, session, durability)
+
+
+def activate_json_db(db_name: str, sa: Session):
+    """
+    an incoming db takes the requests from now on
+    """
+    with session_scope(sa) as session:
+        meta_entry = session.query(StorageMeta).filter(StorageMeta.db_name == db_name).one()
+        meta_entry.incoming = False
+        notify_meta_change('activate', db_name, meta_entry.id, session)
+
+
+def notify_meta_change(event: str, db_name: str, db_id: int, sa: Session, durability: str = None,
+                       incoming: bool = False):
+    # delivered to listeners when the transaction commits
+    sa.execute(func.pg_notify(
+        META_CHANNEL,
+        json.dumps({"event": event, "db_name": db_name, "db_id": db_id, "durability": durability,
+                    "incoming": incoming})
+    ))
 
 
-def add_json_db_entry_to_meta(db_name: str, sa: Session):
-    meta_entry = StorageMeta(db_name=db_name)
+def add_json_db_entry_to_meta(db_name: str, sa: Session, durability: str = DURABLE, incoming: bool = False) -> int:
+    meta_entry = StorageMeta(db_name=db_name, durability=durability, incoming=incoming)
     sa.add(meta_entry)
+    sa.flush()
+    return meta_entry.id
 
 
-def remove_json_db_entry_from_meta(db_name: str, sa: Session):
-    sa.delete(sa.query(StorageMeta).filter(StorageMeta.db_name == db_name).one())
+def remove_json_db_entry_from_meta(db_name: str, sa: Session) -> int:
+    meta_entry = sa.query(StorageMeta).filter(StorageMeta.db_name == db_name).one()
+    sa.delete(meta_entry)
+    return meta_entry.id
@@ -0,0 +1,201 @@
+"""
+    Moves a json db to another shard while it is read and written.
+        python -m pgfire.engine.storage.postgres.move_db <db_name> <shard name>
+    The db is created on the target shard as incoming, requests keep going to
+    the source. Its rows are copied while the changes notified meanwhile are
+    copied again. At the switch, writes of the db wait on the source for as long
+    as it takes to copy the last changes, on a lock of its table or, in the
+    shared layout, on the lock of the db every write takes. Then the target
+    takes the requests and the db is removed from the source. Writes that waited
+    fail and are retried on the target.
+    Event streams of the db get a "moved" event and must be opened again.
+"""
+import argparse
+import json
+import time
+
+from sqlalchemy import text
+
+from .layouts import LAYOUT_SHARED
+from .replicas import PRIMARY_LSN_QUERY
+from .shards import ShardedJsonStorage
+
+__all__ = ["move_db", "DbMover", "DEFAULT_MOVE_PAGE_SIZE", "DEFAULT_SWITCH_KEYS"]
+
+DEFAULT_MOVE_PAGE_SIZE = 500
+# changed l1_keys left to copy again before writes are blocked for the switch
+DEFAULT_SWITCH_KEYS = 100
+MAX_CATCH_UP_ROUNDS = 20
+# wait for the "moved" event sent once writes are blocked
+SWITCH_TIMEOUT = 30.0
+MOVED_EVENT = "moved"
+
+EXPIRY_OF_DB_SQL = "SELECT path, expires FROM path_expiry WHERE db_id = :db_id"
+COPY_EXPIRY_SQL = """INSERT INTO path_expiry (db_id, path, expires) VALUES (:db_id, :path, :expires)
+ON CONFLICT (db_id, path) DO UPDATE SET expires = excluded.expires"""
+
+
+class DbMover(object):
+    """
+        Copies db_name from the source shard to the target shard, then switches it over
+    """
+
+    def __init__(self, storage: ShardedJsonStorage, db_name: str, target_name: str,
+                 page_size: int = DEFAULT_MOVE_PAGE_SIZE, switch_keys: int = DEFAULT_SWITCH_KEYS, log=print):
+        if target_name not in storage.shards:
+            raise ValueError("Unknown shard: %s" % target_name)
+        self.source = storage.hosting_shard(db_name, fresh=True)
+        if self.source is None:
+            raise ValueError("Json db does not exist: %s" % db_name)
+        self.target = storage.shards[target_name]
+        if self.source is self.target:
+            raise ValueError("Json db %s is already on shard %s" % (db_name, target_name))
+        self.db_name = db_name
+        self.target_name = target_name
+        self.page_size = page_size
+        self.switch_keys = switch_keys
+        self.log = log
+        self.events = None
+        # l1_keys changed on the source since they were copied
+        self.dirty = set()
+        self.root_changed = False
+        self.copied = 0
+
+    def move(self) -> int:
+        """
+        :return: number of l1_keys copied, copies of changed keys included
+        """
+        source, target, db_name = self.source, self.target, self.db_name
+        indexes = [index["order_by"] for index in source.list_indexes(db_name)]
+        with source.get_notifier(db_name, '') as notifier:
+            # listening before the copy, no change made meanwhile is missed
+            self.events = notifier.listen()
+            target.create_db(db_name, source.db_meta.durability_of(db_name), incoming=True)
+            try:
+                self.__copy_all()
+                self.log("copied %s: %s keys" % (db_name, self.copied))
+                for order_by in indexes:
+                    target.create_index(db_name, order_by)
+                for _ in range(MAX_CATCH_UP_ROUNDS):
+                    self.__drain()
+                    if len(self.dirty) <= self.switch_keys and not self.root_changed:
+                        break
+                    self.__copy_changes()
+                self.__switch()
+            except Exception:
+                if target.hosts_db(db_name, fresh=True) is False and db_name in target.db_meta:
+                    # still incoming, the source was left as it was
+                    target.delete_db(db_name)
+                raise
+        if source.layout.name == LAYOUT_SHARED:
+            # indexes of the table-per-db layout went with the table
+            for order_by in indexes:
+                source.drop_index(db_name, order_by)
+        self.log("moved %s to %s" % (db_name, self.target_name))
+        return self.copied
+
+    def __drain(self, until_moved: bool = False):
+        """
+        marks the l1_keys of the changes notified so far, until the "moved" event when until_moved
+        """
+        deadline = time.time() + SWITCH_TIMEOUT
+        for event in self.events:
+            if event is None:
+                if not until_moved:
+                    return
+                if time.time() > deadline:
+                    raise TimeoutError("No %s event for db: %s" % (MOVED_EVENT, self.db_name))
+                time.sleep(0.01)
+            elif event['event'] == MOVED_EVENT:
+                if until_moved:
+                    return
+            elif event['path']:
+                self.dirty.add(event['path'].split('/')[0])
+            else:
+                self.root_changed = True
+
+    def __primary_lsn(self):
+        # reads served by a replica must include every change notified so far
+        return self.source.engine.scalar(PRIMARY_LSN_QUERY) if self.source.replicas else None
+
+    def __copy_all(self):
+        min_lsn = self.__primary_lsn()
+        self.root_changed = False
+        self.dirty.clear()
+        after = None
+        with self.target.children_writer(self.db_name, '', 'put') as writer:
+            while True:
+                page, after = self.source.get_page_from_path(self.db_name, '', self.page_size, after, min_lsn)
+                writer.write(page)
+                self.copied += len(page)
+                if after is None:
+                    break
+
+    def __copy_changes(self):
+        if self.root_changed:
+            self.__copy_all()
+            return
+        min_lsn = self.__primary_lsn()
+        keys, self.dirty = self.dirty, set()
+        for key in sorted(keys):
+            value = self.source.get_from_path(self.db_name, key, min_lsn)
+            if value is None:
+                self.target.delete_at_path(self.db_name, key)
+            else:
+                self.target.put_at_path(self.db_name, key, value)
+        self.copied += len(keys)
+
+    def __switch(self):
+        source, target, db_name = self.source, self.target, self.db_name
+        session = source.session_maker()
+        try:
+            # reads go on, writes wait until the db is removed
+            source.layout.block_writes(db_name, session)
+            with source.engine.connect() as conn:
+                # notified after every write committed before the lock
+                conn.execution_options(autocommit=True).execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {"channel": db_name,
+                     "payload": json.dumps({"event": MOVED_EVENT, "path": [], "data": self.target_name})}
+                )
+            self.__drain(until_moved=True)
+            self.__copy_changes()
+            self.__copy_expiry(session)
+            target.activate_db(db_name)
+        except Exception:
+            session.rollback()
+            session.close()
+            raise
+        try:
+            source.access_stats.forget(db_name)
+            source.layout.remove_db(db_name, session)
+            source.db_meta.removed(db_name)
+        finally:
+            session.close()
+
+    def __copy_expiry(self, session):
+        deadlines = session.execute(text(EXPIRY_OF_DB_SQL), {"db_id": self.source.db_meta.id_of(self.db_name)})
+        db_id = self.target.db_meta.id_of(self.db_name)
+        with self.target.engine.begin() as conn:
+            for path, expires in deadlines.fetchall():
+                conn.execute(text(COPY_EXPIRY_SQL), {"db_id": db_id, "path": path, "expires": expires})
+
+
+def move_db(storage_settings: dict, db_name: str, target_name: str,
+            page_size: int = DEFAULT_MOVE_PAGE_SIZE, log=print) -> int:
+    """
+    :param storage_settings: db settings of the deployment, with its "shards"
+    :param target_name: name of the shard to move db_name to
+    :return: number of l1_keys copied
+    """
+    with ShardedJsonStorage(storage_settings) as storage:
+        return DbMover(storage, db_name, target_name, page_size, log=log).move()
+
+
+if __name__ == "__main__":
+    from pgfire.conf import config
+    parser = argparse.ArgumentParser(description="Move a json db to another shard")
+    parser.add_argument("db_name")
+    parser.add_argument("shard")
+    args = parser.parse_args()
+    move_db(config['db'], args.db_name, args.shard)
@@ -0,0 +1,120 @@
+import time
+
+import sqlalchemy
+from sqlalchemy.orm.session import Session
+
+__all__ = ["Replica", "ReplicaSet", "lsn_to_int", "PRIMARY_LSN_QUERY",
+           "DEFAULT_MAX_REPLICA_LAG_BYTES", "DEFAULT_REPLICA_CHECK_INTERVAL"]
+
+# replay position of a standby, or the current wal position when the
+# configured endpoint is not in recovery (zero lag by definition)
+REPLAY_LSN_QUERY = "SELECT CASE WHEN pg_is_in_recovery() " \
+                   "THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END"
+PRIMARY_LSN_QUERY = "SELECT pg_current_wal_lsn()"
+
+DEFAULT_MAX_REPLICA_LAG_BYTES = 16 * 1024 * 1024
+DEFAULT_REPLICA_CHECK_INTERVAL = 1.0
+
+
+def lsn_to_int(lsn):
+    """
+    converts a postgres LSN to an integer, so that positions can be compared.
+    :param lsn: like '16/B374D848'
+    :return: integer position or None
+    """
+    if not lsn:
+        return None
+    hi, lo = str(lsn).split('/')
+    return (int(hi, 16) << 32) | int(lo, 16)
+
+
+class Replica(object):
+    """
+        A read only endpoint and the last replay position seen on it
+    """
+
+    def __init__(self, name: str, engine):
+        from sqlalchemy.orm import sessionmaker
+        self.name = name
+        self.engine = engine
+        self.session = sessionmaker(bind=engine)()  # type: Session
+        self.replay_lsn = None
+        self.healthy = False
+
+    def refresh(self):
+        try:
+            self.replay_lsn = lsn_to_int(self.engine.scalar(REPLAY_LSN_QUERY))
+        except sqlalchemy.exc.DBAPIError:
+            self.replay_lsn = None
+        return self.replay_lsn
+
+    def has_replayed(self, lsn: int) -> bool:
+        if self.replay_lsn is not None and self.replay_lsn >= lsn:
+            return True
+        # cached position is stale, ask once more before giving up
+        replay_lsn = self.refresh()
+        return replay_lsn is not None and replay_lsn >= lsn
+
+    def close(self):
+        self.session.close()
+        self.engine.dispose()
+
+
+class ReplicaSet(object):
+    """
+        Routes reads to streaming replicas.
+        Replicas whose replay position is behind the primary by more than
+        max_lag_bytes are kept out of rotation until they catch up.
+    """
+
+    def __init__(self, primary_engine, replicas: list,
+                 max_lag_bytes: int = DEFAULT_MAX_REPLICA_LAG_BYTES,
+                 check_interval: float = DEFAULT_REPLICA_CHECK_INTERVAL):
+        self.primary_engine = primary_engine
+        self.replicas = replicas
+        self.max_lag_bytes = max_lag_bytes
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.next_replica = 0
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def check_health(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        primary_lsn = lsn_to_int(self.primary_engine.scalar(PRIMARY_LSN_QUERY))
+        for replica in self.replicas:
+            replay_lsn = replica.refresh()
+            replica.healthy = replay_lsn is not None and \
+                primary_lsn - replay_lsn <= self.max_lag_bytes
+
+    def choose(self, min_lsn: str = None):
+        """
+        picks the next healthy replica in round robin order.
+        :param min_lsn: the replica must have replayed at least this position
+        :return: Replica or None, if the read should go to the primary
+        """
+        if not self.replicas:
+            return None
+        self.check_health()
+        min_lsn = lsn_to_int(min_lsn)
+        count = len(self.replicas)
+        for i in range(count):
+            replica = self.replicas[(self.next_replica + i) % count]
+            if not replica.healthy:
+                continue
+            if min_lsn is not None and not replica.has_replayed(min_lsn):
+                continue
+            self.next_replica = (self.next_replica + i + 1) % count
+            return replica
+        return None
+
+    def mark_failed(self, replica: Replica):
+        replica.healthy = False
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
@@ -0,0 +1,99 @@
+import os
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, String, Integer, func, text
+from sqlalchemy.schema import DDL
+
+from .models import Base, StorageMeta, PathExpiry, JsonDbStats, add_size_columns_sql
+from ..utils import read_file
+
+__all__ = ["SchemaVersion", "SCHEMA_VERSION", "DB_STATS_SCHEMA_VERSION", "CORE_SCHEMA",
+           "installed_schema", "install_schema", "install_core_schema"]
+
+JSONB_DEEP_SET_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "jsonb_set_deep.sql")
+ATOMIC_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "jsonb_atomic_apply.sql")
+DELETE_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "jsonb_delete_prune.sql")
+PROJECT_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "jsonb_project.sql")
+NOTIFY_PAYLOAD_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "json_notify_payload.sql")
+NOTIFY_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "json_notify.sql")
+WRITE_FENCE_FUNCTION_FILE = os.path.join(os.path.dirname(__file__), "json_db_fence.sql")
+DROPPED_FUNCTIONS_FILE = os.path.join(os.path.dirname(__file__), "drop_json_data_notify.sql")
+
+# bump when a table of Base or one of the function files changes
+SCHEMA_VERSION = 13
+# first version keeping db_stats, older installs count the rows of their dbs once
+DB_STATS_SCHEMA_VERSION = 10
+CORE_SCHEMA = "core"
+
+FUNCTION_FILES = [
+    JSONB_DEEP_SET_FUNCTION_FILE,
+    ATOMIC_FUNCTION_FILE,
+    DELETE_FUNCTION_FILE,
+    PROJECT_FUNCTION_FILE,
+    NOTIFY_PAYLOAD_FUNCTION_FILE,
+    NOTIFY_FUNCTION_FILE,
+    WRITE_FENCE_FUNCTION_FILE,
+    DROPPED_FUNCTIONS_FILE,
+]
+
+# serializes schema installs of workers starting together
+SCHEMA_LOCK_ID = 0x70676669
+
+
+class SchemaVersion(Base):
+    """
+        Installed version of each schema component, core functions and
+        tables or the tables of a storage layout
+    """
+    __tablename__ = "pgfire_schema"
+    component = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False)
+    installed = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+def installed_schema(engine) -> dict:
+    """
+    :return: {component: version}, empty before the first install
+    """
+    try:
+        return dict(engine.execute(text("SELECT component, version FROM pgfire_schema")).fetchall())
+    except sqlalchemy.exc.ProgrammingError:
+        return {}
+
+
+def install_schema(engine, component: str, version: int, install_fn):
+    """
+    runs install_fn(connection) in a transaction, unless another worker
+    installed this version while we waited for the lock. A newer version is
+    kept, workers of the previous release keep running during a rolling deploy.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": SCHEMA_LOCK_ID})
+        if component == CORE_SCHEMA:
+            Base.metadata.create_all(conn, tables=[SchemaVersion.__table__])
+        installed = conn.execute(
+            text("SELECT version FROM pgfire_schema WHERE component = :c"), {"c": component}
+        ).scalar()
+        if installed is not None and installed >= version:
+            return
+        install_fn(conn)
+        conn.execute(text(
+            "INSERT INTO pgfire_schema (component, version, installed) VALUES (:c, :v, now()) "
+            "ON CONFLICT (component) DO UPDATE SET version = :v, installed = now()"
+        ), {"c": component, "v": version})
+
+
+def install_core_schema(conn):
+    Base.metadata.create_all(conn, tables=[StorageMeta.__table__, PathExpiry.__table__, JsonDbStats.__table__])
+    # columns added after the first release
+    conn.execute(text("ALTER TABLE storage_meta ADD COLUMN IF NOT EXISTS "
+                      "durability varchar(16) NOT NULL DEFAULT 'durable'"))
+    conn.execute(text("ALTER TABLE storage_meta ADD COLUMN IF NOT EXISTS "
+                      "incoming boolean NOT NULL DEFAULT false"))
+    # deadlines below a path are a range of this index, see expiry.clear_expiry
+    conn.execute(text('CREATE INDEX IF NOT EXISTS path_expiry_subtree ON path_expiry (db_id, path COLLATE "C")'))
+    # tables of the dbs of the table per db layout, the shared table adds them on its own install
+    for (db_name,) in conn.execute(text("SELECT db_name FROM storage_meta")).fetchall():
+        conn.execute(text(add_size_columns_sql(db_name)))
+    for file_name in FUNCTION_FILES:
+        conn.execute(DDL(read_file(file_name)))
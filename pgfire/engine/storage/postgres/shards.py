@@ -0,0 +1,201 @@
+"""
+    Json dbs spread over several postgres clusters. A db lives on the shard
+    whose storage_meta holds it, new dbs are placed by rendezvous hashing of
+    their name over the shard names, so adding a shard only changes the
+    placement of dbs created afterwards.
+        "shards": [{"name": "pg1", "host": "pg1"}, {"name": "pg2", "host": "pg2"}]
+    Settings missing from a shard are taken from the db section, except
+    "replicas" which are given per shard.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy
+
+from . import PostgresJsonStorage
+from ..base import *
+
+__all__ = ["ShardedJsonStorage"]
+
+# settings of the db section that are not shared by the shards
+_OWN_SETTINGS = ("shards", "replicas")
+
+
+class ShardedJsonStorage(BaseJsonStorage):
+    """
+        Routes the calls of each db to the PostgresJsonStorage of its shard.
+        A call failing because its db just moved away is retried on the new shard.
+    """
+    vendor = "postgresql"
+
+    def __init__(self, storage_settings: dict):
+        super().__init__(storage_settings)
+        shared = dict((key, value) for key, value in storage_settings.items() if key not in _OWN_SETTINGS)
+        self.shards = OrderedDict()  # type: OrderedDict[str, PostgresJsonStorage]
+        try:
+            for shard_settings in storage_settings["shards"]:
+                shard_settings = dict(shared, **shard_settings)
+                name = shard_settings.get("name") or "%s:%s/%s" % (
+                    shard_settings.get("host"), shard_settings.get("port"), shard_settings.get("db"))
+                if name in self.shards:
+                    raise ValueError("Duplicate shard: %s" % name)
+                self.shards[name] = PostgresJsonStorage(shard_settings)
+        except Exception:
+            self.close()
+            raise
+        if not self.shards:
+            raise ValueError("No shards configured")
+        # shard of the last write, its LSN is the position of that write
+        self.last_write_shard = None  # type: Optional[PostgresJsonStorage]
+
+    @property
+    def last_write_lsn(self):
+        return self.last_write_shard.last_write_lsn if self.last_write_shard is not None else None
+
+    @property
+    def group_commit(self) -> bool:
+        return any(shard.group_commit for shard in self.shards.values())
+
+    def home_shard(self, db_name: str) -> PostgresJsonStorage:
+        """
+        :return: the shard a new db is created on
+        """
+        name = max(self.shards, key=lambda shard_name: hashlib.md5(
+            ("%s/%s" % (shard_name, db_name)).encode("utf-8")).hexdigest())
+        return self.shards[name]
+
+    def hosting_shard(self, db_name: str, fresh: bool = False) -> Optional[PostgresJsonStorage]:
+        """
+        :param fresh: read storage_meta of the shards instead of their caches
+        :return: the shard db_name lives on, None when it does not exist
+        """
+        for shard in self.shards.values():
+            if shard.hosts_db(db_name, fresh):
+                return shard
+        return None
+
+    def shard_of(self, db_name: str, fresh: bool = False) -> PostgresJsonStorage:
+        return self.hosting_shard(db_name, fresh) or self.home_shard(db_name)
+
+    def __route(self, db_name: str, call):
+        """
+        :param call: call(shard) of the storage method
+        """
+        shard = self.shard_of(db_name)
+        try:
+            return call(shard)
+        except (ValueError, sqlalchemy.exc.DBAPIError):
+            # a move may have finished before the cache of the shard heard of it
+            moved_to = self.shard_of(db_name, fresh=True)
+            if moved_to is shard:
+                raise
+            return call(moved_to)
+
+    def __write(self, db_name: str, call):
+        def write(shard):
+            result = call(shard)
+            self.last_write_shard = shard
+            return result
+        return self.__route(db_name, write)
+
+    def get_from_path(self, db_name: str, path: str, min_lsn: str = None,
+                      fields: List[str] = None) -> JSON_PRIMITIVES:
+        return self.__route(db_name, lambda shard: shard.get_from_path(db_name, path, min_lsn, fields))
+
+    def get_page_from_path(self, db_name: str, path: str, limit: int, after: str = None,
+                           min_lsn: str = None, fields: List[str] = None) -> Tuple[dict, Optional[str]]:
+        return self.__route(db_name, lambda shard: shard.get_page_from_path(
+            db_name, path, limit, after, min_lsn, fields))
+
+    def query_from_path(self, db_name: str, path: str, order_by: str, start_at: JSON_PRIMITIVES = None,
+                        end_at: JSON_PRIMITIVES = None, limit_to_first: int = None, limit_to_last: int = None,
+                        min_lsn: str = None, fields: List[str] = None) -> dict:
+        return self.__route(db_name, lambda shard: shard.query_from_path(
+            db_name, path, order_by, start_at, end_at, limit_to_first, limit_to_last, min_lsn, fields))
+
+    def set_at_path(self, db_name: str,
+                    path: str,
+                    value: JSON_PRIMITIVES, op_type: str = 'put', report_changed: bool = False,
+                    ttl: float = None) -> JSON_PRIMITIVES:
+        return self.__write(db_name, lambda shard: shard.set_at_path(
+            db_name, path, value, op_type, report_changed, ttl))
+
+    def delete_at_path(self, db_name: str, path: str) -> bool:
+        return self.set_at_path(db_name, path, None, 'delete')
+
+    def sweep_expired(self) -> int:
+        return sum(shard.sweep_expired() for shard in self.shards.values())
+
+    def children_writer(self, db_name: str, path: str, op_type: str = 'put') -> JsonChildrenWriter:
+        shard = self.shard_of(db_name)
+        self.last_write_shard = shard
+        return shard.children_writer(db_name, path, op_type)
+
+    def optimize(self, db_name: str):
+        self.shard_of(db_name).optimize(db_name)
+
+    def create_db(self, db_name: str, durability: str = DURABLE) -> BaseJsonDb:
+        # creating an existing db fails on its shard as it would without shards
+        shard = self.shard_of(db_name, fresh=True)
+        shard.create_db(db_name, durability)
+        self.last_write_shard = shard
+        return BaseJsonDb(db_name, self)
+
+    def set_durability(self, db_name: str, durability: str):
+        self.__write(db_name, lambda shard: shard.set_durability(db_name, durability))
+
+    def delete_db(self, db_name: str) -> bool:
+        return self.__write(db_name, lambda shard: shard.delete_db(db_name))
+
+    def get_db(self, db_name: str) -> BaseJsonDb:
+        if self.hosting_shard(db_name) is not None:
+            return BaseJsonDb(db_name, self)
+
+    def get_notifier(self, db_name: str, path: str) -> BaseJsonChangeNotifier:
+        """
+        listens on the shard the db lives on now, a stream of a db moved
+        afterwards receives a "moved" event and must be opened again
+        """
+        return self.shard_of(db_name).get_notifier(db_name, path)
+
+    def get_all_dbs(self, min_lsn: str = None) -> List[str]:
+        all_dbs = []
+        for shard in self.shards.values():
+            # the write position only means something on the shard it came from
+            shard_lsn = min_lsn if shard is self.last_write_shard else None
+            all_dbs.extend(db_name for db_name in shard.get_all_dbs(shard_lsn) if shard.hosts_db(db_name))
+        return all_dbs
+
+    def get_db_stats(self) -> Dict[str, dict]:
+        stats = {}
+        for shard in self.shards.values():
+            # dbs being moved in are counted on the shard they come from
+            stats.update(shard.get_db_stats())
+        return stats
+
+    def recount_stats(self, db_names: List[str] = None):
+        for shard in self.shards.values():
+            shard.recount_stats(db_names)
+
+    def create_index(self, db_name: str, path: str) -> str:
+        return self.__route(db_name, lambda shard: shard.create_index(db_name, path))
+
+    def drop_index(self, db_name: str, path: str):
+        self.__route(db_name, lambda shard: shard.drop_index(db_name, path))
+
+    def list_indexes(self, db_name: str) -> List[dict]:
+        return self.__route(db_name, lambda shard: shard.list_indexes(db_name))
+
+    def advise_indexes(self, db_name: str, apply: bool = False) -> dict:
+        return self.__route(db_name, lambda shard: shard.advise_indexes(db_name, apply))
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
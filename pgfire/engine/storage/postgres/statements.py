@@ -0,0 +1,288 @@
+import hashlib
+import itertools
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+__all__ = ["WriteStatements", "table_write_statements", "shared_write_statements", "subtree_channel"]
+
+# prepared statements kept on one connection, least recently used are deallocated
+MAX_PREPARED_PER_CONNECTION = 512
+PREPARED_INFO_KEY = "pgfire_prepared"
+
+_statement_ids = itertools.count()
+
+# parameter types of each write, parameters selecting the db in a shared table follow these
+PUT_PARAMS = ['text', 'jsonb', 'text[]', 'jsonb']  # l1_key, insert_data, path, value
+PATCH_PARAMS = PUT_PARAMS
+ATOMIC_PARAMS = ['text', 'text[]', 'text', 'jsonb']  # l1_key, path, op, operand
+DELETE_PARAMS = ['text', 'text[]']  # l1_key, path
+REPLACE_PARAMS = PUT_PARAMS
+REPLACE_ROOT_PARAMS = ['jsonb']  # new value of the root
+PUT_CHILDREN_PARAMS = ['jsonb']  # children of the root, each replaces the row of its l1_key
+CLEAR_PARAMS = []
+
+# Every statement ends its rows with rows_delta and bytes_delta, how the change of the row changed
+# the number of rows of the db and their size, summed up by DbStats. A row keeps the pg_column_size
+# of its data as written in size, and the change of size made by the last write in size_change,
+# NULL when that write inserted the row. Rows written before these columns existed count their
+# stored size.
+OLD_SIZE = "COALESCE(t.size, pg_column_size(t.data))"
+
+# sets the data of the row to value, which is computed once
+SET_SIZED = """(data, last_modified, size, size_change) = (
+        SELECT v.data, now(), pg_column_size(v.data), pg_column_size(v.data) - %(old_size)s
+        FROM (SELECT %(value)s AS data OFFSET 0) AS v
+    )"""
+
+ROW_STATS = """CASE WHEN w.size_change IS NULL THEN 1 ELSE 0 END AS rows_delta,
+       COALESCE(w.size_change, w.size) AS bytes_delta"""
+
+
+def _set_sized(value: str) -> str:
+    return SET_SIZED % {"value": value, "old_size": OLD_SIZE}
+
+
+# a value equal to the stored one is not written, the statement then returns no row and notifies nothing
+PUT_SQL = """WITH w AS (
+    INSERT INTO {table} AS t ({key_cols}, data, created, last_modified, size)
+    VALUES ({key_vals}, $2, now(), now(), pg_column_size($2))
+    ON CONFLICT ({key_cols})
+    DO UPDATE SET %(set)s
+    WHERE t.data #> $3 IS DISTINCT FROM $4
+    RETURNING t.size, t.size_change
+)
+SELECT json_notify({channel}, $1, json_notify_payload('put', $3, $4)),
+       %(row_stats)s
+FROM w""" % {"set": _set_sized("jsonb_set_deep(t.data, $3, $4)"), "row_stats": ROW_STATS}
+
+PATCH_SQL = """WITH w AS (
+    INSERT INTO {table} AS t ({key_cols}, data, created, last_modified, size)
+    VALUES ({key_vals}, $2, now(), now(), pg_column_size($2))
+    ON CONFLICT ({key_cols})
+    DO UPDATE SET %(set)s
+    WHERE t.data #> $3 IS DISTINCT FROM CASE WHEN jsonb_typeof(t.data #> $3) = 'object'
+                                             THEN t.data #> $3 || $4 ELSE $4 END
+    RETURNING t.size, t.size_change
+)
+SELECT json_notify({channel}, $1, json_notify_payload('patch', $3, $4)),
+       %(row_stats)s
+FROM w""" % {"set": _set_sized("jsonb_set_deep(t.data, $3, CASE WHEN jsonb_typeof(t.data #> $3) = 'object' "
+                               "THEN t.data #> $3 || $4 ELSE $4 END)"),
+             "row_stats": ROW_STATS}
+
+# the row lock taken by ON CONFLICT DO UPDATE makes read-modify-write atomic
+ATOMIC_SQL = """WITH w AS (
+    INSERT INTO {table} AS t ({key_cols}, data, created, last_modified, size)
+    SELECT {key_vals}, v.data, now(), now(), pg_column_size(v.data)
+    FROM (SELECT jsonb_set_deep('{{}}'::jsonb, $2, jsonb_atomic_apply(NULL, $3, $4)) AS data OFFSET 0) AS v
+    ON CONFLICT ({key_cols})
+    DO UPDATE SET %(set)s
+    RETURNING t.data #> $2 AS result, t.size, t.size_change
+)
+SELECT result,
+       json_notify({channel}, $1, json_notify_payload('put', $2, result, $3)),
+       %(row_stats)s
+FROM w""" % {"set": _set_sized("jsonb_set_deep(t.data, $2, jsonb_atomic_apply(t.data #> $2, $3, $4))"),
+             "row_stats": ROW_STATS}
+
+# a row left empty is deleted instead of updated
+DELETE_SQL = """WITH u AS (
+    UPDATE {table} AS t SET %(set)s
+    WHERE {key_match} AND data #> $2 IS NOT NULL AND jsonb_delete_prune(data, $2) != '{{}}'::jsonb
+    RETURNING t.size_change
+), d AS (
+    DELETE FROM {table} AS t
+    WHERE {key_match} AND data #> $2 IS NOT NULL AND jsonb_delete_prune(data, $2) = '{{}}'::jsonb
+    RETURNING %(old_size)s AS size
+)
+SELECT json_notify({channel}, $1, json_notify_payload('delete', $2, NULL)), deleted.rows_delta, deleted.bytes_delta
+FROM (SELECT 0 AS rows_delta, u.size_change AS bytes_delta FROM u
+      UNION ALL
+      SELECT -1, -d.size FROM d) AS deleted""" % {"set": _set_sized("jsonb_delete_prune(t.data, $2)"),
+                                                  "old_size": OLD_SIZE}
+
+# rows are only rewritten when their data differs, a change event is sent for each child of path
+# that differs when the stored and the new value are both objects, else for path.
+# The stored value is read and locked before the upsert, which reads old for that.
+# The row stats are returned by the first event only
+REPLACE_SQL = """WITH old AS (
+    SELECT data #> $3 AS node FROM {table} WHERE {key_match} FOR UPDATE
+), w AS (
+    INSERT INTO {table} AS t ({key_cols}, data, created, last_modified, size)
+    SELECT {key_vals}, $2, now(), now(), pg_column_size($2) FROM (SELECT count(*) FROM old) AS locked
+    ON CONFLICT ({key_cols})
+    DO UPDATE SET %(set)s
+    WHERE t.data #> $3 IS DISTINCT FROM $4
+    RETURNING t.size, t.size_change
+), node AS (
+    SELECT old.node AS old, $4 AS new,
+           COALESCE(jsonb_typeof(old.node) = 'object' AND jsonb_typeof($4) = 'object'
+                    AND $4 != '{{}}'::jsonb, false) AS split,
+           %(row_stats)s
+    FROM w LEFT JOIN old ON true
+)
+SELECT json_notify({channel}, $1, json_notify_payload(e.event, e.path, e.data)),
+       CASE WHEN row_number() OVER () = 1 THEN node.rows_delta ELSE 0 END,
+       CASE WHEN row_number() OVER () = 1 THEN node.bytes_delta ELSE 0 END
+FROM node, LATERAL (
+    SELECT CASE WHEN n.key IS NULL THEN 'delete' ELSE 'put' END AS event,
+           $3 || COALESCE(o.key, n.key) AS path, n.value AS data
+    FROM jsonb_each(CASE WHEN node.split THEN node.old END) AS o
+    FULL JOIN jsonb_each(CASE WHEN node.split THEN node.new END) AS n ON o.key = n.key
+    WHERE o.value IS DISTINCT FROM n.value
+    UNION ALL
+    SELECT 'put', $3, node.new WHERE NOT node.split
+) AS e""" % {"set": _set_sized("jsonb_set_deep(t.data, $3, $4)"), "row_stats": ROW_STATS}
+
+# rows of the children of the root, each built once
+CHILD_ROWS = """SELECT {child_key_vals}, v.data, now(), now(), pg_column_size(v.data)
+    FROM jsonb_each($1) AS c, LATERAL (SELECT jsonb_build_object(c.key, c.value) AS data OFFSET 0) AS v"""
+
+SET_CHILD = """data = excluded.data, last_modified = now(),
+                  size = excluded.size, size_change = excluded.size - %s""" % OLD_SIZE
+
+# the root is replaced row by row, rows of unchanged l1_keys are left as they are
+REPLACE_ROOT_SQL = """WITH w AS (
+    INSERT INTO {table} AS t ({key_cols}, data, created, last_modified, size)
+    %(rows)s
+    ON CONFLICT ({key_cols})
+    DO UPDATE SET %(set)s
+    WHERE t.data IS DISTINCT FROM excluded.data
+    RETURNING t.l1_key, t.data, t.size, t.size_change
+), d AS (
+    DELETE FROM {table} AS t WHERE {db_match} AND NOT $1 ? l1_key
+    RETURNING l1_key, %(old_size)s AS size
+)
+SELECT json_notify({channel}, w.l1_key, json_notify_payload('put', ARRAY[w.l1_key], w.data -> w.l1_key)),
+       %(row_stats)s
+FROM w
+UNION ALL
+SELECT json_notify({channel}, d.l1_key, json_notify_payload('delete', ARRAY[d.l1_key], NULL)), -1, -d.size
+FROM d""" % {"rows": CHILD_ROWS, "set": SET_CHILD, "old_size": OLD_SIZE, "row_stats": ROW_STATS}
+
+# writes of large values, one statement for a batch of rows
+PUT_CHILDREN_SQL = """WITH w AS (
+    INSERT INTO {table} AS t ({key_cols}, data, created, last_modified, size)
+    %(rows)s
+    ON CONFLICT ({key_cols})
+    DO UPDATE SET %(set)s
+    RETURNING t.l1_key, t.data, t.size, t.size_change
+)
+SELECT json_notify({channel}, w.l1_key, json_notify_payload('put', ARRAY[w.l1_key], w.data -> w.l1_key)),
+       %(row_stats)s
+FROM w""" % {"rows": CHILD_ROWS, "set": SET_CHILD, "row_stats": ROW_STATS}
+
+CLEAR_SQL = """WITH d AS (
+    DELETE FROM {table} AS t WHERE {db_match} RETURNING l1_key, %(old_size)s AS size
+)
+SELECT json_notify({channel}, d.l1_key, json_notify_payload('delete', ARRAY[d.l1_key], NULL)), -1, -d.size
+FROM d""" % {"old_size": OLD_SIZE}
+
+WRITES = {
+    'put': (PUT_PARAMS, PUT_SQL),
+    'patch': (PATCH_PARAMS, PATCH_SQL),
+    'atomic': (ATOMIC_PARAMS, ATOMIC_SQL),
+    'delete': (DELETE_PARAMS, DELETE_SQL),
+    'replace': (REPLACE_PARAMS, REPLACE_SQL),
+    'replace_root': (REPLACE_ROOT_PARAMS, REPLACE_ROOT_SQL),
+    'put_children': (PUT_CHILDREN_PARAMS, PUT_CHILDREN_SQL),
+    'clear': (CLEAR_PARAMS, CLEAR_SQL),
+}
+
+
+def subtree_channel(channel: str, l1_key: str) -> str:
+    """
+    channel notified of the changes under l1_key besides the channel of the db, same as json_notify_channel
+    """
+    name = "%s__%s" % (channel, l1_key)
+    if len(name.encode('utf-8')) < 64:
+        return name
+    return "%s__%s" % (channel[:29], hashlib.md5(("%s/%s" % (channel, l1_key)).encode('utf-8')).hexdigest())
+
+
+def _quote_ident(name: str) -> str:
+    return '"%s"' % name.replace('"', '""')
+
+
+def _quote_literal(value: str) -> str:
+    return "'%s'" % value.replace("'", "''")
+
+
+class WriteStatements(object):
+    """
+        The write statements of one table, prepared on first use on each
+        connection. Postgres parses and plans them once per connection
+        instead of on every write.
+    """
+
+    def __init__(self, key: str, statements: dict):
+        """
+        :param key: identifies the table the statements write to
+        :param statements: {op: (param_types, sql)}
+        """
+        self.key = key
+        self.statements = statements
+
+    def __prepare(self, conn, op: str) -> str:
+        prepared = conn.info.setdefault(PREPARED_INFO_KEY, OrderedDict())
+        name = prepared.get((self.key, op))
+        if name is not None:
+            prepared.move_to_end((self.key, op))
+            return name
+
+        param_types, sql = self.statements[op]
+        name = "pgfire_write_%s" % next(_statement_ids)
+        types = " (%s)" % ', '.join(param_types) if param_types else ""
+        conn.execute("PREPARE %s%s AS %s" % (name, types, sql))
+        prepared[(self.key, op)] = name
+        if len(prepared) > MAX_PREPARED_PER_CONNECTION:
+            _, evicted = prepared.popitem(last=False)
+            conn.execute("DEALLOCATE %s" % evicted)
+        return name
+
+    def execute(self, conn, op: str, *args) -> list:
+        """
+        :return: rows of the statement, one row per notified change, ending with its rows_delta and bytes_delta
+        """
+        name = self.__prepare(conn, op)
+        params = dict(("p%s" % i, arg) for i, arg in enumerate(args))
+        args_sql = "(%s)" % ', '.join(":p%s" % i for i in range(len(args))) if args else ""
+        return conn.execute(text("EXECUTE %s%s" % (name, args_sql)), params).fetchall()
+
+
+def table_write_statements(db_name: str) -> WriteStatements:
+    """
+    statements of a table-per-db json db, the table and notify channel are part of the SQL
+    """
+    statements = {}
+    for op, (param_types, sql) in WRITES.items():
+        statements[op] = (param_types, sql.format(
+            table=_quote_ident(db_name),
+            key_cols="l1_key",
+            key_vals="$1",
+            key_match="l1_key = $1",
+            child_key_vals="c.key",
+            db_match="TRUE",
+            channel=_quote_literal(db_name)
+        ))
+    return WriteStatements(db_name, statements)
+
+
+def shared_write_statements(table_name: str) -> WriteStatements:
+    """
+    statements of the shared table, db id and notify channel are passed after the parameters of the write
+    """
+    statements = {}
+    for op, (param_types, sql) in WRITES.items():
+        db_id, channel = len(param_types) + 1, len(param_types) + 2
+        statements[op] = (param_types + ['integer', 'text'], sql.format(
+            table=table_name,
+            key_cols="db_id, l1_key",
+            key_vals="$%s, $1" % db_id,
+            key_match="db_id = $%s AND l1_key = $1" % db_id,
+            child_key_vals="$%s, c.key" % db_id,
+            db_match="db_id = $%s" % db_id,
+            channel="$%s" % channel
+        ))
+    return WriteStatements(table_name, statements)
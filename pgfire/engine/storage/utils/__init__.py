@@ -1,7 +1,9 @@
 from contextlib import contextmanager
+import queue
 import random
+import threading
 import time
-import numpy
+from typing import List
 
 
 @contextmanager
@@ -15,6 +17,87 @@ def session_scope(session):
         raise
 
 
+class WakeupQueue(queue.Queue):
+    """
+        Calls wakeup(), when set, after each put from the putting thread,
+        consumers on an event loop wait for it instead of polling
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.wakeup = None
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup()
+
+
+def queue_to_generator(q):
+    """
+    yields the messages put in q, None while q is empty, until None is put in q
+    """
+    while True:
+        try:
+            data = q.get_nowait()
+            if data is None:
+                return
+            q.task_done()
+            yield data
+        except queue.Empty:
+            yield None
+
+
+def is_related_path(event_path: str, path: str) -> bool:
+    """
+    a change at event_path changes the data at path when one of them is the other or below it
+    """
+    if not path:
+        return True
+    return event_path == path or event_path.startswith(path + '/') or path.startswith(event_path + '/')
+
+
+def path_filter(path, gen):
+    for payload in gen:
+        if payload and path is not None:
+            if is_related_path(payload['path'], path):
+                yield payload
+            else:
+                continue
+        else:
+            yield payload
+
+
+# rank of each type in the order of jsonb values
+_JSONB_TYPE_RANK = ((type(None), 1), (str, 2), (bool, 4), (int, 3), (float, 3), (list, 5), (dict, 6))
+
+
+def jsonb_sort_key(value, order_path: List[str]):
+    """
+    key of a child in the order of the jsonb value at order_path, a missing value sorts first
+    """
+    for key in order_path:
+        if not isinstance(value, dict) or key not in value:
+            return (0,)
+        value = value[key]
+    return jsonb_key(value)
+
+
+def jsonb_key(value):
+    """
+    key of value in the order of jsonb values. Strings compare by code point, as in a
+    database whose collation is "C", postgres compares the strings of jsonb with the
+    collation of the database and no COLLATE clause changes it
+    """
+    rank = next(rank for cls, rank in _JSONB_TYPE_RANK if isinstance(value, cls))
+    if isinstance(value, list):
+        return rank, len(value), [jsonb_key(v) for v in value]
+    if isinstance(value, dict):
+        return rank, len(value), [(k, jsonb_key(value[k])) for k in sorted(value)]
+    return rank, value
+
+
 def read_file(file_name):
     with open(file_name) as f:
         contents = f.read()
@@ -38,13 +121,18 @@ class PushID(object):
         # collisions with other clients.  We store the last characters
         # we generated because in the event of a collision, we'll use
         # those same characters except "incremented" by one.
-        self.lastRandChars = numpy.empty(12, dtype=int)
+        self.lastRandChars = [0] * 12
+        self.lock = threading.Lock()
 
     def next_id(self):
+        with self.lock:
+            return self.__next_id()
+
+    def __next_id(self):
         now = int(time.time() * 1000)
         duplicate_time = (now == self.lastPushTime)
         self.lastPushTime = now
-        time_stamp_chars = numpy.empty(8, dtype=str)
+        time_stamp_chars = [''] * 8
 
         for i in range(7, -1, -1):
             time_stamp_chars[i] = self.PUSH_CHARS[now % 64]
@@ -0,0 +1,229 @@
+"""
+    Per database admission control, requests over the limits of their db
+    are rejected before they reach the storage
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+__all__ = ["TokenBucket", "AdmissionController", "Rejected", "get_admission_controller",
+           "admission_middleware"]
+
+DEFAULT_MAX_QUEUE_WAIT_MS = 1000
+DEFAULT_MAX_DBS = 10000
+
+
+class Rejected(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Too many requests, retry after %.3f s" % retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+        Allows rate requests per second on average and bursts of up to burst requests
+    """
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def __refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """
+        :return: 0 when a token was taken, else seconds until one is available
+        """
+        self.__refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        """
+        returns a token taken by a request that was not served
+        """
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def full(self) -> bool:
+        self.__refill()
+        return self.tokens >= self.burst
+
+
+class _DbAdmission(object):
+    def __init__(self, controller):
+        self.bucket = TokenBucket(controller.rate, controller.burst) if controller.rate else None
+        self.slots = asyncio.Semaphore(controller.max_concurrent) if controller.max_concurrent else None
+        self.queued = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def idle(self) -> bool:
+        """
+        no request holds or waits for a slot and the bucket refilled, a new state would be the same
+        """
+        return not self.in_flight and not self.queued and (self.bucket is None or self.bucket.full())
+
+    def record_wait(self, wait: float):
+        self.wait_count += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def metrics(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queue_wait_ms": {
+                "count": self.wait_count,
+                "avg": self.wait_total * 1000 / self.wait_count if self.wait_count else 0,
+                "max": self.wait_max * 1000,
+            },
+        }
+
+
+class AdmissionController(object):
+    """
+        Token bucket rate limit and concurrency cap of each db.
+        Requests over the concurrency cap wait in a bounded queue for at most
+        max_queue_wait_ms, so one busy db cannot hold every storage call of
+        the process and the others keep their latency.
+        Db names come from clients, past max_dbs the state of the least
+        recently used idle dbs is dropped, their metrics start over.
+    """
+
+    def __init__(self, rate: float = None, burst: float = None, max_concurrent: int = None,
+                 max_queued: int = None, max_queue_wait_ms: float = DEFAULT_MAX_QUEUE_WAIT_MS,
+                 max_dbs: int = DEFAULT_MAX_DBS):
+        """
+        :param rate: requests per second of a db, None for no rate limit
+        :param burst: requests above rate a db may send at once, defaults to rate
+        :param max_concurrent: requests of a db handled at once, None for no cap
+        :param max_queued: requests of a db waiting for a slot, None for no limit
+        :param max_dbs: dbs whose state is kept
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait_ms / 1000.0
+        self.max_dbs = max_dbs
+        self.dbs = OrderedDict()  # type: OrderedDict[str, _DbAdmission]
+
+    def __db(self, db_name: str) -> _DbAdmission:
+        db = self.dbs.get(db_name)
+        if db is not None:
+            self.dbs.move_to_end(db_name)
+            return db
+        if len(self.dbs) >= self.max_dbs:
+            # busy dbs keep their state, the limit is exceeded while every db is busy
+            for name in [name for name, it in self.dbs.items() if it.idle()][:len(self.dbs) - self.max_dbs + 1]:
+                del self.dbs[name]
+        db = self.dbs[db_name] = _DbAdmission(self)
+        return db
+
+    def __reject(self, db, retry_after: float):
+        db.rejected += 1
+        raise Rejected(retry_after)
+
+    @asynccontextmanager
+    async def admit(self, db_name: str, hold: bool = True):
+        """
+        :param hold: take a concurrency slot for the request, streaming requests
+            that stay open do not
+        :raises Rejected: when the request is over a limit of the db
+        """
+        db = self.__db(db_name)
+        hold = hold and db.slots is not None
+        # a request rejected for a full queue or its wait takes no token
+        if hold and db.slots.locked() and self.max_queued is not None and db.queued >= self.max_queued:
+            self.__reject(db, self.max_queue_wait)
+        if db.bucket is not None:
+            wait = db.bucket.take()
+            if wait:
+                self.__reject(db, wait)
+
+        if not hold:
+            db.admitted += 1
+            yield
+            return
+
+        if db.slots.locked():
+            db.queued += 1
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(db.slots.acquire(), self.max_queue_wait)
+            except asyncio.TimeoutError:
+                if db.bucket is not None:
+                    db.bucket.give_back()
+                self.__reject(db, self.max_queue_wait)
+            finally:
+                db.queued -= 1
+                db.record_wait(time.monotonic() - start)
+        else:
+            await db.slots.acquire()
+            db.record_wait(0)
+
+        db.admitted += 1
+        db.in_flight += 1
+        try:
+            yield
+        finally:
+            db.in_flight -= 1
+            db.slots.release()
+
+    def metrics(self) -> dict:
+        return dict((db_name, db.metrics()) for db_name, db in self.dbs.items())
+
+
+def get_admission_controller(config: dict):
+    """
+    :param config: "admission" section of the app config
+    :return: None when no limit is configured
+    """
+    if not config:
+        return None
+    return AdmissionController(
+        rate=config.get("rate"),
+        burst=config.get("burst"),
+        max_concurrent=config.get("max_concurrent"),
+        max_queued=config.get("max_queued"),
+        max_queue_wait_ms=config.get("max_queue_wait_ms", DEFAULT_MAX_QUEUE_WAIT_MS),
+        max_dbs=config.get("max_dbs", DEFAULT_MAX_DBS),
+    )
+
+
+@web.middleware
+async def admission_middleware(request: web.Request, handler):
+    """
+    applies the limits of the db in the path, app['admission'] holds the controller
+    """
+    controller = request.app.get('admission')
+    db_name = request.match_info.get('db_name')
+    if controller is None or db_name is None:
+        return await handler(request)
+    # event streams stay open, they are rate limited but hold no slot
+    hold = not request.path.startswith('/database_events/')
+    try:
+        async with controller.admit(db_name, hold):
+            return await handler(request)
+    except Rejected as e:
+        return web.json_response(status=429, headers={
+            'Retry-After': str(max(1, math.ceil(e.retry_after)))
+        })
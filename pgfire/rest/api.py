@@ -1,15 +1,136 @@
 import asyncio
+import hmac
 import json
+import os
+import re
+import time
 
 from aiohttp import web
 from aiohttp_sse import sse_response
 
+from pgfire.engine.storage.base import ATOMIC_OPS, DURABILITY_LEVELS, DURABLE, post_push_id
+from pgfire.rest.live_query import LiveQuery
+from pgfire.rest.profiling import *
+from pgfire.rest.streaming import iter_body_members, NotAnObject
+
+# write position token, returned on writes and accepted on reads
+LSN_HEADER = 'X-Pgfire-Lsn'
+# like pg_current_wal_lsn(), two hexadecimal halves of 32 bits
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+# key to pass as ?after= for the next page of a paginated read
+NEXT_PAGE_HEADER = 'X-Pgfire-Next'
+# set to true on a put or patch that left the stored value as it was, nothing was written or notified
+UNCHANGED_HEADER = 'X-Pgfire-Unchanged'
+# write bodies larger than this, or of unknown length, are parsed as they arrive and
+# written in batches of about stream_batch_bytes of their top level children
+DEFAULT_STREAM_BODY_THRESHOLD = 1 << 20
+DEFAULT_STREAM_BATCH_BYTES = 1 << 20
+# seconds an idle event stream waits before checking its client is still connected
+SSE_CLOSE_CHECK_INTERVAL = 1.0
+# token of the profiling routes and of the index changes, set as "admin_token" in the "profiling" section of the config
+ADMIN_TOKEN_HEADER = 'X-Pgfire-Admin-Token'
+DEFAULT_PROFILE_SECONDS = 10
+DEFAULT_MAX_PROFILE_SECONDS = 60
+
+
+async def _write(storage, write_fn, *args):
+    if storage.group_commit:
+        # wait for the shared commit in a worker thread, other requests
+        # keep arriving and join the same batch
+        return await asyncio.get_event_loop().run_in_executor(None, write_fn, *args)
+    return write_fn(*args)
+
+
+def _write_response(storage, data, status=200):
+    response = web.json_response(data=data) if status != 204 else web.Response(status=204)
+    if storage.last_write_lsn:
+        response.headers[LSN_HEADER] = storage.last_write_lsn
+    return response
+
+
+def _update_response(storage, result):
+    """
+    response of a put or patch, result is (value, changed)
+    """
+    data, changed = result
+    response = _write_response(storage, data)
+    if not changed:
+        response.headers[UNCHANGED_HEADER] = 'true'
+    return response
+
+
+def _ttl_param(request: web.Request):
+    """
+    seconds from ?ttl=, after which the written path is deleted
+    """
+    ttl = request.query.get('ttl')
+    if ttl is None:
+        return None
+    ttl = float(ttl)
+    if not 0 < ttl < float('inf'):
+        raise ValueError("Invalid ttl: %s" % ttl)
+    return ttl
+
+
+def _min_lsn(request: web.Request):
+    """
+    position of a write a read must observe, from the LSN_HEADER
+    :raises ValueError: on a malformed position
+    """
+    lsn = request.headers.get(LSN_HEADER)
+    if lsn and not LSN_PATTERN.match(lsn):
+        raise ValueError("Invalid LSN: %s" % lsn)
+    return lsn or None
+
+
+def _stream_body(request: web.Request) -> bool:
+    threshold = request.app['config'].get('stream_body_threshold', DEFAULT_STREAM_BODY_THRESHOLD)
+    return request.body_exists and (request.content_length is None or request.content_length > threshold)
+
+
+async def _write_streamed(request: web.Request, storage, db_name: str, path: str, op_type: str):
+    """
+    writes the json object of the body in batches of its children as they arrive,
+    the whole body is never held in memory. A body that is not an object is parsed
+    as a whole and returned as (False, data), else (True, children written)
+    """
+    batch_bytes = request.app['config'].get('stream_batch_bytes', DEFAULT_STREAM_BATCH_BYTES)
+    members = iter_body_members(request.content)
+    try:
+        first = await members.__anext__()
+    except NotAnObject as e:
+        return False, json.loads(e.consumed + await request.read())
+    except StopAsyncIteration:
+        first = None
+
+    with storage.children_writer(db_name, path, op_type) as writer:
+        batch, size = {}, 0
+        if first is not None:
+            batch[first[0]], size = first[1], first[2]
+        async for key, value, length in members:
+            if size >= batch_bytes:
+                await _write(storage, writer.write, batch)
+                batch, size = {}, 0
+            batch[key] = value
+            size += length
+        await _write(storage, writer.write, batch)
+    return True, writer.children
+
 
 async def create_db(request: web.Request):
+    """
+    {"db_name": <name>, "durability": <one of DURABILITY_LEVELS, durable by default>}
+    """
     storage = request.app['storage']
     data = await request.json()
     db_name = data['db_name']
-    json_db = storage.create_db(db_name)
+    durability = data.get('durability', DURABLE)
+    if durability not in DURABILITY_LEVELS:
+        return web.json_response(status=400)
+    try:
+        json_db = storage.create_db(db_name, durability)
+    except ValueError:
+        return web.json_response(status=400)
     if json_db:
         return web.json_response(status=204)
     else:
@@ -21,56 +142,219 @@ async def delete_db(request: web.Request):
 
 
 async def db_put(request: web.Request):
+    """
+    a put at the root, or with ?op=replace, rewrites and notifies only what changed.
+    With ?ttl=<seconds> the path is deleted after that time
+    """
     storage = request.app['storage']
     db_name = request.match_info['db_name']
     path = request.match_info['op_path']
-    data = await request.json()
+    op = request.query.get('op')
+    try:
+        ttl = _ttl_param(request)
+    except ValueError:
+        return web.json_response(status=400)
+    if op not in (None, 'replace') or ttl is not None and (op is not None or not path):
+        return web.json_response(status=400)
+    if op is None and ttl is None and _stream_body(request):
+        try:
+            streamed, data = await _write_streamed(request, storage, db_name, path, 'put')
+        except ValueError:
+            return web.json_response(status=400)
+        if streamed:
+            return _write_response(storage, None, status=204)
+    else:
+        data = await request.json()
     json_db = storage.get_db(db_name)
-    return web.json_response(data=json_db.put(path, data))
+    if op is None and path:
+        return _update_response(storage, await _write(storage, json_db.put, path, data, True, ttl))
+    try:
+        await _write(storage, json_db.replace, path, data)
+    except ValueError:
+        return web.json_response(status=400)
+    return _write_response(storage, data)
+
+
+def _query_params(params) -> dict:
+    """
+    arguments of BaseJsonDb.query from ?orderBy=<child path>, values of
+    startAt, endAt and equalTo are json, as limitToFirst and limitToLast
+    :raises ValueError: on invalid parameters
+    """
+    order_by = params['orderBy']
+    query = {"order_by": json.loads(order_by) if order_by.startswith('"') else order_by}
+    if not query["order_by"]:
+        raise ValueError("Invalid orderBy")
+    if 'equalTo' in params:
+        query["start_at"] = query["end_at"] = json.loads(params['equalTo'])
+    if 'startAt' in params:
+        query["start_at"] = json.loads(params['startAt'])
+    if 'endAt' in params:
+        query["end_at"] = json.loads(params['endAt'])
+    if 'limitToFirst' in params:
+        query["limit_to_first"] = int(params['limitToFirst'])
+    if 'limitToLast' in params:
+        query["limit_to_last"] = int(params['limitToLast'])
+    return query
 
 
 async def db_get(request: web.Request):
+    """
+    data at path, or with ?limit=<n>&after=<key> a page of its children in key order.
+    ?orderBy=<child path> orders the children by the value at the child path, see _query_params.
+    ?fields=<key>,<key> returns only these keys of each child.
+    """
     storage = request.app['storage']
     db_name = request.match_info['db_name']
     path = request.match_info.get('op_path')
     json_db = storage.get_db(db_name)
-    return web.json_response(data=json_db.get(path))
+    fields = request.query['fields'].split(',') if 'fields' in request.query else None
+    try:
+        min_lsn = _min_lsn(request)
+    except ValueError:
+        return web.json_response(status=400)
+    if 'orderBy' in request.query:
+        try:
+            result = json_db.query(path, min_lsn=min_lsn, fields=fields, **_query_params(request.query))
+        except ValueError:
+            return web.json_response(status=400)
+        return web.json_response(data=result)
+    if 'limit' not in request.query:
+        return web.json_response(data=json_db.get(path, min_lsn, fields))
+    try:
+        limit = int(request.query['limit'])
+        page, next_after = json_db.get_page(path, limit, request.query.get('after'), min_lsn, fields)
+    except ValueError:
+        return web.json_response(status=400)
+    response = web.json_response(data=page)
+    if next_after is not None:
+        response.headers[NEXT_PAGE_HEADER] = next_after
+    return response
 
 
 async def db_sse_get(request: web.Request):
+    """
+    the data at path, then its changes. With the parameters of a query, see _query_params,
+    the result of the query, then the changes of the result, see LiveQuery
+    """
+    if 'orderBy' in request.query:
+        return await _live_query_sse(request)
     storage = request.app['storage']
     db_name = request.match_info['db_name']
     path = request.match_info.get('op_path')
     json_db = storage.get_db(db_name)
-    data = json_db.get(path)
+    try:
+        data = json_db.get(path, _min_lsn(request))
+    except ValueError:
+        return web.json_response(status=400)
 
     response = await sse_response(request)
-    notifier = storage.get_notifier(db_name, path)
-    async with response, notifier:
-        stream = notifier.listen()
-        while True:
-            if data:
-                await response.send(json.dumps(data))
-            data = next(stream)
-            await asyncio.sleep(0)
+    # changes are encoded once for all the streams of the process, see EventFanout
+    async with response, request.app['fanout'].subscribe(db_name, path) as frames:
+        if data:
+            await response.send(json.dumps(data))
+        # a client that went away is noticed when the wait for a frame times out
+        while request.transport is not None and not request.transport.is_closing():
+            try:
+                frame = await asyncio.wait_for(frames.get(), SSE_CLOSE_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            if frame is None:
+                # the client fell behind, it connects again for the data
+                break
+            try:
+                await response.write(frame)
+            except ConnectionResetError:
+                break
+
+
+async def _live_query_sse(request: web.Request):
+    db_name = request.match_info['db_name']
+    path = request.match_info.get('op_path')
+    try:
+        live_query = LiveQuery(request.app['storage'].get_db(db_name), path, **_query_params(request.query))
+    except ValueError:
+        return web.json_response(status=400)
+
+    # subscribed before the query, a change is never missed between the two
+    async with request.app['fanout'].subscribe(db_name, path, decoded=True) as events:
+        try:
+            data = live_query.load()
+        except ValueError:
+            return web.json_response(status=400)
+        response = await sse_response(request)
+        async with response:
+            await response.send(json.dumps(data))
+            while request.transport is not None and not request.transport.is_closing():
+                try:
+                    event = await asyncio.wait_for(events.get(), SSE_CLOSE_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    continue
+                if event is None:
+                    break
+                try:
+                    for change in live_query.apply(event):
+                        await response.send(json.dumps(change))
+                except ConnectionResetError:
+                    break
 
 
 async def db_patch(request: web.Request):
+    """
+    merges data at path, or with ?op=<one of ATOMIC_OPS> applies the
+    operation atomically with data as the operand. ?ttl= as for a put
+    """
     storage = request.app['storage']
     db_name = request.match_info['db_name']
     path = request.match_info['op_path']
-    data = await request.json()
+    op = request.query.get('op')
+    try:
+        ttl = _ttl_param(request)
+    except ValueError:
+        return web.json_response(status=400)
+    if ttl is not None and (op is not None or not path):
+        return web.json_response(status=400)
+    if op is None and ttl is None and _stream_body(request):
+        try:
+            streamed, data = await _write_streamed(request, storage, db_name, path, 'patch')
+        except ValueError:
+            return web.json_response(status=400)
+        if streamed:
+            return _write_response(storage, None, status=204)
+    else:
+        data = await request.json()
     json_db = storage.get_db(db_name)
-    return web.json_response(data=json_db.patch(path, data))
+    if op is None:
+        return _update_response(storage, await _write(storage, json_db.patch, path, data, True, ttl))
+    if op not in ATOMIC_OPS:
+        return web.json_response(status=400)
+    try:
+        return _write_response(storage, await _write(storage, storage.atomic_at_path, db_name, path, op, data))
+    except ValueError:
+        return web.json_response(status=400)
 
 
 async def db_post(request: web.Request):
     storage = request.app['storage']
     db_name = request.match_info['db_name']
     path = request.match_info['op_path']
-    data = await request.json()
+    try:
+        ttl = _ttl_param(request)
+    except ValueError:
+        return web.json_response(status=400)
+    if ttl is None and _stream_body(request):
+        push_id = post_push_id.next_id()
+        try:
+            streamed, data = await _write_streamed(request, storage, db_name, "%s/%s" % (path, push_id), 'put')
+        except ValueError:
+            return web.json_response(status=400)
+        if streamed:
+            # the posted value is not sent back
+            return _write_response(storage, {push_id: None})
+    else:
+        data = await request.json()
     json_db = storage.get_db(db_name)
-    return web.json_response(data=json_db.post(path, data))
+    return _write_response(storage, await _write(storage, json_db.post, path, data, ttl))
 
 
 async def db_del(request: web.Request):
@@ -78,7 +362,114 @@ async def db_del(request: web.Request):
     db_name = request.match_info['db_name']
     path = request.match_info['op_path']
     json_db = storage.get_db(db_name)
-    return web.json_response(data=json_db.delete(path))
+    return _write_response(storage, await _write(storage, json_db.delete, path))
+
+
+async def admission_metrics(request: web.Request):
+    """
+    admitted, rejected and queue wait of each db, empty without admission limits
+    """
+    controller = request.app.get('admission')
+    return web.json_response(data=controller.metrics() if controller else {})
+
+
+async def db_stats(request: web.Request):
+    """
+    rows, bytes and writes of each db from the counters kept by the storage, no data is
+    scanned. subscribers are the event streams and live queries open in this process.
+    """
+    try:
+        stats = request.app['storage'].get_db_stats()
+    except NotImplementedError:
+        return web.json_response(status=501)
+    subscribers = request.app['fanout'].subscriber_counts()
+    for db_name, counters in stats.items():
+        counters["subscribers"] = subscribers.get(db_name, 0)
+    return web.json_response(data=stats)
+
+
+async def index_advice(request: web.Request):
+    """
+    indexes recommended by the queries of the db served by this process,
+    POST creates the recommended ones and drops the unused ones
+    """
+    if request.method == 'POST':
+        denied = _admin_denied(request)
+        if denied is not None:
+            return denied
+    storage = request.app['storage']
+    db_name = request.match_info['db_name']
+    if storage.get_db(db_name) is None:
+        return web.json_response(status=404)
+    # indexes are built concurrently with writes, which can take long
+    try:
+        advice = await asyncio.get_event_loop().run_in_executor(
+            None, storage.advise_indexes, db_name, request.method == 'POST'
+        )
+    except NotImplementedError:
+        # the storage has no indexes
+        return web.json_response(status=501)
+    return web.json_response(data=advice)
+
+
+def _admin_denied(request: web.Request):
+    """
+    :return: the response of a request not allowed on the admin routes, None when it is
+    """
+    token = (request.app['config'].get('profiling') or {}).get('admin_token')
+    if not token:
+        # the admin routes are off
+        return web.json_response(status=404)
+    if not hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, ''), token):
+        return web.json_response(status=403)
+    return None
+
+
+def _attachment(kind: str, extension: str) -> dict:
+    return {'Content-Disposition': 'attachment; filename="pgfire-%s-%d-%d.%s"' % (
+        kind, os.getpid(), int(time.time()), extension)}
+
+
+async def cpu_profile(request: web.Request):
+    """
+    stacks of all threads sampled for ?seconds=, in the collapsed format of flame graph tools
+    """
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+    max_seconds = request.app['config']['profiling'].get('max_seconds', DEFAULT_MAX_PROFILE_SECONDS)
+    try:
+        seconds = float(request.query.get('seconds', DEFAULT_PROFILE_SECONDS))
+    except ValueError:
+        return web.json_response(status=400)
+    if not 0 < seconds <= max_seconds:
+        return web.json_response(status=400)
+    stacks = await asyncio.get_event_loop().run_in_executor(None, sample_stacks, seconds)
+    return web.Response(text=stacks, content_type='text/plain', headers=_attachment('cpu', 'folded'))
+
+
+async def memory_profile(request: web.Request):
+    """
+    GET the top allocators and the event queues of the process, POST starts
+    tracing allocations and DELETE stops it
+    """
+    denied = _admin_denied(request)
+    if denied is not None:
+        return denied
+    if request.method == 'POST':
+        frames = request.app['config']['profiling'].get('trace_frames', DEFAULT_TRACE_FRAMES)
+        return web.json_response(data={"tracing": True, "started": start_memory_tracing(frames)})
+    if request.method == 'DELETE':
+        stop_memory_tracing()
+        return web.json_response(data={"tracing": False})
+    try:
+        top = int(request.query.get('top', DEFAULT_TOP_ALLOCATORS))
+    except ValueError:
+        return web.json_response(status=400)
+    # a snapshot of the traces takes a while on a large heap
+    snapshot = await asyncio.get_event_loop().run_in_executor(None, memory_snapshot, top)
+    snapshot["event_queues"] = request.app['fanout'].queue_sizes()
+    return web.json_response(data=snapshot, headers=_attachment('memory', 'json'))
 
 
 async def db_head(request: web.Request):
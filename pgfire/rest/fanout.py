@@ -0,0 +1,167 @@
+"""
+    Change events shared by the event streams of a process. Streams of the
+    same db and first key share one storage notifier, each event is encoded
+    once as an SSE frame and the same bytes are queued for every stream at a
+    path it changes. Live queries get the events themselves. A stream that
+    falls max_queued events behind is closed, its client connects again and
+    reads the data anew.
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+from pgfire.engine.storage.utils import is_related_path
+
+__all__ = ["EventFanout", "sse_frame", "DEFAULT_MAX_QUEUED_EVENTS"]
+
+SSE_LINE_SEP = "\r\n"
+DEFAULT_MAX_QUEUED_EVENTS = 1000
+
+
+def sse_frame(data) -> bytes:
+    """
+    the frame aiohttp_sse EventSourceResponse.send(json.dumps(data)) writes
+    """
+    return ("data: %s%s%s" % (json.dumps(data), SSE_LINE_SEP, SSE_LINE_SEP)).encode("utf-8")
+
+
+class _Feed(object):
+    """
+        One storage notifier and the queues of the streams it serves
+    """
+
+    def __init__(self, notifier):
+        self.notifier = notifier
+        # queue -> (path of its stream, whether it takes events instead of frames)
+        self.subscribers = {}
+        self.encoded = 0
+        self.dropped = 0
+        self.task = None
+        self.loop = None
+        # set from the thread of the notifier when it received events
+        self.received = asyncio.Event()
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.notifier.set_wakeup(self.__wakeup)
+        self.task = asyncio.ensure_future(self.__pump(self.notifier.listen()))
+
+    def __wakeup(self):
+        try:
+            self.loop.call_soon_threadsafe(self.received.set)
+        except RuntimeError:
+            # the loop closed, nothing is pumped anymore
+            pass
+
+    async def __pump(self, stream):
+        try:
+            while True:
+                data = next(stream, None)
+                if data is None:
+                    # the notifier yields None until an event arrives, events received from here on wake us
+                    await self.received.wait()
+                    self.received.clear()
+                    continue
+                frame = None
+                for subscriber, (path, decoded) in list(self.subscribers.items()):
+                    if is_related_path(data['path'], path):
+                        if decoded:
+                            # shared by the subscribers, not to be modified
+                            self.__queue(subscriber, data)
+                            continue
+                        if frame is None:
+                            frame = sse_frame(data)
+                            self.encoded += 1
+                        self.__queue(subscriber, frame)
+        finally:
+            self.notifier.set_wakeup(None)
+            # joins the listen thread of postgres notifiers
+            await asyncio.get_event_loop().run_in_executor(None, self.notifier.cleanup)
+
+    def __queue(self, subscriber: asyncio.Queue, item):
+        try:
+            subscriber.put_nowait(item)
+        except asyncio.QueueFull:
+            # too far behind, what it missed is dropped and None ends its stream
+            del self.subscribers[subscriber]
+            self.dropped += 1
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            subscriber.put_nowait(None)
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class EventFanout(object):
+    """
+        Subscriptions of the event streams of one process to the changes of a storage
+
+            async with fanout.subscribe(db_name, path) as frames:
+                frame = await frames.get()
+                if frame is None:
+                    # fell behind, the stream ends
+    """
+
+    def __init__(self, storage, max_queued: int = DEFAULT_MAX_QUEUED_EVENTS):
+        """
+        :param max_queued: frames or events a stream may have waiting before it is closed
+        """
+        self.storage = storage
+        self.max_queued = max_queued
+        # (db_name, first key of the path, '' at the root) -> _Feed
+        self.feeds = {}
+
+    @asynccontextmanager
+    async def subscribe(self, db_name: str, path: str, decoded: bool = False):
+        """
+        :return: queue of the encoded frames of the changes at path, with decoded of the change events.
+            None is queued when the subscriber fell max_queued behind, nothing follows it
+        """
+        path = path or ''
+        key = (db_name, path.split('/')[0])
+        feed = self.feeds.get(key)
+        if feed is None:
+            feed = self.feeds[key] = _Feed(self.storage.get_notifier(db_name, key[1] or None))
+            feed.start()
+        frames = asyncio.Queue(self.max_queued)
+        feed.subscribers[frames] = (path, decoded)
+        try:
+            yield frames
+        finally:
+            feed.subscribers.pop(frames, None)
+            if not feed.subscribers and self.feeds.get(key) is feed:
+                del self.feeds[key]
+                await feed.stop()
+
+    def subscriber_counts(self) -> dict:
+        """
+        :return: {db_name: event streams and live queries of the db open in this process}
+        """
+        counts = {}
+        for (db_name, _), feed in self.feeds.items():
+            counts[db_name] = counts.get(db_name, 0) + len(feed.subscribers)
+        return counts
+
+    def queue_sizes(self) -> dict:
+        """
+        :return: {"<db_name>/<first key>": {"notifier": events not yet pumped, "streams": frames not yet sent}}
+        """
+        sizes = {}
+        for (db_name, key), feed in self.feeds.items():
+            # postgres and memory notifiers queue the events they received
+            notifier_queue = getattr(feed.notifier, 'message_queue', None)
+            sizes["%s/%s" % (db_name, key)] = {
+                "notifier": notifier_queue.qsize() if notifier_queue is not None else None,
+                "streams": sorted((frames.qsize() for frames in feed.subscribers), reverse=True),
+            }
+        return sizes
+
+    async def close(self):
+        feeds, self.feeds = list(self.feeds.values()), {}
+        for feed in feeds:
+            await feed.stop()
@@ -0,0 +1,179 @@
+"""
+    Result windows of queries kept current from the change events under
+    their path. A change is applied to the window in memory, storage is only
+    read for a child the window does not hold, or queried again when a
+    member leaves a full window and the next child has to take its place.
+"""
+import copy
+import json
+from typing import List
+
+from pgfire.engine.storage.base import BaseJsonDb
+from pgfire.engine.storage.utils import jsonb_key, jsonb_sort_key
+
+__all__ = ["LiveQuery"]
+
+# a child removed by a change
+_MISSING = object()
+
+
+def _same(a, b) -> bool:
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+
+def _apply_change(node, keys: List[str], event: dict):
+    """
+    :return: node after the change event at keys below it, _MISSING when it was deleted
+    """
+    if not keys:
+        if event['event'] == 'delete':
+            return _MISSING
+        data = copy.deepcopy(event['data'])
+        if event['event'] == 'patch' and isinstance(node, dict) and isinstance(data, dict):
+            return dict(node, **data)
+        return data
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _apply_change(node.get(keys[0], _MISSING), keys[1:], event)
+    if child is _MISSING:
+        node.pop(keys[0], None)
+        # objects left empty are pruned, as by the storages
+        return node if node else _MISSING
+    node[keys[0]] = child
+    return node
+
+
+class LiveQuery(object):
+    """
+        The children of path ordered by the value at their child path
+        order_by, with the range and limit arguments of BaseJsonDb.query.
+        apply() turns a change event under path into the changes of the
+        window:
+            {"event": "enter", "key": <child key>, "data": <child>}
+            {"event": "update", "key": <child key>, "data": <child>}
+            {"event": "exit", "key": <child key>}
+    """
+
+    def __init__(self, json_db: BaseJsonDb, path: str, order_by: str, start_at=None, end_at=None,
+                 limit_to_first: int = None, limit_to_last: int = None):
+        self.json_db = json_db
+        self.path = path or ''
+        self.prefix = self.path.split('/') if self.path else []
+        self.order_by = order_by
+        self.order_path = order_by.split('/')
+        self.start_at = start_at
+        self.end_at = end_at
+        self.limit_to_first = limit_to_first
+        self.limit_to_last = limit_to_last
+        self.limit = limit_to_last if limit_to_last is not None else limit_to_first
+        # child key -> child, in the order of the query
+        self.window = {}
+        # times the window was queried again
+        self.refreshes = 0
+
+    def load(self) -> dict:
+        """
+        :return: the window, queried from storage
+        """
+        self.window = self.__query()
+        return self.window
+
+    def __query(self) -> dict:
+        return self.json_db.query(self.path, self.order_by, self.start_at, self.end_at,
+                                  self.limit_to_first, self.limit_to_last)
+
+    def __rank(self, key: str, child):
+        return jsonb_sort_key(child, self.order_path), key
+
+    def __in_range(self, child) -> bool:
+        sort_key = jsonb_sort_key(child, self.order_path)
+        if self.start_at is not None and (sort_key == (0,) or sort_key < jsonb_key(self.start_at)):
+            return False
+        if self.end_at is not None and (sort_key == (0,) or sort_key > jsonb_key(self.end_at)):
+            return False
+        return True
+
+    def __sorted(self, window: dict) -> dict:
+        return dict(sorted(window.items(), key=lambda item: self.__rank(*item)))
+
+    def __refresh(self) -> List[dict]:
+        """
+        queries the window again, the changes are the difference with the current one
+        """
+        self.refreshes += 1
+        old, self.window = self.window, self.__query()
+        changes = [{"event": "exit", "key": key} for key in old if key not in self.window]
+        for key, child in self.window.items():
+            if key not in old:
+                changes.append({"event": "enter", "key": key, "data": child})
+            elif not _same(old[key], child):
+                changes.append({"event": "update", "key": key, "data": child})
+        return changes
+
+    def apply(self, event: dict) -> List[dict]:
+        """
+        :param event: change event at a path related to path
+        :return: the changes of the window, exits first
+        """
+        keys = event['path'].split('/') if event['path'] else []
+        if len(keys) <= len(self.prefix) or keys[:len(self.prefix)] != self.prefix:
+            # path itself or one of its parents changed
+            return self.__refresh()
+        key, below = keys[len(self.prefix)], keys[len(self.prefix) + 1:]
+        if event.get('truncated'):
+            child = self.__read(key)
+        elif key in self.window:
+            child = _apply_change(self.window[key], below, event)
+        elif not below and event['event'] != 'patch':
+            child = _MISSING if event['event'] == 'delete' else event['data']
+        else:
+            # the window does not hold the rest of the child
+            child = self.__read(key)
+
+        member = key in self.window
+        candidate = child is not _MISSING and self.__in_range(child)
+        full = self.limit is not None and len(self.window) >= self.limit
+        if member:
+            if candidate and _same(self.window[key], child):
+                return []
+            if not full:
+                # no child outside of the window is in range, nothing takes the place of an exit
+                if not candidate:
+                    del self.window[key]
+                    return [{"event": "exit", "key": key}]
+                self.window[key] = child
+                self.window = self.__sorted(self.window)
+                return [{"event": "update", "key": key, "data": child}]
+            # every child outside of a full window ranks after its last member, or before its first one
+            ranks = [self.__rank(k, v) for k, v in self.window.items()]
+            rank = self.__rank(key, child)
+            stays = rank <= max(ranks) if self.limit_to_last is None else rank >= min(ranks)
+            if not candidate or not stays:
+                return self.__refresh()
+            self.window[key] = child
+            self.window = self.__sorted(self.window)
+            return [{"event": "update", "key": key, "data": child}]
+
+        if not candidate:
+            return []
+        changes = []
+        if full:
+            ranks = sorted(self.__rank(k, v) for k, v in self.window.items())
+            rank = self.__rank(key, child)
+            if self.limit_to_last is None:
+                if rank > ranks[-1]:
+                    return []
+                evicted = ranks[-1][1]
+            else:
+                if rank < ranks[0]:
+                    return []
+                evicted = ranks[0][1]
+            del self.window[evicted]
+            changes.append({"event": "exit", "key": evicted})
+        self.window[key] = child
+        self.window = self.__sorted(self.window)
+        changes.append({"event": "enter", "key": key, "data": child})
+        return changes
+
+    def __read(self, key: str):
+        child = self.json_db.get('/'.join(self.prefix + [key]))
+        return _MISSING if child is None else child
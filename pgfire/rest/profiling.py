@@ -0,0 +1,108 @@
+"""
+    Profiles of the running process, served by the admin routes. CPU time is
+    sampled from the stacks of all threads, so no profiler has to be set up
+    before the process started. Allocations are traced with tracemalloc only
+    between start_memory_tracing() and stop_memory_tracing(), tracing slows
+    every allocation down.
+"""
+import collections
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+__all__ = ["sample_stacks", "memory_snapshot", "start_memory_tracing", "stop_memory_tracing",
+           "DEFAULT_SAMPLE_INTERVAL", "DEFAULT_TOP_ALLOCATORS", "DEFAULT_TRACE_FRAMES"]
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_TOP_ALLOCATORS = 25
+# frames kept for each traced allocation
+DEFAULT_TRACE_FRAMES = 1
+
+# allocations of the tracing itself are left out of the snapshots
+_TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def _collapsed_stack(frame) -> str:
+    """
+    :return: the calls of frame outermost first, "file:function:line" separated by ;
+    """
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append("%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    calls.reverse()
+    return ";".join(calls)
+
+
+def sample_stacks(seconds: float, interval: float = DEFAULT_SAMPLE_INTERVAL) -> str:
+    """
+    samples the stacks of the other threads every interval for seconds. Waiting
+    threads are sampled too, in the call they wait in.
+    :return: the collapsed stacks read by flame graph tools, a "thread;call;call count" line per stack
+    """
+    counts = collections.Counter()
+    sampler = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident != sampler:
+                counts["%s;%s" % (names.get(ident, ident), _collapsed_stack(frame))] += 1
+        time.sleep(interval)
+    return "".join("%s %d\n" % (stack, count) for stack, count in counts.most_common())
+
+
+def start_memory_tracing(frames: int = DEFAULT_TRACE_FRAMES) -> bool:
+    """
+    :return: False when tracing was already started
+    """
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_memory_tracing():
+    tracemalloc.stop()
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # not linux
+        return None
+
+
+def memory_snapshot(top: int = DEFAULT_TOP_ALLOCATORS) -> dict:
+    """
+    :return: resident size, garbage collector counts and, while tracing, the
+        lines that allocated the most memory still in use
+    """
+    snapshot = {
+        "pid": os.getpid(),
+        "rss_bytes": _rss_bytes(),
+        "gc_counts": list(gc.get_count()),
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if not snapshot["tracing"]:
+        return snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot["traced_bytes"] = current
+    snapshot["traced_peak_bytes"] = peak
+    statistics = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS).statistics("lineno")
+    snapshot["top_allocators"] = [{
+        "location": "%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+        "bytes": stat.size,
+        "blocks": stat.count,
+    } for stat in statistics[:top]]
+    return snapshot
@@ -6,6 +6,14 @@ routes = [
     # ('path', handler, 'http_method')
     (r'/createdb', create_db, 'POST'),
     (r'/deletedb', delete_db, 'DELETE'),
+    (r'/metrics/admission', admission_metrics, 'GET'),
+    (r'/stats', db_stats, 'GET'),
+    (r'/admin/indexes/{db_name:[a-z0-9_\-]+}', index_advice, 'GET'),
+    (r'/admin/indexes/{db_name:[a-z0-9_\-]+}', index_advice, 'POST'),
+    (r'/admin/profile/cpu', cpu_profile, 'GET'),
+    (r'/admin/profile/memory', memory_profile, 'GET'),
+    (r'/admin/profile/memory', memory_profile, 'POST'),
+    (r'/admin/profile/memory', memory_profile, 'DELETE'),
     (r'/database/{db_name:[a-z0-9_\-]+}/{op_path:.*?}', db_put, 'PUT'),
     (r'/database/{db_name:[a-z0-9_\-]+}/{op_path:.*?}', db_get, 'GET'),
     (r'/database_events/{db_name:[a-z0-9_\-]+}/{op_path:.*?}', db_sse_get, 'GET'),
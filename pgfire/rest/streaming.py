@@ -0,0 +1,179 @@
+"""
+    Incremental parsing of large write bodies, a json object is split into
+    its members as the body arrives instead of being parsed as a whole
+"""
+import codecs
+import json
+
+__all__ = ["JsonObjectStreamParser", "NotAnObject", "iter_body_members"]
+
+_WHITESPACE = ' \t\r\n'
+_decoder = json.JSONDecoder()
+
+
+class NotAnObject(ValueError):
+    """
+        The body is not a json object, it has to be parsed as a whole
+    """
+
+    def __init__(self, consumed):
+        """
+        :param consumed: the part of the body read before
+        """
+        super().__init__("Body is not a json object")
+        self.consumed = consumed
+
+
+class JsonObjectStreamParser(object):
+    """
+        Splits the text of one json object into its members, (key, value,
+        length of the value text) tuples,
+        fed in pieces of any size. Only the text of the member being parsed
+        is kept. A member is decoded again only once its text has doubled
+        since the last incomplete attempt, so large members are decoded a
+        bounded number of times.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.started = False
+        self.finished = False
+        # 'key', 'colon', 'value' or 'separator'
+        self.expect = 'key'
+        self.after_comma = False
+        self.key = None
+        self.decoded = None
+        # buffer length at which to try decoding the incomplete key or value again,
+        # pieces fed before are kept apart until then instead of growing the buffer
+        self.retry_at = 0
+        self.pieces = []
+        self.pieces_length = 0
+
+    def feed(self, text: str) -> list:
+        """
+        :return: members completed by text
+        :raises NotAnObject: when the body does not start with an object
+        :raises ValueError: on malformed json
+        """
+        self.pieces.append(text)
+        self.pieces_length += len(text)
+        if len(self.buffer) + self.pieces_length < self.retry_at:
+            return []
+        self.retry_at -= self.pos
+        self.buffer = ''.join([self.buffer[self.pos:]] + self.pieces)
+        self.pieces = []
+        self.pieces_length = 0
+        self.pos = 0
+        members = []
+        while not self.finished and self.__skip_whitespace():
+            if not self.started:
+                if self.buffer[self.pos] != '{':
+                    raise NotAnObject(self.buffer)
+                self.started = True
+                self.pos += 1
+            elif self.expect == 'key':
+                if self.buffer[self.pos] == '}' and not self.after_comma:
+                    self.pos += 1
+                    self.finished = True
+                elif self.buffer[self.pos] != '"':
+                    raise ValueError("Expected a key at %s" % self.buffer[self.pos:self.pos + 20])
+                elif not self.__decode(_WHITESPACE + ':'):
+                    break
+                else:
+                    self.key = self.decoded
+                    self.expect = 'colon'
+            elif self.expect == 'colon':
+                if self.buffer[self.pos] != ':':
+                    raise ValueError("Expected ':' after key %s" % self.key)
+                self.pos += 1
+                self.expect = 'value'
+            elif self.expect == 'value':
+                start = self.pos
+                if not self.__decode(_WHITESPACE + ',}'):
+                    break
+                members.append((self.key, self.decoded, self.pos - start))
+                self.expect = 'separator'
+            else:
+                char = self.buffer[self.pos]
+                if char not in ',}':
+                    raise ValueError("Expected ',' or '}' after a value")
+                self.pos += 1
+                self.finished = char == '}'
+                self.after_comma = True
+                self.expect = 'key'
+                continue
+            self.after_comma = False
+        return members
+
+    def close(self) -> list:
+        """
+        :return: members still pending decoding
+        :raises ValueError: when the object is incomplete or followed by more data
+        """
+        self.retry_at = 0
+        members = self.feed('')
+        if not self.finished:
+            if self.expect in ('key', 'value') and self.started and self.pos < len(self.buffer):
+                # the pending key or value fails with the reason it is invalid
+                _decoder.raw_decode(self.buffer, self.pos)
+            raise ValueError("Incomplete json object")
+        if self.buffer[self.pos:].strip(_WHITESPACE):
+            raise ValueError("Trailing data after json object")
+        return members
+
+    def __skip_whitespace(self) -> bool:
+        """
+        :return: False when the buffer ends before a non whitespace character
+        """
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+            self.pos += 1
+        return self.pos < len(self.buffer)
+
+    def __decode(self, followers: str) -> bool:
+        """
+        decodes the key or value at pos into self.decoded
+        :param followers: characters that can follow it
+        :return: False when it is not complete in the buffer yet
+        """
+        try:
+            value, end = _decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            end = len(self.buffer)
+        # a number at the end of the buffer may continue in the next piece, 1 of 1.5 is not followed by a follower
+        if end == len(self.buffer) or self.buffer[end] not in followers:
+            self.retry_at = len(self.buffer) + max(len(self.buffer) - self.pos, 1)
+            return False
+        self.decoded = value
+        self.pos = end
+        self.retry_at = 0
+        return True
+
+
+async def iter_body_members(content, chunk_size: int = 1 << 16):
+    """
+    yields the (key, value, length of the value text) members of the json object
+    read from the aiohttp stream content
+    :raises NotAnObject: before the first member, when the body is not an object
+    """
+    head = b''
+    while not head.strip():
+        chunk = await content.read(chunk_size)
+        if not chunk:
+            break
+        head += chunk
+    if not head.lstrip().startswith(b'{'):
+        raise NotAnObject(head)
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parser = JsonObjectStreamParser()
+    for member in parser.feed(decoder.decode(head)):
+        yield member
+    while True:
+        chunk = await content.read(chunk_size)
+        if not chunk:
+            break
+        for member in parser.feed(decoder.decode(chunk)):
+            yield member
+    for member in parser.feed(decoder.decode(b'', final=True)) + parser.close():
+        yield member
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from pgfire.rest.admission import AdmissionController, Rejected, TokenBucket
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == pytest.approx(0.5)
+    now[0] = 0.5
+    assert bucket.take() == 0
+    assert bucket.take() > 0
+
+
+def test_rate_limit_per_db():
+    async def run():
+        controller = AdmissionController(rate=1, burst=2)
+        for _ in range(2):
+            async with controller.admit("noisy"):
+                pass
+        with pytest.raises(Rejected) as e:
+            async with controller.admit("noisy"):
+                pass
+        assert 0 < e.value.retry_after <= 1
+        # other dbs have buckets of their own
+        async with controller.admit("quiet"):
+            pass
+        return controller.metrics()
+
+    metrics = asyncio.run(run())
+    assert metrics["noisy"]["admitted"] == 2 and metrics["noisy"]["rejected"] == 1
+    assert metrics["quiet"]["admitted"] == 1
+
+
+def test_concurrency_cap():
+    async def request(controller, db_name, seconds):
+        async with controller.admit(db_name):
+            await asyncio.sleep(seconds)
+
+    async def run():
+        controller = AdmissionController(max_concurrent=2, max_queued=1, max_queue_wait_ms=200)
+        results = await asyncio.gather(*[request(controller, "noisy", 0.05) for _ in range(4)],
+                                       request(controller, "quiet", 0), return_exceptions=True)
+        # two run, one waits for a slot, the queue is full for the last one
+        assert [isinstance(r, Rejected) for r in results] == [False, False, False, True, False]
+
+        slow = [asyncio.ensure_future(request(controller, "slow", 1)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected):
+            await request(controller, "slow", 0)
+        for task in slow:
+            task.cancel()
+        return controller.metrics()
+
+    metrics = asyncio.run(run())
+    assert metrics["noisy"]["queue_wait_ms"]["count"] == 3
+    assert metrics["noisy"]["queue_wait_ms"]["max"] >= 40
+    assert metrics["noisy"]["in_flight"] == 0 and metrics["noisy"]["queued"] == 0
+    assert metrics["slow"]["rejected"] == 1
+
+
+def test_rejected_requests_take_no_token():
+    async def request(controller, seconds):
+        async with controller.admit("noisy"):
+            await asyncio.sleep(seconds)
+
+    async def run():
+        controller = AdmissionController(rate=0.1, burst=2, max_concurrent=1, max_queued=0)
+        first = asyncio.ensure_future(request(controller, 0.05))
+        await asyncio.sleep(0)
+        # the queue is full, the token is left for the next request
+        with pytest.raises(Rejected):
+            await request(controller, 0)
+        await first
+        await request(controller, 0)
+        return controller.metrics()
+
+    metrics = asyncio.run(run())
+    assert metrics["noisy"]["admitted"] == 2 and metrics["noisy"]["rejected"] == 1
+
+
+def test_idle_dbs_are_forgotten():
+    async def run():
+        controller = AdmissionController(max_concurrent=1, max_dbs=2)
+        async with controller.admit("busy"):
+            for i in range(5):
+                async with controller.admit("db%d" % i):
+                    pass
+            # the db holding a slot keeps its state
+            assert list(controller.dbs) == ["busy", "db4"]
+
+    asyncio.run(run())
@@ -0,0 +1,105 @@
+import time
+
+from pgfire.client import PgfireClient
+
+TEST_PORT = 8667
+process = None
+
+
+def get_test_config():
+    return {
+        "db": {
+            "engine": "memory"
+        },
+        "stream_body_threshold": 4096
+    }
+
+
+def setup_module(module):
+    start_app()
+
+
+def teardown_module(module):
+    stop_app()
+
+
+def stop_app():
+    global process
+    process.terminate()
+    process.join()
+
+
+def __start_app():
+    from app import prepare_app
+    from aiohttp import web
+    app = prepare_app()
+    # override test config
+    app['config'] = get_test_config()
+    web.run_app(app, host="localhost", port=TEST_PORT)
+
+
+def start_app():
+    global process
+    from multiprocessing import Process
+
+    process = Process(target=__start_app)
+    process.start()
+    time.sleep(2)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_read_write():
+    with PgfireClient("http://localhost:%s" % TEST_PORT) as client:
+        json_db = client.create_db("client_db")
+        assert json_db.put("blog/a", {"title": "a", "body": "..."}) == {"title": "a", "body": "..."}
+        json_db.patch("blog/a", {"created": 1})
+        posted_data = json_db.post("posts", {"t": 1})
+        assert json_db.get("posts") == posted_data
+        assert json_db.increment("n") == 1
+        assert json_db.get("blog", fields=["title"]) == {"a": {"title": "a"}}
+        assert json_db.get_page("blog", 1) == ({"a": {"title": "a", "body": "...", "created": 1}}, None)
+        assert json_db.delete("blog/a")
+        assert json_db.get("blog") is None
+
+        with json_db.batch() as batch:
+            for i in range(20):
+                batch.put("items/%s" % i, i)
+            batch.increment("n")
+        assert batch.results == list(range(20)) + [2]
+        assert len(json_db.get("items")) == 20
+
+        # bodies above stream_body_threshold are streamed and answered without the value
+        large = dict(("k%03d" % i, "x" * 100) for i in range(100))
+        assert json_db.put("large", large) is None
+        assert json_db.patch("large", dict(("k%03d" % i, "y" * 100) for i in range(100, 200))) is None
+        assert json_db.get("large/k000") == "x" * 100
+        assert len(json_db.get("large")) == 200
+
+
+def test_subscription_cache():
+    with PgfireClient("http://localhost:%s" % TEST_PORT) as client:
+        json_db = client.create_db("client_cache_db")
+        json_db.put("blog/a", {"title": "a"})
+        subscription = json_db.subscribe("blog")
+        assert subscription.wait_synced(5)
+
+        with PgfireClient("http://localhost:%s" % TEST_PORT) as writer:
+            other = writer.db("client_cache_db")
+            other.put("blog/b", {"title": "b"})
+            other.patch("blog/a", {"created": 1})
+            other.put("bloggers/x", 1)
+            other.delete("blog/b")
+            other.put("blog/c", 3)
+
+        assert wait_for(lambda: json_db.cache.get("blog", {}).get("c") == 3)
+        # served from the local copy, no request is sent
+        json_db.client.session.close()
+        assert json_db.get("blog") == {"a": {"title": "a", "created": 1}, "c": 3}
+        assert json_db.get("blog/a/title") == "a"
+        assert "bloggers" not in json_db.cache
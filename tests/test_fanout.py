@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from pgfire.engine.storage.memory import MemoryJsonStorage
+from pgfire.rest.fanout import EventFanout, sse_frame
+
+
+def test_sse_frame():
+    assert sse_frame({"event": "put", "path": "a", "data": 1}) == \
+        b'data: {"event": "put", "path": "a", "data": 1}\r\n\r\n'
+
+
+def test_frames_encoded_once():
+    async def run(storage):
+        json_db = storage.create_db("test_db")
+        fanout = EventFanout(storage)
+        async with fanout.subscribe("test_db", "a") as a1, fanout.subscribe("test_db", "a") as a2, \
+                fanout.subscribe("test_db", "a/x") as ax, fanout.subscribe("test_db", None) as root:
+            # streams of the same first key share a notifier
+            assert len(fanout.feeds) == 2
+            json_db.put("a/y", 1)
+            json_db.put("b", 2)
+            frames = [await asyncio.wait_for(q.get(), 1) for q in (a1, a2, root, root)]
+            assert frames[0] is frames[1]
+            assert [json.loads(f[len(b"data: "):]) for f in frames[1:]] == [
+                {"event": "put", "path": "a/y", "data": 1},
+                {"event": "put", "path": "a/y", "data": 1},
+                {"event": "put", "path": "b", "data": 2},
+            ]
+            assert ax.empty()
+            assert fanout.feeds[("test_db", "a")].encoded == 1
+            json_db.put("a/z", 3)
+            await asyncio.wait_for(root.get(), 1)
+            assert fanout.queue_sizes() == {"test_db/a": {"notifier": 0, "streams": [1, 1, 0]},
+                                            "test_db/": {"notifier": 0, "streams": [0]}}
+            assert fanout.subscriber_counts() == {"test_db": 4}
+        assert fanout.feeds == {}
+
+        async with fanout.subscribe("test_db", "a") as a1:
+            await fanout.close()
+        assert fanout.feeds == {}
+
+    with MemoryJsonStorage({}) as storage:
+        asyncio.run(run(storage))
+
+
+def test_slow_subscriber_dropped():
+    async def run(storage):
+        json_db = storage.create_db("test_db")
+        fanout = EventFanout(storage, max_queued=2)
+        async with fanout.subscribe("test_db", None) as slow, fanout.subscribe("test_db", None) as fast:
+            for i in range(3):
+                json_db.put("a", i)
+                await asyncio.wait_for(fast.get(), 1)
+            # the slow one missed the third event, what it had queued is dropped with it
+            assert await asyncio.wait_for(slow.get(), 1) is None
+            assert slow.empty()
+            feed = fanout.feeds[("test_db", "")]
+            assert feed.dropped == 1 and list(feed.subscribers) == [fast]
+            json_db.put("a", 3)
+            assert json.loads((await asyncio.wait_for(fast.get(), 1))[len(b"data: "):])["data"] == 3
+            assert slow.empty()
+        assert fanout.feeds == {}
+
+    with MemoryJsonStorage({}) as storage:
+        asyncio.run(run(storage))
@@ -0,0 +1,76 @@
+from pgfire.engine.storage.memory import MemoryJsonStorage
+from pgfire.rest.live_query import LiveQuery
+
+
+def test_window_of_last_children():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        for key, ts in (("a", 1), ("b", 2), ("c", 3)):
+            json_db.put("blog/%s" % key, {"ts": ts})
+        json_db.put("users/x", 1)
+        with storage.get_notifier("test_db", "blog") as notifier:
+            stream = notifier.listen()
+            live_query = LiveQuery(json_db, "blog", "ts", limit_to_last=2)
+            assert live_query.load() == {"b": {"ts": 2}, "c": {"ts": 3}}
+
+            def write(fn, *args):
+                fn(*args)
+                return live_query.apply(next(stream))
+
+            assert write(json_db.put, "blog/d", {"ts": 4}) == [
+                {"event": "exit", "key": "b"},
+                {"event": "enter", "key": "d", "data": {"ts": 4}},
+            ]
+            # outside of the window, read from storage and left out
+            assert write(json_db.put, "blog/a/ts", 0) == []
+            assert write(json_db.put, "blog/e", {"title": "no ts"}) == []
+            assert write(json_db.patch, "blog/c", {"title": "c"}) == [
+                {"event": "update", "key": "c", "data": {"ts": 3, "title": "c"}}
+            ]
+            # a write changing nothing sends no event
+            json_db.put("blog/c/title", "c")
+            assert next(stream) is None
+            assert live_query.refreshes == 0
+            # the place of a member leaving a full window is taken by the next child
+            assert write(json_db.delete, "blog/d") == [
+                {"event": "exit", "key": "d"},
+                {"event": "enter", "key": "b", "data": {"ts": 2}},
+            ]
+            assert write(json_db.put, "blog/c/ts", -1) == [
+                {"event": "exit", "key": "c"},
+                {"event": "enter", "key": "a", "data": {"ts": 0}},
+            ]
+            assert live_query.refreshes == 2
+            assert list(live_query.window) == ["a", "b"]
+            assert write(json_db.put, "blog", {"b": {"ts": 2}}) == [{"event": "exit", "key": "a"}]
+            assert live_query.window == json_db.query("blog", "ts", limit_to_last=2)
+
+
+def test_window_of_range():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        json_db.put("scores", {"a": 10, "b": 20})
+        with storage.get_notifier("test_db", "scores") as notifier:
+            stream = notifier.listen()
+            live_query = LiveQuery(json_db, "scores", "score", start_at=15, end_at=30, limit_to_first=2)
+            assert live_query.load() == {}
+
+            live_query = LiveQuery(json_db, "scores", "score")
+            json_db.put("scores", {"a": {"score": 10}, "b": {"score": 20}})
+            assert live_query.apply(next(stream)) == [
+                {"event": "enter", "key": "a", "data": {"score": 10}},
+                {"event": "enter", "key": "b", "data": {"score": 20}},
+            ]
+            live_query = LiveQuery(json_db, "scores", "score", start_at=15, end_at=30, limit_to_first=2)
+            assert live_query.load() == {"b": {"score": 20}}
+            json_db.put("scores/c", {"score": 25})
+            json_db.put("scores/b/score", 40)
+            json_db.put("scores/a/score", 15)
+            assert [change for _ in range(3) for change in live_query.apply(next(stream))] == [
+                {"event": "enter", "key": "c", "data": {"score": 25}},
+                {"event": "exit", "key": "b"},
+                {"event": "enter", "key": "a", "data": {"score": 15}},
+            ]
+            # b left the range of a full window
+            assert live_query.refreshes == 1
+            assert list(live_query.window) == ["a", "c"]
@@ -0,0 +1,222 @@
+import os
+import time
+
+import pytest
+
+from pgfire.engine.storage.memory import MemoryJsonStorage
+
+
+def test_get_put_patch_post_delete():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        assert storage.get_db("test_db") is json_db
+        assert storage.get_db("missing") is None
+
+        assert json_db.put("a/b/c", {"d": 1}) == {"d": 1}
+        json_db.put("a/x", 1)
+        json_db.put("a/x/y", 2)
+        assert json_db.get("a") == {"b": {"c": {"d": 1}}, "x": {"y": 2}}
+        json_db.patch("a/b/c", {"e": 2})
+        assert json_db.get("a/b/c") == {"d": 1, "e": 2}
+        posted_data = json_db.post("posts", {"t": 1})
+        assert json_db.get("posts") == posted_data
+        assert json_db.get("missing/path") is None
+
+        assert json_db.delete("a/b/c")
+        assert not json_db.delete("a/b/c")
+        assert json_db.get("a") == {"x": {"y": 2}}
+        assert json_db.delete("a/x/y")
+        assert json_db.get(None) == {"posts": posted_data}
+        with pytest.raises(ValueError):
+            json_db.put("", 1)
+
+        assert storage.get_all_dbs() == ["test_db"]
+        assert storage.delete_db("test_db")
+        assert storage.get_db("test_db") is None
+
+
+def test_atomic_fields_and_pages():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        assert [json_db.increment("n") for _ in range(3)] == [1, 2, 3]
+        assert json_db.max("n", 2) == 3 and json_db.min("n", 2) == 2
+        assert json_db.append("l", 1) == [1] and json_db.append("l", 2) == [1, 2]
+        assert json_db.remove_from_array("l", 1) == [2]
+        # elements compare as in jsonb, true is not 1 but 1.0 is
+        json_db.put("flags", [True, 1, 1.0, "1"])
+        assert json_db.remove_from_array("flags", 1) == [True, "1"]
+        assert json_db.remove_from_array("flags", True) == ["1"]
+        with pytest.raises(ValueError):
+            json_db.increment("n", "1")
+
+        for key in ("c", "a", "b"):
+            json_db.put("blog/%s" % key, {"title": key, "body": "..."})
+        assert json_db.get("blog", fields=["title"]) == {"a": {"title": "a"}, "b": {"title": "b"},
+                                                         "c": {"title": "c"}}
+        assert json_db.get_page("blog", 2, fields=["title"]) == ({"a": {"title": "a"}, "b": {"title": "b"}}, "b")
+        assert json_db.get_page("blog", 2, "b") == ({"c": {"title": "c", "body": "..."}}, None)
+
+
+def test_children_writer():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        json_db.put("old", 1)
+        with storage.children_writer("test_db", None) as writer:
+            writer.write({"a": {"b": 1}, "c": 2})
+        with storage.children_writer("test_db", "a", "patch") as writer:
+            writer.write({"d": 3})
+        assert json_db.get(None) == {"a": {"b": 1, "d": 3}, "c": 2}
+
+
+def test_replace():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        json_db.put("a", {"x": 1, "y": 2})
+        json_db.put("c", 1)
+        with storage.get_notifier("test_db", None) as notifier:
+            stream = notifier.listen()
+            assert json_db.replace(None, {"a": {"x": 1, "y": 2}, "b": True}) == 2
+            assert json_db.replace("a", {"x": 1, "y": 2}) == 0
+            assert json_db.replace("a", {"x": 1, "z": 3}) == 2
+            assert json_db.replace("a/x", [1]) == 1
+            events = [next(stream) for _ in range(5)]
+        assert events == [
+            {"event": "put", "path": "b", "data": True},
+            {"event": "delete", "path": "c", "data": None},
+            {"event": "put", "path": "a/z", "data": 3},
+            {"event": "delete", "path": "a/y", "data": None},
+            {"event": "put", "path": "a/x", "data": [1]},
+        ]
+        assert json_db.get(None) == {"a": {"x": [1], "z": 3}, "b": True}
+        with pytest.raises(ValueError):
+            json_db.replace(None, 1)
+
+
+def test_unchanged_writes():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        assert json_db.put("a/x", {"y": 1, "z": 2}, report_changed=True) == ({"y": 1, "z": 2}, True)
+        with storage.get_notifier("test_db", None) as notifier:
+            stream = notifier.listen()
+            assert json_db.put("a/x", {"z": 2, "y": 1}, report_changed=True) == ({"z": 2, "y": 1}, False)
+            assert json_db.patch("a/x", {"y": 1}, report_changed=True) == ({"y": 1}, False)
+            assert json_db.put("a/x/z", 2) == 2
+            assert json_db.patch("a/x", {"y": 3}, report_changed=True) == ({"y": 3}, True)
+            assert [next(stream) for _ in range(2)] == [
+                {"event": "patch", "path": "a/x", "data": {"y": 3}}, None
+            ]
+        assert json_db.get("a") == {"x": {"y": 3, "z": 2}}
+
+
+def test_ttl():
+    with MemoryJsonStorage({"ttl_sweep_interval": 0.05, "ttl_sweep_batch": 2}) as storage:
+        json_db = storage.create_db("test_db")
+        for key in ("a", "b", "c"):
+            json_db.put("presence/%s" % key, True, ttl=0.2)
+        json_db.put("presence/d", True, ttl=60)
+        json_db.put("session/x", 1, ttl=0.2)
+        json_db.delete("session")
+        json_db.put("session/x", 2)
+        # a write without ttl above the path cancels it, a patch only for the children it writes
+        json_db.put("kept/b", True, ttl=0.2)
+        json_db.put("kept", {"b": "kept", "c": 2})
+        json_db.put("patched/b", True, ttl=0.2)
+        json_db.put("patched/c", True, ttl=0.2)
+        json_db.patch("patched", {"b": "kept"})
+        with pytest.raises(ValueError):
+            json_db.put("presence/e", True, ttl=0)
+        with storage.get_notifier("test_db", None) as notifier:
+            stream = notifier.listen()
+            events = []
+            deadline = time.monotonic() + 5
+            while len(events) < 4 and time.monotonic() < deadline:
+                event = next(stream)
+                if event is None:
+                    time.sleep(0.05)
+                else:
+                    events.append(event)
+        assert events == [{"event": "delete", "path": path, "data": None}
+                          for path in ("presence/a", "presence/b", "presence/c", "patched/c")]
+        assert json_db.get(None) == {"presence": {"d": True}, "session": {"x": 2},
+                                     "kept": {"b": "kept", "c": 2}, "patched": {"b": "kept"}}
+        assert list(storage.expiries) == [("test_db", "presence/d")]
+
+
+def test_db_stats():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        assert storage.get_db_stats() == {"test_db": {"rows": 0, "bytes": None, "writes": 0, "writes_per_minute": 0}}
+        json_db.put("a/b", 1)
+        json_db.put("a/b", 1)
+        json_db.increment("n")
+        json_db.replace(None, {"a": {"b": 2}, "c": 3, "n": 1})
+        json_db.delete("missing")
+        stats = storage.get_db_stats()["test_db"]
+        # writes changing nothing are not counted
+        assert (stats["rows"], stats["writes"]) == (3, 3)
+        # the writes of the minute before are the rate
+        storage.write_counts["test_db"][1] -= 1
+        assert storage.get_db_stats()["test_db"]["writes_per_minute"] == 3
+        storage.delete_db("test_db")
+        assert storage.get_db_stats() == {}
+
+
+def test_query():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        json_db.put("users/a", {"age": 30, "name": "a"})
+        json_db.put("users/b", {"age": 20, "name": "b"})
+        json_db.put("users/c", {"name": "c"})
+        json_db.put("users/d", {"age": 20, "name": "d"})
+        json_db.put("users/e", {"age": "old"})
+        json_db.put("users/f", {"age": True})
+        json_db.put("users/g", {"age": None})
+
+        # same order as jsonb values in postgres
+        assert list(json_db.query("users", "age")) == ["c", "g", "e", "b", "d", "a", "f"]
+        assert json_db.query("users", "age", start_at=20, end_at=29, fields=["name"]) == {
+            "b": {"name": "b"}, "d": {"name": "d"}}
+        assert list(json_db.query("users", "age", start_at=20, limit_to_first=2)) == ["b", "d"]
+        assert list(json_db.query("users", "age", end_at=30, limit_to_last=2)) == ["d", "a"]
+        assert list(json_db.query(None, "age")) == ["users"]
+        # strings by code point, postgres orders them by the collation of its database
+        for key, name in (("h", "b"), ("i", "B"), ("j", "_")):
+            json_db.put("names/%s" % key, {"name": name})
+        assert list(json_db.query("names", "name")) == ["i", "j", "h"]
+        assert json_db.query("users/a/age", "age") == {}
+        with pytest.raises(ValueError):
+            json_db.query("users", "age", limit_to_last=0)
+
+
+def test_notifications():
+    with MemoryJsonStorage({}) as storage:
+        json_db = storage.create_db("test_db")
+        with storage.get_notifier("test_db", "a") as notifier:
+            stream = notifier.listen()
+            json_db.put("a/b", 1)
+            json_db.put("c", 2)
+            json_db.increment("a/n")
+            json_db.delete("a/b")
+            events = []
+            for data in stream:
+                if data is None:
+                    break
+                events.append(data)
+        assert events == [
+            {"event": "put", "path": "a/b", "data": 1},
+            {"event": "put", "op": "increment", "path": "a/n", "data": 1},
+            {"event": "delete", "path": "a/b", "data": None},
+        ]
+
+
+def test_snapshot(tmp_path):
+    snapshot_file = str(tmp_path / "pgfire.snapshot")
+    settings = {"snapshot_file": snapshot_file, "snapshot_interval": 0.05}
+    with MemoryJsonStorage(settings) as storage:
+        storage.create_db("test_db").put("a/b", [1, "x"])
+        time.sleep(0.2)
+        assert os.path.getsize(snapshot_file) > 0
+        storage.get_db("test_db").put("c", True)
+
+    with MemoryJsonStorage(settings) as storage:
+        assert storage.get_db("test_db").get(None) == {"a": {"b": [1, "x"]}, "c": True}
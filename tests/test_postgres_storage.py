@@ -1,12 +1,19 @@
+import json
 import threading
+import time
 from contextlib import contextmanager
 
+import pytest
 import sqlalchemy as sa
 from sqlalchemy import exc
 
 from pgfire.engine.storage.postgres import PostgresJsonStorage, BaseJsonDb
+from pgfire.engine.storage.postgres.models import PathExpiry
+from pgfire.engine.storage.postgres.statements import subtree_channel
 
 TEST_DB_NAME = 'test_pgfire'
+# second shard of the sharded storage tests
+TEST_SHARD_DB_NAME = 'test_pgfire_shard2'
 
 
 def get_test_db_settings():
@@ -55,6 +62,8 @@ def setup_module(module):
             conn.execute("ROLLBACK")
 
         conn.execute("CREATE DATABASE %s" % TEST_DB_NAME)
+        conn.execute("DROP DATABASE IF EXISTS %s" % TEST_SHARD_DB_NAME)
+        conn.execute("CREATE DATABASE %s" % TEST_SHARD_DB_NAME)
 
 
 def teardown_module(module):
@@ -79,6 +88,37 @@ def test_pgstorage_init():
     assert data
 
 
+def test_schema_installed_once():
+    """
+    DDL runs only when the installed schema version is missing or older than the code
+    :return:
+    """
+    from pgfire.engine.storage.postgres.schema import SCHEMA_VERSION, CORE_SCHEMA
+    db_settings = get_test_db_settings()
+    PostgresJsonStorage(db_settings).close()
+    with db_connection(TEST_DB_NAME) as con:
+        assert con.execute("select version from pgfire_schema where component='%s'"
+                           % CORE_SCHEMA).scalar() == SCHEMA_VERSION
+        # an up to date schema is not installed again
+        con.execute("drop function jsonb_atomic_apply(jsonb, text, jsonb)")
+        PostgresJsonStorage(db_settings).close()
+        assert con.execute("select to_regproc('jsonb_atomic_apply')").scalar() is None
+
+        # nor is a newer one, installed by a later release
+        con.execute("update pgfire_schema set version = %d where component='%s'" % (SCHEMA_VERSION + 1, CORE_SCHEMA))
+        PostgresJsonStorage(db_settings).close()
+        assert con.execute("select to_regproc('jsonb_atomic_apply')").scalar() is None
+        assert con.execute("select version from pgfire_schema where component='%s'"
+                           % CORE_SCHEMA).scalar() == SCHEMA_VERSION + 1
+
+        # an outdated schema is
+        con.execute("update pgfire_schema set version = 0 where component='%s'" % CORE_SCHEMA)
+        PostgresJsonStorage(db_settings).close()
+        assert con.execute("select to_regproc('jsonb_atomic_apply')").scalar()
+        assert con.execute("select version from pgfire_schema where component='%s'"
+                           % CORE_SCHEMA).scalar() == SCHEMA_VERSION
+
+
 def test_create_db():
     """
     storage will create a table for every Json db
@@ -331,9 +371,893 @@ def test_change_notification2():
         assert data_received_count2 == 1
 
 
+def test_replica_read_your_writes():
+    """
+    reads are routed to replicas, a read with the lsn of a write sees the write.
+    the primary is registered as its own replica, it always has zero lag.
+    :return:
+    """
+    test_db_name = "test_db_replica"
+    db_settings = get_test_db_settings()
+    db_settings["replicas"] = [{"host": db_settings["host"]}]
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        json_db = pg_storage.create_db(test_db_name)
+        try:
+            json_db.put("a/b", 1)
+            lsn = pg_storage.last_write_lsn
+            assert lsn
+            assert json_db.get("a/b", lsn) == 1
+            assert test_db_name in pg_storage.get_all_dbs(lsn)
+
+            # a replica lagging more than allowed is out of rotation
+            with PostgresJsonStorage(dict(db_settings, max_replica_lag_bytes=-1)) as lagging_storage:
+                assert lagging_storage.replicas.choose() is None
+                assert lagging_storage.get_db(test_db_name).get("a/b") == 1
+        finally:
+            pg_storage.delete_db(test_db_name)
+
+
+def test_atomic_operations():
+    test_db_name = "test_db_atomic"
+    db_settings = get_test_db_settings()
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        json_db = pg_storage.create_db(test_db_name)
+        notifier = pg_storage.get_notifier(test_db_name, 'counters')
+        message_stream = notifier.listen()
+
+        assert json_db.increment("counters/views") == 1
+        assert json_db.increment("counters/views", 5) == 6
+        assert json_db.increment("counters/views", -0.5) == 5.5
+        assert json_db.max("counters/high", 3) == 3
+        assert json_db.max("counters/high", 2) == 3
+        assert json_db.min("counters/high", 1) == 1
+
+        assert json_db.append("tags", "a") == ["a"]
+        assert json_db.append("tags", {"b": 1}) == ["a", {"b": 1}]
+        assert json_db.append("tags", "a") == ["a", {"b": 1}, "a"]
+        assert json_db.remove_from_array("tags", "a") == [{"b": 1}]
+        assert json_db.get(None) == {"counters": {"views": 5.5, "high": 1}, "tags": [{"b": 1}]}
+
+        with pytest.raises(ValueError):
+            json_db.increment("counters/views", "1")
+
+        import time
+        time.sleep(1)
+        events = []
+        for data in message_stream:
+            if data is None:
+                break
+            events.append(data)
+        notifier.cleanup()
+        assert len(events) == 6
+        assert {"event": "put", "op": "increment", "path": "counters/views", "data": 1} in events
+        assert {"event": "put", "op": "min", "path": "counters/high", "data": 1} in events
+
+
+def test_db_meta_cache_sync():
+    """
+    dbs created or deleted by another storage instance are seen without querying storage_meta
+    :return:
+    """
+    test_db_name = "test_db_meta_sync"
+    db_settings = get_test_db_settings()
+    with PostgresJsonStorage(db_settings) as pg_storage1, PostgresJsonStorage(db_settings) as pg_storage2:
+        assert pg_storage2.db_meta.synced
+        assert pg_storage2.get_db(test_db_name) is None
+
+        pg_storage1.create_db(test_db_name)
+        import time
+        time.sleep(1)
+        assert test_db_name in pg_storage2.db_meta
+        assert pg_storage2.get_db(test_db_name)
+
+        pg_storage1.delete_db(test_db_name)
+        time.sleep(1)
+        assert test_db_name not in pg_storage2.db_meta
+        assert pg_storage2.get_db(test_db_name) is None
+
+        # created again after delete
+        pg_storage2.create_db(test_db_name)
+        time.sleep(1)
+        assert pg_storage1.get_db(test_db_name)
+
+
+def test_shared_layout():
+    """
+    all dbs in one partitioned table, no table is created per db
+    :return:
+    """
+    test_db_name = "test_db_shared"
+    db_settings = get_test_db_settings()
+    db_settings["layout"] = "shared"
+    db_settings["shared_partitions"] = 4
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        json_db = pg_storage.create_db(test_db_name)
+        other_db = pg_storage.create_db(test_db_name + "_other")
+        with db_connection(TEST_DB_NAME) as con:
+            result = con.execute("select * from information_schema.tables where table_name='%s'"
+                                 % test_db_name)
+            assert result.fetchone() is None
+            result.close()
+
+        json_db.put("a/b", {"c": 1})
+        other_db.put("a/b", 2)
+        json_db.patch("a/b", {"d": 2})
+        assert json_db.increment("a/n") == 1
+        posted_data = json_db.post("posts", {"t": 1})
+        assert json_db.get("a") == {"b": {"c": 1, "d": 2}, "n": 1}
+        assert json_db.get(None) == {"a": {"b": {"c": 1, "d": 2}, "n": 1}, "posts": posted_data}
+        assert other_db.get(None) == {"a": {"b": 2}}
+
+        assert pg_storage.delete_db(test_db_name)
+        assert pg_storage.get_db(test_db_name) is None
+        assert other_db.get("a/b") == 2
+
+
+def test_migrate_to_shared_layout():
+    from pgfire.engine.storage.postgres.migrate import migrate_to_shared_layout
+    migrate_db_name = TEST_DB_NAME + "_migrate"
+    with db_connection() as conn:
+        conn = conn.execution_options(autocommit=False)
+        conn.execute("ROLLBACK")
+        conn.execute("DROP DATABASE IF EXISTS %s" % migrate_db_name)
+        conn.execute("CREATE DATABASE %s" % migrate_db_name)
+
+    db_settings = get_test_db_settings()
+    db_settings["db"] = migrate_db_name
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        pg_storage.create_db("db_a").put("x/y", 1)
+        pg_storage.create_db("db_b").put("z", [1, 2])
+
+    assert sorted(migrate_to_shared_layout(db_settings, log=lambda msg: None)) == ["db_a", "db_b"]
+    assert migrate_to_shared_layout(db_settings, log=lambda msg: None) == []
+
+    db_settings["layout"] = "shared"
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        assert pg_storage.get_db("db_a").get(None) == {"x": {"y": 1}}
+        assert pg_storage.get_db("db_b").get("z") == [1, 2]
+
+
+def test_group_commit():
+    """
+    concurrent writes share transactions, each caller gets its own result
+    :return:
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    test_db_name = "test_db_group_commit"
+    db_settings = get_test_db_settings()
+    db_settings["group_commit"] = True
+    db_settings["group_commit_window_ms"] = 5
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        json_db = pg_storage.create_db(test_db_name)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(lambda i: json_db.put("items/%s" % i, {"i": i}), range(200)))
+            counters = list(executor.map(lambda i: json_db.increment("counter"), range(50)))
+        assert results == [{"i": i} for i in range(200)]
+        assert sorted(counters) == list(range(1, 51))
+        assert len(json_db.get("items")) == 200
+
+        # a failing write does not fail the writes batched with it
+        missing_db = BaseJsonDb("test_db_group_commit_missing", pg_storage)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            failed = executor.submit(missing_db.put, "a", 1)
+            succeeded = executor.submit(json_db.put, "b", 2)
+            with pytest.raises(Exception):
+                failed.result()
+            assert succeeded.result() == 2
+        assert json_db.get("b") == 2
+
+
+def test_delete_removes_keys():
+    """
+    delete removes the key instead of writing null, emptied parents and rows go with it
+    :return:
+    """
+    test_db_name = "test_db_delete"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            notifier = pg_storage.get_notifier(test_db_name, 'a')
+            message_stream = notifier.listen()
+
+            json_db.put("a/b/c", 1)
+            json_db.put("a/d", 2)
+            json_db.put("e", 3)
+
+            assert json_db.delete("a/b/c")
+            assert json_db.get("a") == {"d": 2}
+            assert not json_db.delete("a/b/c")
+
+            assert json_db.delete("a/d")
+            assert json_db.get(None) == {"e": 3}
+            cls = pg_storage.layout.table(test_db_name)
+            assert pg_storage.layout.scope(pg_storage.session.query(cls.l1_key), test_db_name).all() == [("e",)]
+
+            import time
+            time.sleep(1)
+            events = []
+            for data in message_stream:
+                if data is None:
+                    break
+                events.append(data)
+            notifier.cleanup()
+            assert {"event": "delete", "path": "a/b/c", "data": None} in events
+            assert len([e for e in events if e["event"] == "delete"]) == 2
+            pg_storage.delete_db(test_db_name)
+
+
+def test_write_statements_prepared_once():
+    """
+    write statements are prepared once per connection and table, then reused
+    :return:
+    """
+    test_db_name = "test_db_prepared"
+    db_settings = get_test_db_settings()
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        json_db = pg_storage.create_db(test_db_name)
+        for i in range(10):
+            json_db.put("a/%s" % i, i)
+            json_db.patch("b", {"p": i})
+        assert json_db.get("a/9") == 9 and json_db.get("b") == {"p": 9}
+        prepared = pg_storage.session.execute(
+            "select count(*) from pg_prepared_statements where name like 'pgfire_write_%%'").scalar()
+        assert prepared == 2
+
+
+def test_get_page():
+    """
+    children are paged in key order, pages continue after the last key of the previous one
+    :return:
+    """
+    test_db_name = "test_db_page"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            for i in range(25):
+                json_db.post("posts", {"i": i})
+            json_db.put("top/b", 2)
+            json_db.put("top/a", 1)
+
+            pages, after = [], None
+            while True:
+                page, after = json_db.get_page("posts", 10, after)
+                pages.append(page)
+                if after is None:
+                    break
+            assert [len(page) for page in pages] == [10, 10, 5]
+            keys = [key for page in pages for key in page]
+            assert keys == sorted(keys)
+            assert [json_db.get("posts")[key]["i"] for key in keys] == list(range(25))
+
+            assert json_db.get_page("top", 1) == ({"a": 1}, "a")
+            assert json_db.get_page("top", 1, "a") == ({"b": 2}, None)
+            assert json_db.get_page("top/a", 10) == ({}, None)
+            assert json_db.get_page(None, 1) == ({"posts": json_db.get("posts")}, "posts")
+            assert json_db.get_page(None, 1, "posts") == ({"top": {"a": 1, "b": 2}}, None)
+            with pytest.raises(ValueError):
+                json_db.get_page("posts", 0)
+            pg_storage.delete_db(test_db_name)
+
+
+def test_get_fields():
+    """
+    only the requested keys of each child are returned, also on pages
+    :return:
+    """
+    test_db_name = "test_db_fields"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            json_db.put("blog/a", {"title": "a", "created": 1, "body": "..."})
+            json_db.put("blog/b", {"title": "b", "body": "..."})
+            json_db.put("blog/c", 3)
+            json_db.put("about", {"title": "about", "body": "..."})
+
+            assert json_db.get("blog", fields=["title", "created"]) == {
+                "a": {"title": "a", "created": 1}, "b": {"title": "b"}, "c": 3}
+            assert json_db.get("blog/c", fields=["title"]) == 3
+            assert json_db.get(None, fields=["title"]) == {
+                "blog": {}, "about": {"title": "about"}}
+            assert json_db.get_page("blog", 1, "a", fields=["title"]) == ({"b": {"title": "b"}}, "b")
+            assert json_db.get_page(None, 1, fields=["title"]) == ({"about": {"title": "about"}}, "about")
+            pg_storage.delete_db(test_db_name)
+
+
+def _next_events(message_stream, count, timeout=10):
+    """
+    the next count events of the stream, which yields None until an event arrives
+    """
+    events = []
+    deadline = time.monotonic() + timeout
+    while len(events) < count and time.monotonic() < deadline:
+        data = next(message_stream)
+        if data is None:
+            time.sleep(0.01)
+        else:
+            events.append(data)
+    return events
+
+
+def test_subtree_channels():
+    """
+    a notifier below the root only receives the changes of its l1_key, one at the root all of them
+    :return:
+    """
+    test_db_name = "test_db_channels"
+    long_key = "k" * 60
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            assert pg_storage.session.execute(sa.text("SELECT json_notify_channel(:c, :k)"), {
+                "c": test_db_name, "k": long_key}).scalar() == subtree_channel(test_db_name, long_key)
+            pg_storage.session.commit()
+
+            root_notifier = pg_storage.get_notifier(test_db_name, None)
+            a_notifier = pg_storage.get_notifier(test_db_name, "a/x")
+            long_notifier = pg_storage.get_notifier(test_db_name, long_key)
+            root_stream, a_stream, long_stream = root_notifier.listen(), a_notifier.listen(), long_notifier.listen()
+            json_db.put("b", 1)
+            json_db.put("a/y", 2)
+            json_db.put(long_key, 3)
+            json_db.replace(None, {"a": {"x": 4}})
+            assert _next_events(root_stream, 6) == [
+                {"event": "put", "path": "b", "data": 1},
+                {"event": "put", "path": "a/y", "data": 2},
+                {"event": "put", "path": long_key, "data": 3},
+                {"event": "put", "path": "a", "data": {"x": 4}},
+                {"event": "delete", "path": "b", "data": None},
+                {"event": "delete", "path": long_key, "data": None},
+            ]
+            assert _next_events(long_stream, 2) == [
+                {"event": "put", "path": long_key, "data": 3},
+                {"event": "delete", "path": long_key, "data": None},
+            ]
+            # only the changes of a reached the listener of a, the stream keeps those at a/x
+            time.sleep(0.5)
+            assert [m["path"] for m in list(a_notifier.message_queue.queue)] == ["a/y", "a"]
+            assert _next_events(a_stream, 1) == [{"event": "put", "path": "a", "data": {"x": 4}}]
+            for notifier in (root_notifier, a_notifier, long_notifier):
+                notifier.cleanup()
+            pg_storage.delete_db(test_db_name)
+
+            # dbs whose names start alike do not share the channels of their long keys
+            first_db, second_db = (pg_storage.create_db("%s_sharing_a_long_prefix_%d" % (test_db_name, i))
+                                   for i in (1, 2))
+            assert subtree_channel(first_db.db_name, long_key) != subtree_channel(second_db.db_name, long_key)
+            first_notifier = pg_storage.get_notifier(first_db.db_name, long_key)
+            first_stream = first_notifier.listen()
+            second_db.put(long_key, 1)
+            first_db.put(long_key, 2)
+            assert _next_events(first_stream, 1) == [{"event": "put", "path": long_key, "data": 2}]
+            time.sleep(0.5)
+            assert list(first_notifier.message_queue.queue) == []
+            first_notifier.cleanup()
+            for json_db in (first_db, second_db):
+                pg_storage.delete_db(json_db.db_name)
+
+
+def test_children_writer():
+    """
+    a large value is written in batches of children in one transaction
+    :return:
+    """
+    test_db_name = "test_db_children_writer"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            json_db.put("old/a", 1)
+            json_db.put("blog/x", {"title": "x"})
+
+            notifier = pg_storage.get_notifier(test_db_name, None)
+            message_stream = notifier.listen()
+            with pg_storage.children_writer(test_db_name, None) as writer:
+                writer.write({"blog": {"a": 1}, "b": 2})
+                # not visible before the commit
+                assert json_db.get("old/a") == 1
+                writer.write({"c": [3]})
+            assert writer.children == 3
+            assert json_db.get(None) == {"blog": {"a": 1}, "b": 2, "c": [3]}
+            # the old rows are deleted, each new child is put
+            events = _next_events(message_stream, 5)
+            notifier.cleanup()
+            assert sorted(e["path"] for e in events[:2]) == ["blog", "old"]
+            assert all(e["event"] == "delete" for e in events[:2])
+            assert {"event": "put", "path": "c", "data": [3]} in events[2:]
+
+            with pg_storage.children_writer(test_db_name, "blog", "patch") as writer:
+                writer.write({"b": {"title": "b"}})
+            with pg_storage.children_writer(test_db_name, "c", "put") as writer:
+                writer.write({"d": 4})
+                writer.write({"e": 5})
+            assert json_db.get("blog") == {"a": 1, "b": {"title": "b"}}
+            assert json_db.get("c") == {"d": 4, "e": 5}
+
+            with pytest.raises(ValueError):
+                with pg_storage.children_writer(test_db_name, None) as writer:
+                    writer.write({"f": 6})
+                    raise ValueError("body ended early")
+            assert json_db.get("b") == 2 and json_db.get("f") is None
+            pg_storage.delete_db(test_db_name)
+
+
+def test_replace():
+    """
+    a replace rewrites only the rows that differ and notifies only the changed children
+    :return:
+    """
+    test_db_name = "test_db_replace"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            json_db.put("a", {"x": 1, "y": 2})
+            json_db.put("b", 1)
+            json_db.put("c", 1)
+            cls = pg_storage.layout.table(test_db_name)
+            modified = dict(pg_storage.layout.scope(
+                pg_storage.session.query(cls.l1_key, cls.last_modified), test_db_name).all())
+            pg_storage.session.commit()
+
+            notifier = pg_storage.get_notifier(test_db_name, None)
+            message_stream = notifier.listen()
+            assert json_db.replace(None, {"a": {"x": 1, "y": 2}, "b": 2, "d": 3}) == 3
+            assert json_db.get(None) == {"a": {"x": 1, "y": 2}, "b": 2, "d": 3}
+            assert _next_events(message_stream, 3) == [
+                {"event": "put", "path": "b", "data": 2},
+                {"event": "put", "path": "d", "data": 3},
+                {"event": "delete", "path": "c", "data": None},
+            ]
+            # the unchanged row is not rewritten
+            assert pg_storage.layout.scope(pg_storage.session.query(cls.last_modified).filter(
+                cls.l1_key == "a"), test_db_name).scalar() == modified["a"]
+            pg_storage.session.commit()
+
+            assert json_db.replace("a", {"x": 1, "y": 2}) == 0
+            assert json_db.replace("a", {"x": 1, "z": {"q": 1}}) == 2
+            assert _next_events(message_stream, 2) in (
+                [{"event": "put", "path": "a/z", "data": {"q": 1}}, {"event": "delete", "path": "a/y", "data": None}],
+                [{"event": "delete", "path": "a/y", "data": None}, {"event": "put", "path": "a/z", "data": {"q": 1}}],
+            )
+            assert json_db.replace("a/x", [1]) == 1
+            assert _next_events(message_stream, 1) == [{"event": "put", "path": "a/x", "data": [1]}]
+            assert json_db.replace("e/f", {"g": 1}) == 1
+            assert _next_events(message_stream, 1) == [{"event": "put", "path": "e/f", "data": {"g": 1}}]
+            notifier.cleanup()
+            assert json_db.get(None) == {"a": {"x": [1], "z": {"q": 1}}, "b": 2, "d": 3, "e": {"f": {"g": 1}}}
+
+            with pytest.raises(ValueError):
+                json_db.replace(None, [1])
+            pg_storage.delete_db(test_db_name)
+
+
+def test_unchanged_writes():
+    """
+    a put or patch leaving the stored value as it is rewrites no row and notifies nothing
+    :return:
+    """
+    test_db_name = "test_db_unchanged"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        db_settings["group_commit"] = layout == "shared"
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            assert json_db.put("a/x", {"y": 1, "z": 2}, report_changed=True) == ({"y": 1, "z": 2}, True)
+            cls = pg_storage.layout.table(test_db_name)
+            modified = pg_storage.layout.scope(pg_storage.session.query(cls.last_modified).filter(
+                cls.l1_key == "a"), test_db_name).scalar()
+            pg_storage.session.commit()
+
+            notifier = pg_storage.get_notifier(test_db_name, None)
+            message_stream = notifier.listen()
+            assert json_db.put("a/x", {"z": 2, "y": 1}, report_changed=True) == ({"z": 2, "y": 1}, False)
+            assert json_db.patch("a/x", {"y": 1}, report_changed=True) == ({"y": 1}, False)
+            assert json_db.put("a/x/z", 2) == 2
+            assert pg_storage.layout.scope(pg_storage.session.query(cls.last_modified).filter(
+                cls.l1_key == "a"), test_db_name).scalar() == modified
+            pg_storage.session.commit()
+
+            assert json_db.patch("a/x", {"y": 3}, report_changed=True) == ({"y": 3}, True)
+            assert json_db.put("a/w", None, report_changed=True) == (None, True)
+            # the first event received is the first change
+            assert _next_events(message_stream, 2) == [
+                {"event": "patch", "path": "a/x", "data": {"y": 3}},
+                {"event": "put", "path": "a/w", "data": None},
+            ]
+            notifier.cleanup()
+            assert json_db.get("a") == {"x": {"y": 3, "z": 2}, "w": None}
+            pg_storage.delete_db(test_db_name)
+
+
+def test_ttl():
+    """
+    paths written with a ttl are deleted by the sweeper in batches, with the usual delete events
+    :return:
+    """
+    test_db_name = "test_db_ttl"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        db_settings["ttl_sweep_interval"] = 0.2
+        db_settings["ttl_sweep_batch"] = 2
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            for key in ("a", "b", "c"):
+                json_db.put("presence/%s" % key, True, ttl=1)
+            json_db.put("presence/d", True, ttl=60)
+            json_db.put("session/x", 1, ttl=1)
+            # a delete above the path cancels its ttl
+            json_db.delete("session")
+            json_db.put("session/x", 2)
+            # a write without ttl above the path cancels it, a patch only for the children it writes
+            json_db.put("kept/b", True, ttl=1)
+            json_db.put("kept", {"b": "kept", "c": 2})
+            json_db.put("patched/b", True, ttl=1)
+            json_db.put("patched/c", True, ttl=1)
+            json_db.patch("patched", {"b": "kept"})
+            with pytest.raises(ValueError):
+                json_db.put("presence/e", True, ttl=0)
+
+            notifier = pg_storage.get_notifier(test_db_name, None)
+            message_stream = notifier.listen()
+            assert _next_events(message_stream, 4) == [
+                {"event": "delete", "path": path, "data": None}
+                for path in ("presence/a", "presence/b", "presence/c", "patched/c")
+            ]
+            notifier.cleanup()
+            assert json_db.get(None) == {"presence": {"d": True}, "session": {"x": 2},
+                                         "kept": {"b": "kept", "c": 2}, "patched": {"b": "kept"}}
+            assert pg_storage.sweep_expired() == 0
+            db_id = pg_storage.db_meta.id_of(test_db_name)
+            assert pg_storage.session.query(PathExpiry.path).filter(PathExpiry.db_id == db_id).all() == [
+                ("presence/d",)]
+            pg_storage.session.commit()
+            pg_storage.delete_db(test_db_name)
+            assert pg_storage.session.query(PathExpiry).filter(PathExpiry.db_id == db_id).count() == 0
+            pg_storage.session.commit()
+
+
+def test_db_stats():
+    """
+    rows, bytes and writes of a db are kept by its writes and agree with a count of its data
+    :return:
+    """
+    test_db_name = "test_db_stats"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        db_settings["group_commit"] = layout == "shared"
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            assert pg_storage.get_db_stats()[test_db_name] == {
+                "rows": 0, "bytes": 0, "writes": 0, "writes_per_minute": 0}
+            json_db.put("a/b", 1)
+            json_db.put("a/b", 1)
+            json_db.put("big", {"x": "y" * 10000})
+            json_db.patch("a", {"c": 2})
+            json_db.increment("n")
+            json_db.delete("big/x")
+            json_db.replace("a", {"d": [1, 2]})
+            with pg_storage.children_writer(test_db_name, "", "patch") as writer:
+                writer.write(dict(("i%d" % i, i) for i in range(5)))
+            # a rolled back write is not counted
+            with pytest.raises(RuntimeError):
+                with pg_storage.children_writer(test_db_name, "", "patch") as writer:
+                    writer.write({"j": 1})
+                    raise RuntimeError()
+            stats = pg_storage.get_db_stats()[test_db_name]
+            # the unchanged put is not a write
+            assert stats["rows"] == 7
+            # a batch of the children writer is one write
+            assert stats["writes"] == 7
+            # rows hold the children of the root, measured as jsonb before compression
+            with pg_storage.engine.connect() as conn:
+                assert stats["bytes"] == conn.execute(sa.text(
+                    "SELECT sum(pg_column_size(jsonb_build_object(key, value))) FROM jsonb_each(CAST(:doc AS jsonb))"
+                ), {"doc": json.dumps(json_db.get(None))}).scalar()
+
+            pg_storage.recount_stats([test_db_name])
+            assert pg_storage.get_db_stats()[test_db_name] == stats
+
+            # writers of two processes creating the same row count it once
+            with PostgresJsonStorage(db_settings) as other_storage:
+                other_db = other_storage.get_db(test_db_name)
+                threads = [threading.Thread(target=db.put, args=("k/%s" % name, 1))
+                           for name, db in (("t1", json_db), ("t2", other_db))]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                other_storage.db_stats.flush()
+            assert pg_storage.get_db_stats()[test_db_name]["rows"] == 8
+            json_db.delete("k")
+
+            # writes counted in the minute before are the rate
+            db_id = pg_storage.db_meta.id_of(test_db_name)
+            with pg_storage.engine.begin() as conn:
+                # the writes above may have been flushed in two minutes
+                minute_writes = conn.execute(sa.text(
+                    "UPDATE db_stats SET minute = date_trunc('minute', now()) - interval '1 minute' "
+                    "WHERE db_id = :id RETURNING minute_writes"
+                ), {"id": db_id}).scalar()
+            assert 0 < minute_writes <= 10
+            assert pg_storage.get_db_stats()[test_db_name]["writes_per_minute"] == minute_writes
+            json_db.put("a/e", True)
+            assert pg_storage.get_db_stats()[test_db_name]["writes_per_minute"] == minute_writes
+            pg_storage.delete_db(test_db_name)
+            assert test_db_name not in pg_storage.get_db_stats()
+            with pg_storage.engine.connect() as conn:
+                assert conn.execute(sa.text("SELECT count(*) FROM db_stats WHERE db_id = :id"),
+                                    {"id": db_id}).scalar() == 0
+
+
+def test_query():
+    """
+    children are ordered by the value at a child path, children without it come first
+    :return:
+    """
+    test_db_name = "test_db_query"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            json_db.put("users/a", {"age": 30, "name": "a"})
+            json_db.put("users/b", {"age": 20, "name": "b"})
+            json_db.put("users/c", {"name": "c"})
+            json_db.put("users/d", {"age": 20, "name": "d"})
+            json_db.put("users/e", {"age": "old"})
+            json_db.put("u1", {"age": 3})
+            json_db.put("u2", {"age": 1})
+
+            assert list(json_db.query("users", "age")) == ["c", "e", "b", "d", "a"]
+            assert json_db.query("users", "age", start_at=20, end_at=29, fields=["name"]) == {
+                "b": {"name": "b"}, "d": {"name": "d"}}
+            assert list(json_db.query("users", "age", start_at=20, limit_to_first=2)) == ["b", "d"]
+            assert list(json_db.query("users", "age", end_at=30, limit_to_last=2)) == ["d", "a"]
+            assert json_db.query("users", "age", start_at="old", end_at="old") == {"e": {"age": "old"}}
+            assert list(json_db.query(None, "age")) == ["users", "u2", "u1"]
+            assert json_db.query(None, "age", start_at=2) == {"u1": {"age": 3}}
+            assert json_db.query("users/a", "age") == {"age": 30, "name": "a"}
+            assert json_db.query("users/a/age", "age") == {}
+            with pytest.raises(ValueError):
+                json_db.query("users", "age", limit_to_first=0)
+
+            # strings follow the collation of the database, the memory storage orders them by code point
+            for key, name in (("h", "b"), ("i", "B"), ("j", "_")):
+                json_db.put("names/%s" % key, {"name": name})
+            collated = [row[0] for row in pg_storage.session.execute(
+                "SELECT s FROM unnest(ARRAY['b', 'B', '_']) s ORDER BY s").fetchall()]
+            pg_storage.session.rollback()
+            assert [json_db.get("names/%s/name" % key) for key in json_db.query("names", "name")] == collated
+            pg_storage.delete_db(test_db_name)
+
+
+def test_durability():
+    """
+    writes of dbs that are not durable commit without waiting for the WAL flush, unlogged dbs have unlogged tables
+    :return:
+    """
+    db_settings = get_test_db_settings()
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        statements = []
+        sa.event.listen(pg_storage.engine, "before_cursor_execute",
+                        lambda conn, cursor, statement, *args: statements.append(statement))
+
+        def relaxed(write):
+            del statements[:]
+            write()
+            return "SET LOCAL synchronous_commit TO OFF" in statements
+
+        def persistence(db_name):
+            return pg_storage.session.execute(sa.text(
+                "SELECT relpersistence FROM pg_class WHERE relname = :t"), {"t": db_name}).scalar()
+
+        durable_db = pg_storage.create_db("test_db_durable")
+        presence_db = pg_storage.create_db("test_db_presence", "async_commit")
+        typing_db = pg_storage.create_db("test_db_typing", "unlogged")
+        assert persistence("test_db_typing") == "u"
+        assert persistence("test_db_presence") == "p"
+        assert not relaxed(lambda: durable_db.put("a", 1))
+        assert relaxed(lambda: presence_db.put("a", 1))
+        assert relaxed(lambda: typing_db.put("a/b", 1))
+        assert typing_db.get("a") == {"b": 1}
+
+        with PostgresJsonStorage(db_settings) as other_storage:
+            assert other_storage.db_meta.durability_of("test_db_typing") == "unlogged"
+            assert other_storage.db_meta.durability_of("test_db_durable") == "durable"
+
+        pg_storage.set_durability("test_db_typing", "durable")
+        assert persistence("test_db_typing") == "p"
+        assert not relaxed(lambda: typing_db.put("a/c", 2))
+        assert typing_db.get("a") == {"b": 1, "c": 2}
+        with pytest.raises(ValueError):
+            pg_storage.create_db("test_db_other", "fast")
+        for db_name in ("test_db_durable", "test_db_presence", "test_db_typing"):
+            pg_storage.delete_db(db_name)
+
+    db_settings["layout"] = "shared"
+    with PostgresJsonStorage(db_settings) as pg_storage:
+        with pytest.raises(ValueError):
+            pg_storage.create_db("test_db_typing", "unlogged")
+        pg_storage.session.rollback()
+        presence_db = pg_storage.create_db("test_db_presence", "async_commit")
+        presence_db.put("a", 1)
+        assert presence_db.get("a") == 1
+        with pytest.raises(ValueError):
+            pg_storage.set_durability("test_db_presence", "unlogged")
+        pg_storage.delete_db("test_db_presence")
+
+
 def test_create_index():
     """
     create an index on a path in json document, for faster access on those paths.
+    ordered queries of the root are counted, the advisor creates indexes for the frequent ones
+    and drops those not used since it was last applied
     :return:
     """
-    pass
+    test_db_name = "test_db_index"
+    for layout in ("table_per_db", "shared"):
+        db_settings = get_test_db_settings()
+        db_settings["layout"] = layout
+        db_settings["index_advisor_min_queries"] = 3
+        with PostgresJsonStorage(db_settings) as pg_storage:
+            json_db = pg_storage.create_db(test_db_name)
+            for i in range(20):
+                json_db.put("u%02d" % i, {"ts": i % 5})
+            for _ in range(3):
+                json_db.query(None, "ts", start_at=4)
+                json_db.query("u01", "ts")
+            json_db.query(None, "name")
+
+            advice = pg_storage.advise_indexes(test_db_name)
+            assert advice["create"] == ["ts"]
+            assert advice["drop"] == []
+            assert [q["path"] for q in advice["not_indexable"]] == ["u01"]
+            assert pg_storage.list_indexes(test_db_name) == []
+
+            pg_storage.advise_indexes(test_db_name, apply=True)
+            indexes = pg_storage.list_indexes(test_db_name)
+            assert [index["order_by"] for index in indexes] == ["ts"]
+            # creating it again is a no-op
+            assert pg_storage.create_index(test_db_name, "ts") == indexes[0]["name"]
+            assert json_db.query(None, "ts", start_at=4) == {"u04": {"ts": 4}, "u09": {"ts": 4},
+                                                              "u14": {"ts": 4}, "u19": {"ts": 4}}
+
+            # queried since it was created
+            assert pg_storage.advise_indexes(test_db_name, apply=True)["drop"] == []
+            # unused since, however often the advice is read
+            assert pg_storage.advise_indexes(test_db_name)["drop"] == ["ts"]
+            assert pg_storage.advise_indexes(test_db_name)["drop"] == ["ts"]
+            assert pg_storage.list_indexes(test_db_name) != []
+            assert pg_storage.advise_indexes(test_db_name, apply=True)["drop"] == ["ts"]
+            assert pg_storage.list_indexes(test_db_name) == []
+
+            pg_storage.create_index(test_db_name, "ts")
+            pg_storage.delete_db(test_db_name)
+            assert pg_storage.list_indexes(test_db_name) == []
+            assert pg_storage.access_stats.for_db(test_db_name) == []
+
+
+def get_test_shard_settings():
+    """
+    settings with the test db as shard s1 and a second database as shard s2
+    """
+    db_settings = get_test_db_settings()
+    db_settings["shards"] = [{"name": "s1"}, {"name": "s2", "db": TEST_SHARD_DB_NAME}]
+    return db_settings
+
+
+def test_sharded_storage():
+    """
+    dbs are placed on a shard by the hash of their name, calls of a db go to its shard
+    :return:
+    """
+    from pgfire.engine.storage.postgres.shards import ShardedJsonStorage
+    db_names = ["test_db_shard_%d" % i for i in range(6)]
+    with ShardedJsonStorage(get_test_shard_settings()) as storage:
+        homes = dict((db_name, storage.home_shard(db_name)) for db_name in db_names)
+        assert set(homes.values()) == set(storage.shards.values())
+        for db_name in db_names:
+            storage.create_db(db_name).put("a/b", db_name)
+        for db_name in db_names:
+            assert storage.hosting_shard(db_name) is homes[db_name]
+            assert homes[db_name].get_db(db_name).get("a") == {"b": db_name}
+            assert storage.get_db(db_name).get("a/b") == db_name
+            assert storage.get_db(db_name).query(None, "b") == {"a": {"b": db_name}}
+        assert sorted(db_name for db_name in storage.get_all_dbs() if db_name.startswith("test_db_shard")) == db_names
+        with pytest.raises(exc.IntegrityError):
+            storage.create_db(db_names[0])
+
+        # a db found on a shard stays there, whatever the hash says
+        home = storage.home_shard("test_db_placed")
+        other_shard = [shard for shard in storage.shards.values() if shard is not home][0]
+        other_shard.create_db("test_db_placed")
+        storage.get_db("test_db_placed").put("x", 1)
+        assert other_shard.get_db("test_db_placed").get("x") == 1
+
+        with storage.get_notifier(db_names[1], "a") as notifier:
+            message_stream = notifier.listen()
+            storage.get_db(db_names[1]).put("a/b", 2)
+            assert _next_events(message_stream, 1) == [{"event": "put", "path": "a/b", "data": 2}]
+
+        for db_name in db_names + ["test_db_placed"]:
+            assert storage.delete_db(db_name)
+            assert storage.get_db(db_name) is None
+
+
+def test_move_db():
+    """
+    a db is copied to another shard while it is written, then switched over
+    :return:
+    """
+    from pgfire.engine.storage.postgres.move_db import DbMover
+    from pgfire.engine.storage.postgres.shards import ShardedJsonStorage
+    test_db_name = "test_db_move"
+    shard_settings = get_test_shard_settings()
+    for layout in ("table_per_db", "shared"):
+        db_settings = dict(shard_settings, layout=layout)
+        with ShardedJsonStorage(db_settings) as storage, ShardedJsonStorage(db_settings) as writer_storage:
+            source = storage.home_shard(test_db_name)
+            target_name = [name for name, shard in storage.shards.items() if shard is not source][0]
+            target = storage.shards[target_name]
+            json_db = storage.create_db(test_db_name, "async_commit")
+            for i in range(20):
+                json_db.put("u%02d" % i, {"ts": i})
+            json_db.put("presence/a", True, ttl=60)
+            storage.create_index(test_db_name, "ts")
+
+            # writes waiting on the switch are retried on the target, none of them is lost
+            stop = threading.Event()
+            increments = []
+
+            def write():
+                while not stop.is_set():
+                    increments.append(writer_storage.get_db(test_db_name).increment("writer"))
+
+            writer_thread = threading.Thread(target=write)
+            writer_thread.start()
+
+            def during_copy(message):
+                if message.startswith("copied"):
+                    json_db.put("u00/ts", 100)
+                    json_db.delete("u01")
+                    json_db.put("added", 1)
+
+            notifier = storage.get_notifier(test_db_name, None)
+            message_stream = notifier.listen()
+            with ShardedJsonStorage(db_settings) as mover_storage:
+                DbMover(mover_storage, test_db_name, target_name, page_size=7, log=during_copy).move()
+            time.sleep(0.2)
+            stop.set()
+            writer_thread.join()
+            assert {"event": "moved", "path": "", "data": target_name} in _next_events(message_stream, 100, 1)
+            notifier.cleanup()
+
+            assert storage.hosting_shard(test_db_name, fresh=True) is target
+            assert not source.hosts_db(test_db_name, fresh=True)
+            expected = dict(("u%02d" % i, {"ts": i}) for i in range(2, 20))
+            expected.update({"u00": {"ts": 100}, "added": 1, "presence": {"a": True}})
+            expected["writer"] = len(increments)
+            assert increments == list(range(1, len(increments) + 1))
+            assert target.get_db(test_db_name).get(None) == expected
+            assert [index["order_by"] for index in target.list_indexes(test_db_name)] == ["ts"]
+            assert source.list_indexes(test_db_name) == []
+            assert target.session.execute(
+                "SELECT e.path FROM path_expiry e JOIN storage_meta m ON m.id = e.db_id "
+                "WHERE m.db_name = '%s'" % test_db_name).fetchall() == [("presence/a",)]
+            target.session.rollback()
+            # the storages route to the target once they heard of the move
+            assert storage.get_db(test_db_name).get("u00/ts") == 100
+            storage.delete_db(test_db_name)
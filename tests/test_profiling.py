@@ -0,0 +1,43 @@
+import threading
+
+from pgfire.rest.profiling import sample_stacks, memory_snapshot, start_memory_tracing, stop_memory_tracing
+
+
+def _busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sample_stacks():
+    stop = threading.Event()
+    busy = threading.Thread(target=_busy_loop, args=(stop,), name="busy")
+    busy.start()
+    try:
+        stacks = sample_stacks(0.2, interval=0.001)
+    finally:
+        stop.set()
+        busy.join()
+    lines = [line.rsplit(" ", 1) for line in stacks.splitlines()]
+    busy_samples = sum(int(count) for stack, count in lines
+                       if stack.startswith("busy;") and "test_profiling.py:_busy_loop:" in stack)
+    assert busy_samples > 10
+    # the most sampled stacks come first
+    counts = [int(count) for _, count in lines]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_memory_snapshot():
+    assert "top_allocators" not in memory_snapshot()
+    assert start_memory_tracing()
+    try:
+        assert not start_memory_tracing()
+        blocks = [bytearray(1000) for _ in range(1000)]
+        snapshot = memory_snapshot(top=5)
+        assert snapshot["tracing"]
+        assert len(snapshot["top_allocators"]) == 5
+        top = snapshot["top_allocators"][0]
+        assert "test_profiling.py" in top["location"]
+        assert top["bytes"] >= 1000 * len(blocks)
+    finally:
+        stop_memory_tracing()
+    assert not memory_snapshot()["tracing"]
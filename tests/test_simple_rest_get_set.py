@@ -1,3 +1,5 @@
+import json
+import time
 from contextlib import contextmanager
 
 import requests
@@ -15,6 +17,10 @@ def get_test_config():
             "port": 5432,
             "password": "123456",
             "host": "localhost"
+        },
+        "profiling": {
+            "admin_token": "test-admin-token",
+            "max_seconds": 5
         }
     }
 
@@ -100,6 +106,10 @@ def test_create_json_db():
     # # create the same db again
     # response = requests.post(url=url, json=data)
     # assert response.status_code == 400
+    response = requests.post(url=url, json={"db_name": "a_json_db_presence", "durability": "async_commit"})
+    assert response.ok
+    response = requests.post(url=url, json={"db_name": "a_json_db_fast", "durability": "fast"})
+    assert response.status_code == 400
 
 
 def test_get_put_post_delete_from_app():
@@ -176,9 +186,200 @@ def test_delete_json_db():
     assert response.ok
 
 
+def test_get_page_from_app():
+    json_db_name = "a_json_db_page"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s'
+    for key in ("c", "a", "b"):
+        requests.put(url=url % (json_db_name, "items/" + key), json=key)
+
+    response = requests.get(url=url % (json_db_name, "items"), params={"limit": 2})
+    assert response.ok
+    assert response.json() == {"a": "a", "b": "b"}
+    assert response.headers["X-Pgfire-Next"] == "b"
+
+    response = requests.get(url=url % (json_db_name, "items"), params={"limit": 2, "after": "b"})
+    assert response.json() == {"c": "c"}
+    assert "X-Pgfire-Next" not in response.headers
+
+    requests.put(url=url % (json_db_name, "items/d"), json={"title": "d", "body": "..."})
+    response = requests.get(url=url % (json_db_name, "items"), params={"limit": 1, "after": "c", "fields": "title"})
+    assert response.json() == {"d": {"title": "d"}}
+
+    response = requests.get(url=url % (json_db_name, "items"), params={"limit": "x"})
+    assert response.status_code == 400
+
+
+def test_streamed_put_from_app():
+    json_db_name = "a_json_db_stream"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s'
+    data = dict(("item%s" % i, {"i": i, "body": "x" * 100}) for i in range(1000))
+
+    def body(value):
+        # a generator is sent chunked, with no content length
+        text = json.dumps(value).encode('utf-8')
+        for i in range(0, len(text), 1000):
+            yield text[i:i + 1000]
+
+    response = requests.put(url=url % (json_db_name, "big"), data=body(data))
+    assert response.status_code == 204
+    assert requests.get(url=url % (json_db_name, "big")).json() == data
+
+    response = requests.put(url=url % (json_db_name, ""), data=body({"a": 1, "big": {"b": 2}}))
+    assert response.status_code == 204
+    assert requests.get(url=url % (json_db_name, "")).json() == {"a": 1, "big": {"b": 2}}
+
+    response = requests.post(url=url % (json_db_name, "posts"), data=body({"t": 1}))
+    push_id = list(response.json().keys())[0]
+    assert requests.get(url=url % (json_db_name, "posts/" + push_id)).json() == {"t": 1}
+
+    # not an object, parsed as a whole
+    response = requests.put(url=url % (json_db_name, "list"), data=body([1, 2]))
+    assert response.json() == [1, 2]
+    response = requests.put(url=url % (json_db_name, "list"), data=(b for b in [b'{"a": ']))
+    assert response.status_code == 400
+
+
+def test_replace_from_app():
+    json_db_name = "a_json_db_replace"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s'
+    response = requests.put(url=url % (json_db_name, ""), json={"a": {"x": 1}, "b": 2})
+    assert response.json() == {"a": {"x": 1}, "b": 2}
+    response = requests.put(url=url % (json_db_name, ""), json={"a": {"x": 1}, "c": 3})
+    assert response.ok
+    assert requests.get(url=url % (json_db_name, "")).json() == {"a": {"x": 1}, "c": 3}
+
+    response = requests.put(url=url % (json_db_name, "a"), params={"op": "replace"}, json={"y": 2})
+    assert response.json() == {"y": 2}
+    assert requests.get(url=url % (json_db_name, "a")).json() == {"y": 2}
+
+    assert requests.put(url=url % (json_db_name, ""), json=[1]).status_code == 400
+    assert requests.put(url=url % (json_db_name, "a"), params={"op": "x"}, json=1).status_code == 400
+
+
+def test_unchanged_write_from_app():
+    json_db_name = "a_json_db_unchanged"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s' % (json_db_name, "a")
+    response = requests.put(url=url, json={"x": 1, "y": 2})
+    assert response.json() == {"x": 1, "y": 2}
+    assert 'X-Pgfire-Unchanged' not in response.headers
+    response = requests.put(url=url, json={"x": 1, "y": 2})
+    assert response.json() == {"x": 1, "y": 2}
+    assert response.headers['X-Pgfire-Unchanged'] == 'true'
+    response = requests.patch(url=url, json={"y": 2})
+    assert response.headers['X-Pgfire-Unchanged'] == 'true'
+    response = requests.patch(url=url, json={"y": 3})
+    assert 'X-Pgfire-Unchanged' not in response.headers
+    assert requests.get(url=url).json() == {"x": 1, "y": 3}
+
+
+def test_ttl_from_app():
+    json_db_name = "a_json_db_ttl"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s'
+    assert requests.put(url=url % (json_db_name, "presence/a"), params={"ttl": "0.5"}, json=True).ok
+    assert requests.post(url=url % (json_db_name, "typing"), params={"ttl": "0.5"}, json="a").ok
+    assert requests.patch(url=url % (json_db_name, "session"), params={"ttl": "60"}, json={"user": "a"}).ok
+    assert requests.put(url=url % (json_db_name, "presence/b"), params={"ttl": "-1"}, json=True).status_code == 400
+    assert requests.put(url=url % (json_db_name, "presence"), params={"ttl": "1", "op": "replace"},
+                        json={}).status_code == 400
+    deadline = time.monotonic() + 10
+    while requests.get(url=url % (json_db_name, "")).json() != {"session": {"user": "a"}}:
+        assert time.monotonic() < deadline
+        time.sleep(0.2)
+
+
+def test_query_from_app():
+    json_db_name = "a_json_db_query"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s'
+    requests.put(url=url % (json_db_name, "users"), json={
+        "a": {"age": 30}, "b": {"age": 20}, "c": {"name": "c"}, "d": {"age": 25}})
+    response = requests.get(url=url % (json_db_name, "users"), params={"orderBy": '"age"', "startAt": "20",
+                                                                       "limitToFirst": "2"})
+    assert list(response.json()) == ["b", "d"]
+    response = requests.get(url=url % (json_db_name, "users"), params={"orderBy": "age", "limitToLast": "1"})
+    assert response.json() == {"a": {"age": 30}}
+    response = requests.get(url=url % (json_db_name, "users"), params={"orderBy": "age", "equalTo": "25"})
+    assert response.json() == {"d": {"age": 25}}
+    assert requests.get(url=url % (json_db_name, "users"),
+                        params={"orderBy": "age", "startAt": "x"}).status_code == 400
+    assert requests.get(url=url % (json_db_name, "users"), params={"orderBy": ""}).status_code == 400
+    assert requests.get(url=url % (json_db_name, "users"),
+                        params={"orderBy": "age", "limitToFirst": "0"}).status_code == 400
+    # reads after a write send its position, a malformed one is rejected
+    assert requests.get(url=url % (json_db_name, "users/a"), headers={"X-Pgfire-Lsn": "0/0"}).json() == {"age": 30}
+    for params in ({}, {"limit": "1"}, {"orderBy": "age"}):
+        assert requests.get(url=url % (json_db_name, "users"), params=params,
+                            headers={"X-Pgfire-Lsn": "not/an-lsn"}).status_code == 400
+
+    advice = requests.get(url='http://localhost:8666/admin/indexes/%s' % json_db_name).json()
+    assert {"path": "users", "order_by": "age", "queries": 3, "filtered": 2} in advice["queries"]
+    # changing indexes takes the admin token
+    assert requests.post(url='http://localhost:8666/admin/indexes/%s' % json_db_name).status_code == 403
+    assert requests.post(url='http://localhost:8666/admin/indexes/%s' % json_db_name,
+                         headers={"X-Pgfire-Admin-Token": "wrong"}).status_code == 403
+    assert requests.post(url='http://localhost:8666/admin/indexes/%s' % json_db_name,
+                         headers={"X-Pgfire-Admin-Token": "test-admin-token"}).json()["create"] == []
+    assert requests.get(url='http://localhost:8666/admin/indexes/missing_db').status_code == 404
+
+
+def test_db_stats_from_app():
+    json_db_name = "a_json_db_stats"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url = 'http://localhost:8666/database/%s/%s'
+    assert requests.put(url=url % (json_db_name, "a"), json={"x": 1}).ok
+    assert requests.put(url=url % (json_db_name, "b"), json=[1, 2]).ok
+    assert requests.delete(url=url % (json_db_name, "a")).ok
+    stats = requests.get(url='http://localhost:8666/stats').json()
+    # pg_column_size of {"b": [1, 2]} as jsonb
+    assert stats[json_db_name] == {"rows": 1, "bytes": 48, "writes": 3,
+                                   "writes_per_minute": 0, "subscribers": 0}
+
+
 data_received_count1 = 0
 
 
+def test_profiling_from_app():
+    url = 'http://localhost:8666/admin/profile/%s'
+    headers = {"X-Pgfire-Admin-Token": "test-admin-token"}
+    assert requests.get(url=url % "cpu", params={"seconds": "0.2"}).status_code == 403
+    assert requests.get(url=url % "cpu", params={"seconds": "0.2"},
+                        headers={"X-Pgfire-Admin-Token": "wrong"}).status_code == 403
+    assert requests.get(url=url % "cpu", params={"seconds": "10"}, headers=headers).status_code == 400
+
+    response = requests.get(url=url % "cpu", params={"seconds": "0.2"}, headers=headers)
+    assert response.ok
+    assert response.headers["Content-Disposition"].startswith("attachment; ")
+    # the event loop is sampled while it waits for the profile
+    assert any(line.startswith("MainThread;") for line in response.text.splitlines())
+
+    assert requests.post(url=url % "memory", headers=headers).json()["tracing"]
+    requests.get(url='http://localhost:8666/database/a_json_db/')
+    snapshot = requests.get(url=url % "memory", params={"top": "3"}, headers=headers).json()
+    assert len(snapshot["top_allocators"]) == 3
+    assert snapshot["event_queues"] == {}
+    assert not requests.delete(url=url % "memory", headers=headers).json()["tracing"]
+    assert "top_allocators" not in requests.get(url=url % "memory", headers=headers).json()
+
+
 def test_eventsource_api():
     # create json db
     json_db_name = "a_json_db_3"
@@ -224,3 +425,48 @@ def test_eventsource_api():
 
     time.sleep(5)
     assert data_received_count1 == 3
+
+
+def test_live_query_eventsource_api():
+    json_db_name = "a_json_db_live_query"
+    response = requests.post(url='http://localhost:8666/createdb', json={"db_name": json_db_name})
+    assert response.ok
+
+    url_event = 'http://localhost:8666/database_events/%s/%s'
+    url = 'http://localhost:8666/database/%s/%s'
+    for key, ts in (("a", 1), ("b", 2), ("c", 3)):
+        requests.put(url=url % (json_db_name, "posts/%s" % key), json={"ts": ts})
+    assert requests.get(url=url_event % (json_db_name, "posts"), params={"orderBy": "ts", "limitToLast": "x"},
+                        stream=True).status_code == 400
+
+    from sseclient import SSEClient
+    sse = SSEClient(url_event % (json_db_name, "posts") + "?orderBy=ts&limitToLast=2")
+    messages = []
+
+    def message_listener():
+        for msg in sse:
+            if msg.data:
+                messages.append(json.loads(msg.data))
+
+    import threading
+    thr = threading.Thread(target=message_listener, daemon=True)
+    thr.start()
+
+    deadline = time.monotonic() + 10
+    while not messages:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    # changes of children outside of the window are not sent
+    requests.put(url=url % (json_db_name, "posts/a/title"), json="a")
+    requests.put(url=url % (json_db_name, "posts/d"), json={"ts": 4})
+    requests.patch(url=url % (json_db_name, "posts/c"), json={"title": "c"})
+    while len(messages) < 4:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    time.sleep(0.5)
+    assert messages == [
+        {"b": {"ts": 2}, "c": {"ts": 3}},
+        {"event": "exit", "key": "b"},
+        {"event": "enter", "key": "d", "data": {"ts": 4}},
+        {"event": "update", "key": "c", "data": {"ts": 3, "title": "c"}},
+    ]
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from pgfire.rest.streaming import JsonObjectStreamParser, NotAnObject
+
+
+def parse(text, piece_size):
+    parser = JsonObjectStreamParser()
+    members = []
+    for i in range(0, len(text), piece_size):
+        members += parser.feed(text[i:i + piece_size])
+    members += parser.close()
+    return members
+
+
+def test_members_split_at_any_piece_size():
+    value = {"a": {"b": [1, {"c": "x\\\"}{]["}], "d": None}, "e\"k": "str \\\\", "n": -1.5e3,
+             "t": True, "f": False, "z": None, "empty": {}, "arr": [], "u": "é中"}
+    for indent in (None, 2):
+        text = json.dumps(value, indent=indent, ensure_ascii=False)
+        for piece_size in (1, 2, 7, 1000):
+            members = parse(text, piece_size)
+            assert dict((key, value) for key, value, _ in members) == value
+            assert [key for key, _, _ in members] == list(value)
+    assert parse(" {} ", 1) == []
+    assert parse('{"a": [1, 2]}', 3) == [("a", [1, 2], 6)]
+
+
+def test_invalid_bodies():
+    with pytest.raises(NotAnObject):
+        JsonObjectStreamParser().feed(" [1]")
+    for body in ('{"a" 1}', '{"a":1 "b":2}', '{"a":1', '{"a":1}x', '{"a":1,}', '{"a":tru}'):
+        with pytest.raises(ValueError):
+            parse(body, 2)